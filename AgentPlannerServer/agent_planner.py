@@ -1,13 +1,48 @@
-from typing import Optional
+from typing import Any, AsyncIterator, Optional, Tuple
 from .llm_client import LLMClient
-from .types import ExecutionPlan
+from .llm_scheduler import LLMUnavailableError, Priority
+from .model_router import Route
+from .plan_batcher import PlanBatcher
+from .plan_cache import PlanCache
+from .plan_repair import MAX_REASKS, reask_prompt, repair_plan_text
+from .plan_stream import IncrementalTaskParser
+from .tracing import Span, get_tracer
+from .types import AnalysisTask, ExecutionPlan
+
+
+PLANNER_SYSTEM_PROMPT = """你是一个数据分析专家。请将用户请求拆解为任务列表。
+必须返回 JSON 格式。
+JSON Schema 示例: 
+{ 
+  "planId": "string", 
+  "tasks": [
+    { "id": 1, "tool": "Text2SQL", "description": "...", "subQuery": "...", "dependencies": [] }
+  ] 
+}"""
 
 
 class AgentPlanner:
-    """任务规划器"""
+    """
+    任务规划器
     
-    def __init__(self, client: LLMClient):
+    Args:
+        client: LLM客户端
+        plan_cache: 可选的执行计划缓存
+        batcher: 可选的规划请求微批处理器，并发请求合并为一次多查询规划调用
+        max_reasks: 规划输出在本地无法修复时重新请求LLM的最大次数
+    """
+    
+    def __init__(
+        self,
+        client: LLMClient,
+        plan_cache: Optional[PlanCache] = None,
+        batcher: Optional[PlanBatcher] = None,
+        max_reasks: int = MAX_REASKS,
+    ):
         self.client = client
+        self.plan_cache = plan_cache
+        self.batcher = batcher
+        self.max_reasks = max_reasks
     
     async def create_plan(self, user_query: str) -> Optional[ExecutionPlan]:
         """
@@ -19,22 +54,133 @@ class AgentPlanner:
         Returns:
             执行计划对象，如果失败则返回None
         """
-        system_prompt = """你是一个数据分析专家。请将用户请求拆解为任务列表。
-必须返回 JSON 格式。
-JSON Schema 示例: 
-{ 
-  "planId": "string", 
-  "tasks": [
-    { "id": 1, "tool": "Text2SQL", "description": "...", "subQuery": "...", "dependencies": [] }
-  ] 
-}"""
+        plan = None
+        async for kind, item in self.stream_plan(user_query):
+            if kind == "plan":
+                plan = item
+        return plan
+    
+    async def stream_plan(self, user_query: str) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        流式创建执行计划：边接收LLM输出边增量解析，每个任务对象闭合时立即产出
+        
+        Args:
+            user_query: 用户查询字符串
+        
+        缓存命中或批量规划返回完整计划时，一次性产出全部任务。
+        
+        Yields:
+            ("task", AnalysisTask)：一个已完整输出的任务；
+            最后是 ("plan", ExecutionPlan)，规划失败时为 ("plan", None)
+        
+        Raises:
+            LLMUnavailableError: LLM服务过载
+        """
+        span = get_tracer().start_span("plan")
+        try:
+            async for item in self._stream_plan(user_query, span):
+                yield item
+        except Exception as e:
+            span.end(e)
+            raise
+        finally:
+            span.end()
+    
+    async def _stream_plan(self, user_query: str, span: Span) -> AsyncIterator[Tuple[str, Any]]:
+        tracer = get_tracer()
+        plan = None
+        if self.plan_cache is not None:
+            plan = self.plan_cache.get(user_query)
+            span.set("cache_hit", plan is not None)
+            tracer.count("cache_hits_total" if plan is not None else "cache_misses_total", cache="plan")
+        if plan is None and self.batcher is not None:
+            # 批量规划无法增量产出任务；未被合并或结果不可用时回退到下面的流式规划
+            plan = await self.batcher.plan(user_query)
+            span.set("batched", plan is not None)
+            if plan is not None and self.plan_cache is not None:
+                self.plan_cache.put(user_query, plan)
+        if plan is not None:
+            span.set("tasks", len(plan.tasks))
+            for task in plan.tasks:
+                yield "task", task
+            yield "plan", plan
+            return
         
+        parser = IncrementalTaskParser()
+        streamed = set()
+        # 出现不合法的任务后不再提前产出：修复时它可能占用后续任务的ID
+        valid_so_far = True
         try:
-            response_text = await self.client.ask(user_query, system_prompt, is_json=True)
-            import json
-            plan_dict = json.loads(response_text)
-            return ExecutionPlan(**plan_dict)
+            async for chunk in self.client.ask_stream(
+                user_query, PLANNER_SYSTEM_PROMPT, priority=Priority.PLANNER, is_json=True, route=Route.PLANNER,
+            ):
+                for task_dict in parser.feed(chunk):
+                    if not valid_so_far:
+                        continue
+                    try:
+                        task = AnalysisTask(**task_dict)
+                    except Exception:
+                        # 不合法的任务留给完整解析后的本地修复处理
+                        valid_so_far = False
+                        continue
+                    if task.id in streamed:
+                        # 重复ID会在修复时重新编号，只随最终计划产出
+                        continue
+                    if not all(dep in streamed for dep in task.dependencies):
+                        # 依赖尚未到达（前向引用、悬空或循环依赖）的任务可能被修复改写，
+                        # 只随通过校验的最终计划产出
+                        continue
+                    streamed.add(task.id)
+                    if "first_task_ms" not in span.attributes:
+                        span.set("first_task_ms", round(span.duration * 1000, 2))
+                    yield "task", task
+            plan = await self._repair(user_query, parser.text, span)
+        except LLMUnavailableError:
+            # LLM服务过载时交给接口层返回 429/503，而不是当作规划失败
+            raise
         except Exception as e:
             print(f"创建计划失败: {e}")
-            return None
-
+            yield "plan", None
+            return
+        
+        if plan is None:
+            print("创建计划失败: 规划输出无法修复")
+            yield "plan", None
+            return
+        span.set("tasks", len(plan.tasks))
+        if self.plan_cache is not None:
+            self.plan_cache.put(user_query, plan)
+        yield "plan", plan
+    
+    async def _repair(self, user_query: str, text: str, span: Span) -> Optional[ExecutionPlan]:
+        """
+        解析规划输出，不合法时先在本地修复，仍无法得到计划时才重新请求LLM
+        
+        已流式产出的任务合法、ID唯一且只依赖更早产出的任务，本地修复不会改变它们，
+        执行引擎收到最终计划后按修复后的依赖补齐剩余任务。
+        
+        Returns:
+            执行计划，本地修复和重新请求都失败时返回None
+        """
+        tracer = get_tracer()
+        plan, repairs = repair_plan_text(text, user_query)
+        reasks = 0
+        while plan is None and reasks < self.max_reasks:
+            reasks += 1
+            tracer.count("plan_repairs_total", kind="reask")
+            text = await self.client.ask(
+                reask_prompt(user_query, text),
+                PLANNER_SYSTEM_PROMPT,
+                is_json=True,
+                priority=Priority.PLANNER,
+                route=Route.PLANNER,
+            )
+            plan, repairs = repair_plan_text(text, user_query)
+        
+        for kind in set(repairs):
+            tracer.count("plan_repairs_total", kind=kind)
+        if repairs:
+            span.set("repairs", ",".join(sorted(set(repairs))))
+        if reasks:
+            span.set("reasks", reasks)
+        return plan
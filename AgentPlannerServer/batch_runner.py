@@ -0,0 +1,281 @@
+"""
+离线批量分析 - 把 JSONL 文件中的查询直接送入规划、执行、合成流水线
+
+用于夜间报表等批量场景，无需逐条调用自己的 HTTP /analyze 接口：
+- 输入逐行流式读取，每行是一个 JSON 对象（查询取 query 字段）或一个 JSON 字符串
+- 并发度有界，乱序缓冲区也有上限，内存占用与输入规模无关
+- 输出文件每写一行立即刷盘，同时作为检查点：--resume 时跳过已成功的记录，失败的记录重新执行
+- 支持按输入顺序输出（默认）或按完成顺序输出
+- 可选的后处理函数（module:function），CPU 密集时可通过 --processes 放到进程池执行
+
+用法:
+    python3 -m AgentPlannerServer.batch_runner queries.jsonl --out results.jsonl --concurrency 8
+    python3 -m AgentPlannerServer.batch_runner queries.jsonl --out results.jsonl --resume --unordered \\
+        --postprocess reports.nightly:render --processes 4
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple
+
+from .agent_planner import AgentPlanner
+from .execution_engine import ExecutionEngine
+from .llm_cache import ResponseCache
+from .llm_client import LLMClient
+from .llm_scheduler import LLMUnavailableError
+from .plan_batcher import PlanBatcher
+from .plan_cache import PlanCache
+from .text2sql import Text2SQLExecutor, llm_sql_generator
+from .vector_index import VectorRetriever
+
+
+Job = Tuple[int, str, str]
+PostProcessor = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+def read_jobs(input_path: str, query_field: str = "query", id_field: str = "id") -> Iterator[Job]:
+    """
+    逐行读取输入文件
+    
+    Yields:
+        (行号, 任务ID, 查询)；没有 id 字段时以行号作为任务ID，空行和无法解析的行被跳过
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"第 {line_no} 行解析失败: {e}")
+                continue
+            if isinstance(record, str):
+                yield line_no, str(line_no), record
+            elif isinstance(record, dict) and record.get(query_field):
+                yield line_no, str(record.get(id_field, line_no)), str(record[query_field])
+            else:
+                print(f"第 {line_no} 行缺少 {query_field} 字段，已跳过")
+
+
+def load_checkpoint(output_path: str) -> Set[str]:
+    """读取已有输出文件中成功完成的任务ID"""
+    done: Set[str] = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 上次中断时可能留下半行
+                continue
+            if record.get("success"):
+                done.add(str(record.get("id")))
+    return done
+
+
+def load_postprocessor(spec: str) -> PostProcessor:
+    """按 "module:function" 加载后处理函数（使用进程池时必须是模块级函数）"""
+    module_name, _, function_name = spec.partition(":")
+    if not function_name:
+        raise ValueError(f"后处理函数格式应为 module:function: {spec}")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class BatchRunner:
+    """
+    批量分析执行器
+    
+    Args:
+        planner: 规划器
+        engine: 执行引擎
+        concurrency: 同时执行的查询数
+        ordered: 是否按输入顺序输出
+        postprocess: 可选的后处理函数，输入输出都是结果记录字典
+        processes: 后处理进程池大小，0 表示在事件循环中直接调用
+    """
+    
+    def __init__(
+        self,
+        planner: AgentPlanner,
+        engine: ExecutionEngine,
+        concurrency: int = 8,
+        ordered: bool = True,
+        postprocess: Optional[PostProcessor] = None,
+        processes: int = 0,
+    ):
+        self.planner = planner
+        self.engine = engine
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.postprocess = postprocess
+        self.processes = processes
+    
+    async def analyze(self, job_id: str, query: str) -> Dict[str, Any]:
+        """对单个查询执行完整的规划、执行和合成，失败时返回 success=False 的记录"""
+        started = time.monotonic()
+        record: Dict[str, Any] = {"id": job_id, "query": query, "success": False}
+        try:
+            plan, final_answer = await self.engine.run_incremental(self.planner.stream_plan(query))
+            if plan is None:
+                record["message"] = "创建执行计划失败"
+            else:
+                record.update(plan=plan.model_dump(mode="json"), finalAnswer=final_answer, success=True)
+        except ValueError as e:
+            record["message"] = f"执行计划不合法: {e}"
+        except LLMUnavailableError as e:
+            record["message"] = f"LLM服务不可用: {e}"
+        except Exception as e:
+            record["message"] = f"执行失败: {e}"
+        record["elapsed"] = round(time.monotonic() - started, 3)
+        return record
+    
+    async def run(
+        self,
+        input_path: str,
+        output_path: str,
+        resume: bool = False,
+        query_field: str = "query",
+        id_field: str = "id",
+    ) -> Dict[str, Any]:
+        """
+        执行输入文件中的所有查询并写入输出文件
+        
+        Args:
+            input_path: 输入 JSONL 文件
+            output_path: 输出 JSONL 文件（追加写入，兼作检查点）
+            resume: 是否跳过输出文件中已成功的任务
+            query_field: 查询所在的字段名
+            id_field: 任务ID所在的字段名
+        
+        Returns:
+            统计信息：总数、跳过数、成功数、失败数、耗时
+        """
+        done = load_checkpoint(output_path) if resume else set()
+        stats = {"total": 0, "skipped": 0, "succeeded": 0, "failed": 0}
+        started = time.monotonic()
+        
+        jobs: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        # 限制已开始但尚未写出的任务数，按序输出时某个慢查询不会让乱序缓冲区无限增长
+        window = asyncio.Semaphore(self.concurrency * 4)
+        buffer: Dict[int, Dict[str, Any]] = {}
+        next_seq = 0
+        pool = ProcessPoolExecutor(self.processes) if self.processes > 0 and self.postprocess else None
+        
+        mode = "a" if resume else "w"
+        with open(output_path, mode, encoding="utf-8") as out:
+            
+            def write(record: Dict[str, Any]):
+                out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                out.flush()
+                stats["succeeded" if record.get("success") else "failed"] += 1
+                window.release()
+            
+            def emit(seq: int, record: Dict[str, Any]):
+                nonlocal next_seq
+                if not self.ordered:
+                    write(record)
+                    return
+                buffer[seq] = record
+                while next_seq in buffer:
+                    write(buffer.pop(next_seq))
+                    next_seq += 1
+            
+            async def produce():
+                seq = 0
+                for _, job_id, query in read_jobs(input_path, query_field, id_field):
+                    stats["total"] += 1
+                    if job_id in done:
+                        stats["skipped"] += 1
+                        continue
+                    await window.acquire()
+                    await jobs.put((seq, job_id, query))
+                    seq += 1
+                for _ in range(self.concurrency):
+                    await jobs.put(None)
+            
+            async def work():
+                loop = asyncio.get_running_loop()
+                while True:
+                    job = await jobs.get()
+                    if job is None:
+                        return
+                    seq, job_id, query = job
+                    record = await self.analyze(job_id, query)
+                    if self.postprocess is not None and record["success"]:
+                        try:
+                            if pool is not None:
+                                record = await loop.run_in_executor(pool, self.postprocess, record)
+                            else:
+                                record = self.postprocess(record)
+                        except Exception as e:
+                            print(f"任务 {job_id} 后处理失败: {e}")
+                            record.update(success=False, message=f"后处理失败: {e}")
+                    emit(seq, record)
+            
+            try:
+                await asyncio.gather(produce(), *[work() for _ in range(self.concurrency)])
+            finally:
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
+        
+        stats["elapsed"] = round(time.monotonic() - started, 3)
+        return stats
+
+
+async def run_file(
+    input_path: str,
+    output_path: str,
+    concurrency: int = 8,
+    resume: bool = False,
+    ordered: bool = True,
+    postprocess: Optional[PostProcessor] = None,
+    processes: int = 0,
+    query_field: str = "query",
+    id_field: str = "id",
+) -> Dict[str, Any]:
+    """
+    按环境变量配置创建与服务端相同的组件（LLM客户端、计划缓存、微批处理、Text2SQL、RAG），
+    批量执行输入文件后释放连接
+    """
+    client = LLMClient(cache=ResponseCache.from_env())
+    text2sql = Text2SQLExecutor.from_env(llm_sql_generator(client))
+    retriever = VectorRetriever.from_env(client.embed_many)
+    planner = AgentPlanner(client, PlanCache.from_env(), PlanBatcher.from_env(client))
+    engine = ExecutionEngine(client, text2sql, retriever)
+    runner = BatchRunner(planner, engine, concurrency, ordered, postprocess, processes)
+    try:
+        return await runner.run(input_path, output_path, resume, query_field, id_field)
+    finally:
+        await text2sql.close()
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量分析：逐行执行 JSONL 文件中的查询")
+    parser.add_argument("input", help="输入 JSONL 文件")
+    parser.add_argument("--out", required=True, help="输出 JSONL 文件（兼作检查点）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时执行的查询数")
+    parser.add_argument("--resume", action="store_true", help="跳过输出文件中已成功的任务")
+    parser.add_argument("--unordered", action="store_true", help="按完成顺序输出")
+    parser.add_argument("--postprocess", help="后处理函数，格式 module:function")
+    parser.add_argument("--processes", type=int, default=0, help="后处理进程池大小，0 表示不使用进程池")
+    parser.add_argument("--query-field", default="query")
+    parser.add_argument("--id-field", default="id")
+    
+    args = parser.parse_args()
+    postprocess = load_postprocessor(args.postprocess) if args.postprocess else None
+    stats = asyncio.run(run_file(
+        args.input, args.out, args.concurrency, args.resume, not args.unordered,
+        postprocess, args.processes, args.query_field, args.id_field,
+    ))
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+上下文压缩 - 在 token 预算内组织合成阶段的执行上下文
+
+各任务结果先按原样估算 token 数，放得下的原样保留，剩余预算在大结果之间均分：
+表格结果（行字典列表）压缩为表结构、行数、数值列统计、类别列高频值和前 N 行样本；
+文本结果（如RAG引用）按与问题的相关度对片段排序，依次放入直到用完预算。
+压缩结果按 (结果内容, 预算, 问题) 缓存，同一结果重复合成时不再重新计算。
+
+安装 tiktoken（且词表可用）时使用其分词器精确计数，否则按中文一字一 token、其他字符四字一 token 估算。
+"""
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Sequence, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+_CJK_RE = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+_CHUNK_SPLIT_RE = re.compile(r"\n+|(?=【文档引用)")
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """加载 tiktoken 分词器（只尝试一次，离线环境下无法下载词表时回退到估算）"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                print(f"加载tiktoken分词器失败，使用估算计数: {e.__class__.__name__}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """把文本截断到不超过 budget 个 token"""
+    if count_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) + 1 <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + "…"
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _is_table(value: Any) -> bool:
+    return isinstance(value, list) and bool(value) and all(isinstance(row, dict) for row in value)
+
+
+def _bigrams(text: str) -> Counter:
+    text = re.sub(r"\s+", "", text.casefold())
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def _relevance(query_grams: Counter, chunk: str) -> float:
+    """按字符二元组重合度计算相关度（对中文无需分词）"""
+    chunk_grams = _bigrams(chunk)
+    if not chunk_grams or not query_grams:
+        return 0.0
+    overlap = sum((query_grams & chunk_grams).values())
+    return overlap / math.sqrt(sum(chunk_grams.values()))
+
+
+def summarize_table(rows: List[Dict[str, Any]], budget: int) -> str:
+    """
+    把表格结果压缩到预算内
+    
+    Args:
+        rows: 行字典列表（保持查询返回的顺序，前 N 行即 ORDER BY 的前 N 名）
+        budget: token 预算
+    
+    Returns:
+        原表（放得下时）或 表结构 + 统计 + 样本行 的文本
+    """
+    full = _dumps(rows)
+    if count_tokens(full) <= budget:
+        return full
+    
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    lines = [f"共 {len(rows)} 行，列: {', '.join(columns)}"]
+    for column in columns:
+        values = [row.get(column) for row in rows if row.get(column) is not None]
+        numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        if numbers and len(numbers) == len(values):
+            lines.append(
+                f"- {column}: 数值, min={min(numbers):g}, max={max(numbers):g}, "
+                f"mean={sum(numbers) / len(numbers):g}, sum={sum(numbers):g}"
+            )
+        else:
+            top = Counter(str(v) for v in values).most_common(5)
+            distinct = len(set(str(v) for v in values))
+            lines.append(
+                f"- {column}: {distinct} 个不同值, 高频: "
+                + ", ".join(f"{value}({count})" for value, count in top)
+            )
+    
+    header = "\n".join(lines)
+    remaining = budget - count_tokens(header) - count_tokens("\n前 0 行:")
+    sample: List[str] = []
+    for row in rows:
+        line = _dumps(row)
+        cost = count_tokens(line) + 1
+        if cost > remaining:
+            break
+        sample.append(line)
+        remaining -= cost
+    
+    if sample:
+        header += f"\n前 {len(sample)} 行:\n" + "\n".join(sample)
+    return truncate_to_tokens(header, budget)
+
+
+def select_chunks(text: str, query: str, budget: int) -> str:
+    """
+    把文本结果压缩到预算内：按与问题的相关度挑选片段，保持原文顺序输出
+    """
+    if count_tokens(text) <= budget:
+        return text
+    
+    chunks = [chunk.strip() for chunk in _CHUNK_SPLIT_RE.split(text) if chunk.strip()]
+    query_grams = _bigrams(query)
+    ranked = sorted(range(len(chunks)), key=lambda i: _relevance(query_grams, chunks[i]), reverse=True)
+    
+    chosen: List[int] = []
+    remaining = budget
+    for index in ranked:
+        cost = count_tokens(chunks[index]) + 1
+        if cost <= remaining:
+            chosen.append(index)
+            remaining -= cost
+    if not chosen:
+        return truncate_to_tokens(chunks[ranked[0]], budget)
+    return "\n".join(chunks[index] for index in sorted(chosen))
+
+
+class ContextPacker:
+    """
+    合成上下文压缩器
+    
+    Args:
+        budget_tokens: 所有任务结果合计的 token 预算
+        cache_size: 压缩结果缓存的条目数
+    """
+    
+    def __init__(self, budget_tokens: int = 3000, cache_size: int = 256):
+        self.budget_tokens = budget_tokens
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+    
+    @classmethod
+    def from_env(cls) -> "ContextPacker":
+        """根据环境变量创建压缩器"""
+        return cls(
+            budget_tokens=int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000")),
+            cache_size=int(os.getenv("CONTEXT_PACK_CACHE_SIZE", "256")),
+        )
+    
+    def pack(self, query: str, results: Sequence[Tuple[str, Any]]) -> str:
+        """
+        在预算内拼接所有任务结果
+        
+        Args:
+            query: 用户问题，用于文本片段的相关度排序
+            results: (标签, 结果) 列表，如 ("任务 1 结果", rows)
+        
+        Returns:
+            每个结果一行的 “标签: 内容” 文本
+        """
+        texts = [value if isinstance(value, str) else _dumps(value) for _, value in results]
+        costs = [count_tokens(text) for text in texts]
+        budgets = self._allocate(costs)
+        
+        lines = []
+        for (label, value), text, cost, budget in zip(results, texts, costs, budgets):
+            content = text if cost <= budget else self._pack_one(query, value, text, budget)
+            lines.append(f"{label}: {content}")
+        return "\n".join(lines)
+    
+    def _allocate(self, costs: List[int]) -> List[int]:
+        """注水式分配：小结果按实际大小分配，剩余预算在大结果之间均分"""
+        budgets = [0] * len(costs)
+        remaining = self.budget_tokens
+        pending = sorted(range(len(costs)), key=lambda i: costs[i])
+        while pending:
+            share = remaining // len(pending)
+            index = pending[0]
+            if costs[index] <= share:
+                budgets[index] = costs[index]
+                remaining -= costs[index]
+                pending.pop(0)
+            else:
+                for index in pending:
+                    budgets[index] = max(share, 1)
+                break
+        return budgets
+    
+    def _pack_one(self, query: str, value: Any, text: str, budget: int) -> str:
+        # 表格压缩与问题无关，只有文本片段排序依赖问题
+        is_table = _is_table(value)
+        scope = "" if is_table else query
+        key = hashlib.sha256(f"{budget}\0{scope}\0{text}".encode("utf-8")).hexdigest()
+        packed = self._cache.get(key)
+        if packed is not None:
+            self._cache.move_to_end(key)
+            return packed
+        
+        if is_table:
+            packed = summarize_table(value, budget)
+        else:
+            packed = select_chunks(text, query, budget)
+        
+        self._cache[key] = packed
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return packed
@@ -0,0 +1,164 @@
+"""
+执行上下文 - 单次计划执行的任务结果存储
+
+每次 run 创建独立的上下文，结果不会在请求之间泄漏，引擎实例可以安全复用。
+结果按序列化后的字节数计量：超过单条阈值的大结果直接落盘，内存中的结果总量
+超过上限时把最大的结果落盘，上下文关闭时删除所有落盘文件。
+
+落盘和读取落盘文件都是阻塞的文件 IO。在事件循环中应使用 aput / aget / aitems，
+它们在线程池中执行对应的同步方法；同步方法由内部锁保护，可以从多个线程并发调用。
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+
+
+class ResultRecord:
+    """单个任务结果，落盘后 value 为 None、path 指向落盘文件"""
+    __slots__ = ("task_id", "value", "size", "path")
+    
+    def __init__(self, task_id: int, value: Any, size: int, path: Optional[str] = None):
+        self.task_id = task_id
+        self.value = value
+        self.size = size
+        self.path = path
+
+
+class ExecutionContext:
+    """
+    单次执行的结果存储
+    
+    Args:
+        max_bytes: 内存中结果的字节上限，超出时把最大的结果落盘
+        spill_threshold: 单条结果超过该字节数时直接落盘
+        spill_dir: 落盘目录，默认使用系统临时目录
+    """
+    
+    def __init__(
+        self,
+        max_bytes: int = 8 * 1024 * 1024,
+        spill_threshold: int = 1024 * 1024,
+        spill_dir: Optional[str] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self._records: Dict[int, ResultRecord] = {}
+        self._lock = threading.RLock()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+    
+    @classmethod
+    def from_env(cls) -> "ExecutionContext":
+        """根据环境变量创建执行上下文"""
+        return cls(
+            max_bytes=int(os.getenv("EXEC_CONTEXT_MAX_BYTES", str(8 * 1024 * 1024))),
+            spill_threshold=int(os.getenv("EXEC_CONTEXT_SPILL_THRESHOLD", str(1024 * 1024))),
+            spill_dir=os.getenv("EXEC_CONTEXT_SPILL_DIR") or None,
+        )
+    
+    def put(self, task_id: int, value: Any):
+        """保存任务结果，同一任务重复写入时覆盖旧结果（可能同步落盘）"""
+        data = _encode(value)
+        with self._lock:
+            self._discard(task_id)
+            record = ResultRecord(task_id, value, len(data))
+            self._records[task_id] = record
+            
+            if record.size > self.spill_threshold:
+                self._spill(record, data)
+                return
+            
+            self.memory_bytes += record.size
+            while self.memory_bytes > self.max_bytes:
+                largest = max(
+                    (r for r in self._records.values() if r.path is None),
+                    key=lambda r: r.size,
+                )
+                self.memory_bytes -= largest.size
+                self._spill(largest, _encode(largest.value))
+    
+    def get(self, task_id: int, default: Any = None) -> Any:
+        """读取任务结果，落盘的结果从文件中加载"""
+        with self._lock:
+            record = self._records.get(task_id)
+            if record is None:
+                return default
+            if record.path is None:
+                return record.value
+            with open(record.path, "rb") as f:
+                return json.loads(f.read())
+    
+    def items(self) -> Iterator[Tuple[int, Any]]:
+        """按写入顺序遍历 (任务ID, 结果)"""
+        with self._lock:
+            task_ids = list(self._records)
+        for task_id in task_ids:
+            yield task_id, self.get(task_id)
+    
+    async def aput(self, task_id: int, value: Any):
+        """在线程池中执行 put，落盘不阻塞事件循环"""
+        await asyncio.to_thread(self.put, task_id, value)
+    
+    async def aget(self, task_id: int, default: Any = None) -> Any:
+        """在线程池中执行 get"""
+        return await asyncio.to_thread(self.get, task_id, default)
+    
+    async def aitems(self) -> List[Tuple[int, Any]]:
+        """在线程池中读取全部 (任务ID, 结果)，按写入顺序"""
+        return await asyncio.to_thread(lambda: list(self.items()))
+    
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self._records
+    
+    def __len__(self) -> int:
+        return len(self._records)
+    
+    def stats(self) -> Dict[str, int]:
+        """结果数量和内存/磁盘占用"""
+        return {
+            "records": len(self._records),
+            "memory_bytes": self.memory_bytes,
+            "spilled_records": sum(1 for r in self._records.values() if r.path is not None),
+            "spilled_bytes": self.spilled_bytes,
+        }
+    
+    def close(self):
+        """释放所有结果并删除落盘文件"""
+        with self._lock:
+            for task_id in list(self._records):
+                self._discard(task_id)
+    
+    def __enter__(self) -> "ExecutionContext":
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def _spill(self, record: ResultRecord, data: bytes):
+        fd, path = tempfile.mkstemp(prefix="exec_ctx_", suffix=".json", dir=self.spill_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        record.value = None
+        record.path = path
+        self.spilled_bytes += record.size
+    
+    def _discard(self, task_id: int):
+        record = self._records.pop(task_id, None)
+        if record is None:
+            return
+        if record.path is None:
+            self.memory_bytes -= record.size
+            return
+        self.spilled_bytes -= record.size
+        try:
+            os.remove(record.path)
+        except OSError as e:
+            print(f"删除落盘结果失败: {e}")
@@ -1,5 +1,14 @@
-from typing import Any, Optional
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from .context_packer import ContextPacker
+from .execution_context import ExecutionContext
 from .llm_client import LLMClient
+from .llm_scheduler import LLMUnavailableError, Priority
+from .model_router import Route
+from .speculation import Speculation
+from .text2sql import Text2SQLExecutor
+from .tracing import get_tracer
+from .vector_index import VectorRetriever
 from .types import ExecutionPlan, AnalysisTask, TaskTool
 
 
@@ -20,76 +29,467 @@ MOCK_DATA = {
 }
 
 
+def topological_waves(tasks: List[AnalysisTask]) -> List[List[AnalysisTask]]:
+    """
+    校验任务依赖并按拓扑层级分组
+    
+    Args:
+        tasks: 计划中的任务列表
+    
+    Returns:
+        分层后的任务列表，第 n 层任务只依赖前 n-1 层的任务
+    
+    Raises:
+        ValueError: 存在重复ID、缺失的依赖ID或循环依赖
+    """
+    by_id: Dict[int, AnalysisTask] = {}
+    for task in tasks:
+        if task.id in by_id:
+            raise ValueError(f"任务ID重复: {task.id}")
+        by_id[task.id] = task
+    
+    missing = sorted({
+        dep for task in tasks for dep in task.dependencies if dep not in by_id
+    })
+    if missing:
+        raise ValueError(f"依赖了不存在的任务ID: {missing}")
+    
+    # Kahn 算法，逐层剥离入度为 0 的任务
+    indegree = {task.id: len(set(task.dependencies)) for task in tasks}
+    children: Dict[int, List[int]] = {task.id: [] for task in tasks}
+    for task in tasks:
+        for dep in set(task.dependencies):
+            children[dep].append(task.id)
+    
+    waves: List[List[AnalysisTask]] = []
+    current = [task.id for task in tasks if indegree[task.id] == 0]
+    visited = 0
+    while current:
+        waves.append([by_id[task_id] for task_id in current])
+        visited += len(current)
+        following = []
+        for task_id in current:
+            for child in children[task_id]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    following.append(child)
+        current = following
+    
+    if visited != len(tasks):
+        cyclic = sorted(task_id for task_id, degree in indegree.items() if degree > 0)
+        raise ValueError(f"任务存在循环依赖: {cyclic}")
+    
+    return waves
+
+
 class ExecutionEngine:
-    """执行任务引擎"""
+    """
+    执行任务引擎
+    
+    引擎本身不保存任务结果，每次执行使用独立的 ExecutionContext，
+    因此同一个引擎可以在多个请求之间并发复用。
+    
+    Args:
+        client: LLM客户端
+        text2sql: 可选的Text2SQL执行器
+        retriever: 可选的RAG检索器
+        context_factory: 创建执行上下文的函数，默认按环境变量配置
+        packer: 合成上下文压缩器，默认按环境变量配置 token 预算
+    """
     
-    def __init__(self, client: LLMClient):
+    def __init__(
+        self,
+        client: LLMClient,
+        text2sql: Optional[Text2SQLExecutor] = None,
+        retriever: Optional[VectorRetriever] = None,
+        context_factory: Optional[Callable[[], ExecutionContext]] = None,
+        packer: Optional[ContextPacker] = None,
+    ):
         self.client = client
-        self.results_store: dict[int, Any] = {}
+        self.text2sql = text2sql
+        self.retriever = retriever
+        self.context_factory = context_factory or ExecutionContext.from_env
+        self.packer = packer or ContextPacker.from_env()
     
-    async def run(self, plan: ExecutionPlan) -> Optional[str]:
+    async def run(self, plan: ExecutionPlan, speculation: Optional[Speculation] = None) -> Optional[str]:
         """
-        执行计划中的所有任务
+        按依赖关系调度执行计划中的所有任务
+        
+        每个任务在其全部前置任务完成后立即启动，同一层级的任务并发执行。
+        依赖校验（重复ID、缺失ID、循环依赖）在执行任何任务之前完成。
         
         Args:
             plan: 执行计划
+            speculation: 可选的推测执行，匹配的任务直接采用预取结果
         
         Returns:
             最终合成结果，如果失败则返回None
+        
+        Raises:
+            ValueError: 计划的依赖关系不合法
         """
-        # 执行无依赖的独立任务
-        independent_tasks = [task for task in plan.tasks if len(task.dependencies) == 0]
-        
-        # 并行执行独立任务
-        import asyncio
-        await asyncio.gather(*[
-            self._execute_task(task) for task in independent_tasks
-        ])
-        
-        # 查找合成任务
-        synthesis_task = next(
-            (task for task in plan.tasks if task.tool == TaskTool.Final_Synthesis),
-            None
-        )
+        waves = topological_waves(plan.tasks)
+        synthesis_task = self._final_synthesis_task(waves)
         
         if not synthesis_task:
             return "规划中缺失合成节点"
         
-        return await self._synthesize(synthesis_task)
+        with self.context_factory() as context:
+            runners = self._spawn(waves, context, speculation=speculation)
+            try:
+                await asyncio.gather(*runners.values())
+            finally:
+                # 任一任务失败时取消其余仍在运行的任务
+                for runner in runners.values():
+                    runner.cancel()
+            
+            return runners[synthesis_task.id].result()
     
-    async def _execute_task(self, task: AnalysisTask):
-        """执行单个任务"""
-        if task.tool == TaskTool.Text2SQL:
-            result = await self._execute_text2sql(task.subQuery)
-            self.results_store[task.id] = result
-        elif task.tool == TaskTool.RAG:
-            result = await self._execute_rag(task.subQuery)
-            self.results_store[task.id] = result
+    async def run_stream(
+        self,
+        plan: ExecutionPlan,
+        speculation: Optional[Speculation] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        流式执行计划：每个工具任务完成时立即产出其结果，最终合成以token流产出
+        
+        Args:
+            plan: 执行计划
+            speculation: 可选的推测执行，匹配的任务直接采用预取结果
+        
+        有任务依赖最终合成节点时，合成结果必须先完整产出，此时合成按普通任务执行，不产出token流。
+        
+        Yields:
+            事件字典：{"event": "task", "data": {...}}、{"event": "token", "data": "..."}，
+            最后是 {"event": "answer", "data": 最终结果}
+        
+        Raises:
+            ValueError: 计划的依赖关系不合法
+        """
+        waves = topological_waves(plan.tasks)
+        synthesis_task = self._final_synthesis_task(waves)
+        
+        if not synthesis_task:
+            yield {"event": "answer", "data": "规划中缺失合成节点"}
+            return
+        
+        stream_answer = not self._has_dependents(plan.tasks, synthesis_task.id)
+        with self.context_factory() as context:
+            runners = self._spawn(
+                waves, context, exclude=synthesis_task.id if stream_answer else None, speculation=speculation,
+            )
+            by_id = {task.id: task for task in plan.tasks}
+            task_of = {runner: by_id[task_id] for task_id, runner in runners.items()}
+            
+            try:
+                pending = set(runners.values())
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for runner in done:
+                        task = task_of[runner]
+                        yield {
+                            "event": "task",
+                            "data": {"id": task.id, "tool": task.tool.value, "result": runner.result()}
+                        }
+            finally:
+                for runner in runners.values():
+                    runner.cancel()
+            
+            if not stream_answer:
+                yield {"event": "answer", "data": runners[synthesis_task.id].result()}
+                return
+            
+            parts = []
+            async for token in self._stream_synthesis(synthesis_task, context):
+                parts.append(token)
+                yield {"event": "token", "data": token}
+            
+            yield {"event": "answer", "data": "".join(parts)}
+    
+    async def run_incremental(
+        self,
+        planned: AsyncIterator[Tuple[str, Any]],
+        speculation: Optional[Speculation] = None,
+    ) -> Tuple[Optional[ExecutionPlan], Optional[str]]:
+        """
+        边规划边执行，返回 (执行计划, 最终合成结果)
+        
+        Args:
+            planned: 规划器的增量输出，见 AgentPlanner.stream_plan
+            speculation: 可选的推测执行，匹配的任务直接采用预取结果
+        
+        Returns:
+            规划失败时为 (None, None)
+        
+        Raises:
+            ValueError: 计划的依赖关系不合法
+        """
+        plan = answer = None
+        async for item in self._run_incremental(planned, speculation, stream_answer=False):
+            if item["event"] == "plan":
+                plan = item["data"]
+            elif item["event"] == "answer":
+                answer = item["data"]
+        return plan, answer
+    
+    def run_incremental_stream(
+        self,
+        planned: AsyncIterator[Tuple[str, Any]],
+        speculation: Optional[Speculation] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        边规划边执行的流式版本，最终合成以token流产出
+        
+        Yields:
+            {"event": "plan_task", "data": AnalysisTask}（任务到达）、
+            {"event": "plan", "data": ExecutionPlan 或 None}（计划结束），
+            其余事件同 run_stream
+        
+        Raises:
+            ValueError: 计划的依赖关系不合法
+        """
+        return self._run_incremental(planned, speculation, stream_answer=True)
+    
+    async def _run_incremental(
+        self,
+        planned: AsyncIterator[Tuple[str, Any]],
+        speculation: Optional[Speculation],
+        stream_answer: bool,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        增量调度：规划器每产出一个完整任务，只要其依赖的任务都已调度就立即启动
+        
+        依赖尚未到达的任务先暂存，依赖到达后再启动，因此调度顺序天然无环。
+        哪个合成任务是最终输出要等计划结束才能确定，合成任务统一在计划结束后调度；
+        计划结束时以完整计划为准做依赖校验，并补调度剩余任务。
+        """
+        with self.context_factory() as context:
+            events: asyncio.Queue = asyncio.Queue()
+            runners: Dict[int, asyncio.Task] = {}
+            arrived: set = set()
+            held: List[AnalysisTask] = []
+            
+            def spawn(task: AnalysisTask):
+                parents = [runners[dep] for dep in task.dependencies]
+                runner = asyncio.create_task(self._run_after(task, parents, context, speculation))
+                runner.add_done_callback(lambda _, task=task: events.put_nowait(("done", task)))
+                runners[task.id] = runner
+            
+            def spawn_ready():
+                # 启动一个任务可能使暂存的后继任务就绪，反复扫描直到没有新任务可启动
+                progressed = True
+                while progressed:
+                    progressed = False
+                    for task in list(held):
+                        if task.tool != TaskTool.Final_Synthesis and all(dep in runners for dep in task.dependencies):
+                            held.remove(task)
+                            spawn(task)
+                            progressed = True
+            
+            async def pump():
+                try:
+                    async for item in planned:
+                        events.put_nowait(item)
+                except Exception as e:
+                    events.put_nowait(("error", e))
+                events.put_nowait(("end", None))
+            
+            pump_task = asyncio.create_task(pump())
+            plan: Optional[ExecutionPlan] = None
+            synthesis_task: Optional[AnalysisTask] = None
+            planning = True
+            reported = 0
+            
+            try:
+                while planning or reported < len(runners):
+                    kind, item = await events.get()
+                    if kind == "task":
+                        if item.id in arrived:
+                            raise ValueError(f"任务ID重复: {item.id}")
+                        arrived.add(item.id)
+                        held.append(item)
+                        spawn_ready()
+                        yield {"event": "plan_task", "data": item}
+                    elif kind == "plan":
+                        plan = item
+                    elif kind == "error":
+                        raise item
+                    elif kind == "end":
+                        planning = False
+                        yield {"event": "plan", "data": plan}
+                        if plan is None:
+                            return
+                        
+                        waves = topological_waves(plan.tasks)
+                        synthesis_task = self._final_synthesis_task(waves)
+                        if not synthesis_task:
+                            yield {"event": "answer", "data": "规划中缺失合成节点"}
+                            return
+                        if self._has_dependents(plan.tasks, synthesis_task.id):
+                            # 后继任务需要完整的合成结果，合成按普通任务调度
+                            stream_answer = False
+                        for wave in waves:
+                            for task in wave:
+                                if task.id in runners or (stream_answer and task.id == synthesis_task.id):
+                                    continue
+                                spawn(task)
+                    elif kind == "done":
+                        reported += 1
+                        yield {
+                            "event": "task",
+                            "data": {"id": item.id, "tool": item.tool.value, "result": runners[item.id].result()}
+                        }
+            finally:
+                # 计划失败或任一任务失败时取消规划和其余仍在运行的任务
+                pump_task.cancel()
+                for runner in runners.values():
+                    runner.cancel()
+            
+            if not stream_answer:
+                yield {"event": "answer", "data": runners[synthesis_task.id].result()}
+                return
+            
+            parts = []
+            async for token in self._stream_synthesis(synthesis_task, context):
+                parts.append(token)
+                yield {"event": "token", "data": token}
+            
+            yield {"event": "answer", "data": "".join(parts)}
+    
+    @staticmethod
+    def _final_synthesis_task(waves: List[List[AnalysisTask]]) -> Optional[AnalysisTask]:
+        """查找合成任务（拓扑序中最后一个合成节点作为最终输出）"""
+        return next(
+            (task for wave in reversed(waves) for task in wave
+             if task.tool == TaskTool.Final_Synthesis),
+            None
+        )
+    
+    @staticmethod
+    def _has_dependents(tasks: List[AnalysisTask], task_id: int) -> bool:
+        """是否有任务依赖指定任务"""
+        return any(task_id in task.dependencies for task in tasks)
+    
+    def _spawn(
+        self,
+        waves: List[List[AnalysisTask]],
+        context: ExecutionContext,
+        exclude: Optional[int] = None,
+        speculation: Optional[Speculation] = None,
+    ) -> Dict[int, asyncio.Task]:
+        """按拓扑序创建协程任务，保证前置任务的句柄先于后继任务存在"""
+        runners: Dict[int, asyncio.Task] = {}
+        for wave in waves:
+            for task in wave:
+                if task.id == exclude:
+                    continue
+                parents = [runners[dep] for dep in task.dependencies]
+                runners[task.id] = asyncio.create_task(self._run_after(task, parents, context, speculation))
+        return runners
+    
+    async def _run_after(
+        self,
+        task: AnalysisTask,
+        parents: List[asyncio.Task],
+        context: ExecutionContext,
+        speculation: Optional[Speculation] = None,
+    ) -> Any:
+        """等待所有前置任务完成后执行该任务"""
+        if parents:
+            await asyncio.gather(*parents)
+        
+        if task.tool == TaskTool.Final_Synthesis:
+            result = await self._synthesize(task, context)
+            await context.aput(task.id, result)
+            return result
+        
+        await self._execute_task(task, context, speculation)
+        return await context.aget(task.id)
+    
+    async def _execute_task(
+        self,
+        task: AnalysisTask,
+        context: ExecutionContext,
+        speculation: Optional[Speculation] = None,
+    ):
+        """执行单个任务，工具失败时记录错误信息，由合成阶段说明数据缺失"""
+        with get_tracer().span("tool", task_id=task.id, tool=task.tool.value) as span:
+            try:
+                prefetched = speculation.take(task) if speculation is not None else None
+                span.set("speculated", prefetched is not None)
+                if prefetched is not None:
+                    await context.aput(task.id, await prefetched)
+                elif task.tool in (TaskTool.Text2SQL, TaskTool.RAG):
+                    await context.aput(task.id, await self.execute_tool(task.tool, task.subQuery))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"任务 {task.id} 执行失败: {e}")
+                span.record_error(e)
+                await context.aput(task.id, f"任务执行失败: {e}")
+    
+    async def execute_tool(self, tool: TaskTool, query: str) -> Any:
+        """执行一个工具调用（也供推测执行预取使用）"""
+        if tool == TaskTool.Text2SQL:
+            return await self._execute_text2sql(query)
+        if tool == TaskTool.RAG:
+            return await self._execute_rag(query)
+        raise ValueError(f"不支持的工具: {tool}")
     
     async def _execute_text2sql(self, query: str):
-        """模拟SQL执行"""
-        # 这里可以接入真实的数据库查询
-        return MOCK_DATA["SQL"]["result"]
+        """生成并执行SQL，未配置执行器时返回模拟数据"""
+        if self.text2sql is None:
+            return MOCK_DATA["SQL"]["result"]
+        return await self.text2sql.run(query)
     
     async def _execute_rag(self, query: str):
-        """模拟RAG检索"""
-        # 这里可以接入真实的RAG系统
-        return MOCK_DATA["RAG"]["result"]
+        """在本地向量索引中检索，未配置索引时返回模拟数据"""
+        if self.retriever is None:
+            return MOCK_DATA["RAG"]["result"]
+        return await self.retriever.retrieve(query)
     
-    async def _synthesize(self, task: AnalysisTask) -> Optional[str]:
+    async def _synthesize(self, task: AnalysisTask, context: ExecutionContext) -> Optional[str]:
         """
-        聚合所有任务结果并生成最终分析
+        聚合本次执行的所有任务结果并生成最终分析
         
         Args:
             task: 合成任务
+            context: 本次执行的上下文
         
         Returns:
             最终分析结果
         """
-        all_results = "\n".join([
-            f"任务 {task_id} 结果: {result}"
-            for task_id, result in self.results_store.items()
-        ])
+        with get_tracer().span("synthesis", task_id=task.id) as span:
+            prompt, system_prompt = self._synthesis_prompt(task, await context.aitems())
+            
+            try:
+                return await self.client.ask(prompt, system_prompt, priority=Priority.SYNTHESIS, route=Route.SYNTHESIS)
+            except LLMUnavailableError:
+                raise
+            except Exception as e:
+                print(f"合成失败: {e}")
+                span.record_error(e)
+                return None
+    
+    async def _stream_synthesis(self, task: AnalysisTask, context: ExecutionContext) -> AsyncIterator[str]:
+        """流式合成，逐个产出token（生成器中的 span 手动结束）"""
+        span = get_tracer().start_span("synthesis", task_id=task.id, streamed=True)
+        try:
+            prompt, system_prompt = self._synthesis_prompt(task, await context.aitems())
+            async for token in self.client.ask_stream(prompt, system_prompt, route=Route.SYNTHESIS):
+                yield token
+        except Exception as e:
+            span.end(e)
+            raise
+        finally:
+            span.end()
+    
+    def _synthesis_prompt(self, task: AnalysisTask, results: List[Tuple[int, Any]]) -> Tuple[str, str]:
+        """构建合成任务的提示词，返回 (prompt, system_prompt)；任务结果按 token 预算压缩"""
+        all_results = self.packer.pack(
+            task.description,
+            [(f"任务 {task_id} 结果", result) for task_id, result in results],
+        )
         
         prompt = f"""
 基于以下多源数据分析结果，回答用户问题: "{task.description}"
@@ -98,10 +498,4 @@ class ExecutionEngine:
 """
         
         system_prompt = "你是一个深度的业务逻辑分析师。请结合数据结果和文档背景，输出一份客观、详尽的分析报告。"
-        
-        try:
-            return await self.client.ask(prompt, system_prompt)
-        except Exception as e:
-            print(f"合成失败: {e}")
-            return None
-
+        return prompt, system_prompt
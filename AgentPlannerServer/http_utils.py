@@ -0,0 +1,28 @@
+"""
+接口层共用的 HTTP 辅助函数（main.py、main_rag.py、main_langgraph.py）
+"""
+import json
+import math
+from typing import Any
+
+from fastapi import HTTPException
+
+from .llm_scheduler import LLMUnavailableError
+
+
+def retry_after_header(seconds: float) -> str:
+    """Retry-After 头的取值：向上取整的秒数，至少为 1"""
+    return str(max(1, math.ceil(seconds)))
+
+
+def unavailable(error: LLMUnavailableError) -> HTTPException:
+    """LLM服务过载时返回 429/503，并通过 Retry-After 告知客户端何时重试"""
+    headers = {}
+    if error.retry_after is not None:
+        headers["Retry-After"] = retry_after_header(error.retry_after)
+    return HTTPException(status_code=error.status_code, detail=str(error), headers=headers)
+
+
+def sse(event: str, data: Any) -> str:
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
@@ -0,0 +1,610 @@
+"""
+异步任务队列 - /analyze 的作业模式
+
+POST /jobs 只把查询写入队列并立即返回任务ID，由后台固定数量的工作协程执行规划、执行、合成，
+客户端轮询 GET /jobs/{id}、订阅 SSE 或提供 webhook 接收结果，HTTP 连接不再贯穿整条流水线。
+
+- 存储：默认进程内存；设置 JOB_STORE_PATH 后使用 SQLite，进程重启后排队中的任务继续执行，
+  且多个服务进程（uvicorn --workers N）可共享同一个队列（领取任务是单条原子 UPDATE）
+- 背压：同时执行的任务数等于工作协程数，其余任务在队列中等待，不占用 HTTP 连接
+- 准入控制：排队数达到上限时拒绝新任务并给出建议的重试时间；
+  LLM服务过载（LLMUnavailableError）时任务重新排队并按建议时间延后，而不是直接失败
+- 租约：执行期间定期续约，进程崩溃或卡死导致租约过期的任务会被重新领取
+- webhook：只允许 http/https；设置 JOB_WEBHOOK_ALLOWED_HOSTS 时主机必须在白名单中，
+  否则拒绝解析到内网、回环、链路本地（含云元数据服务）等非公网地址的主机，防止服务端请求伪造
+"""
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Set
+from urllib.parse import urlsplit
+
+import httpx
+
+from .llm_scheduler import LLMUnavailableError
+
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+JobRunner = Callable[[str], Awaitable[Dict[str, Any]]]
+
+
+class QueueFullError(Exception):
+    """
+    排队任务数已达上限
+    
+    Args:
+        message: 错误信息
+        retry_after: 建议客户端等待的秒数
+    """
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _host_allowed(host: str, allowed_hosts: Sequence[str]) -> bool:
+    """白名单项为主机名，"*.example.com" 匹配其所有子域名"""
+    for pattern in allowed_hosts:
+        if pattern.startswith("*.") and host.endswith(pattern[1:]):
+            return True
+        if host == pattern:
+            return True
+    return False
+
+
+async def validate_webhook(url: str, allowed_hosts: Sequence[str] = ()):
+    """
+    检查 webhook 地址是否允许服务端访问
+    
+    Args:
+        url: webhook 地址
+        allowed_hosts: 主机白名单，为空时改为拒绝解析到非公网地址的主机
+    
+    Raises:
+        ValueError: 地址不允许访问
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("webhook 必须是 http 或 https 地址")
+    host = parts.hostname.lower().rstrip(".")
+    if allowed_hosts:
+        if not _host_allowed(host, allowed_hosts):
+            raise ValueError(f"webhook 主机 {host} 不在白名单中")
+        return
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, parts.port or 0, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as e:
+        raise ValueError(f"webhook 主机 {host} 无法解析: {e}") from e
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global:
+            raise ValueError(f"webhook 主机 {host} 解析到非公网地址 {address}")
+
+
+class Job:
+    """一个分析任务"""
+    __slots__ = (
+        "id", "query", "status", "result", "error", "webhook", "attempts",
+        "created_at", "started_at", "finished_at", "not_before",
+    )
+    
+    def __init__(
+        self,
+        id: str,
+        query: str,
+        status: str = QUEUED,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+        webhook: Optional[str] = None,
+        attempts: int = 0,
+        created_at: Optional[float] = None,
+        started_at: Optional[float] = None,
+        finished_at: Optional[float] = None,
+        not_before: float = 0.0,
+    ):
+        self.id = id
+        self.query = query
+        self.status = status
+        self.result = result
+        self.error = error
+        self.webhook = webhook
+        self.attempts = attempts
+        self.created_at = created_at if created_at is not None else time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.not_before = not_before
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """接口返回的任务状态"""
+        return {
+            "id": self.id,
+            "query": self.query,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "attempts": self.attempts,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+class MemoryJobStore:
+    """进程内存中的任务存储，完成的任务保留 result_ttl 秒"""
+    
+    def __init__(self, result_ttl: float = 86400.0):
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._queued: Deque[str] = deque()
+    
+    def put(self, job: Job):
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+            self._queued.append(job.id)
+    
+    def claim(self, lease: float) -> Optional[Job]:
+        """领取一个可执行的排队任务并标记为执行中（进程内存储无需租约）"""
+        now = time.time()
+        with self._lock:
+            for _ in range(len(self._queued)):
+                job = self._jobs.get(self._queued.popleft())
+                if job is None or job.status != QUEUED:
+                    continue
+                if job.not_before > now:
+                    self._queued.append(job.id)
+                    continue
+                job.status = RUNNING
+                job.started_at = now
+                job.attempts += 1
+                return job
+        return None
+    
+    def renew(self, job: Job, lease: float) -> bool:
+        """进程内存储的任务不会被其他进程领取，无需续约"""
+        return True
+    
+    def update(self, job: Job) -> bool:
+        with self._lock:
+            self._jobs[job.id] = job
+            if job.status == QUEUED:
+                self._queued.append(job.id)
+        return True
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+    
+    def counts(self) -> Dict[str, int]:
+        counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
+    
+    def close(self):
+        pass
+    
+    def _purge(self):
+        deadline = time.time() - self.result_ttl
+        for job_id in [job.id for job in self._jobs.values() if job.finished and job.finished_at < deadline]:
+            del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """
+    基于 SQLite 的任务存储，进程重启后任务不丢失，可被多个进程共享
+    
+    Args:
+        path: 数据库文件路径
+        result_ttl: 完成的任务保留时间（秒）
+    """
+    
+    _COLUMNS = (
+        "id, query, status, result, error, webhook, attempts, created_at, started_at, finished_at, not_before"
+    )
+    
+    def __init__(self, path: str, result_ttl: float = 86400.0):
+        self.path = path
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " query TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " result TEXT,"
+            " error TEXT,"
+            " webhook TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " not_before REAL NOT NULL DEFAULT 0,"
+            " lease_until REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.commit()
+    
+    def put(self, job: Job):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (SUCCEEDED, FAILED, time.time() - self.result_ttl),
+            )
+            self._conn.execute(
+                f"INSERT INTO jobs ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._row(job),
+            )
+            self._conn.commit()
+    
+    def claim(self, lease: float) -> Optional[Job]:
+        """原子地领取一个排队中（或租约已过期）的任务并标记为执行中"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"UPDATE jobs SET status = ?, started_at = ?, attempts = attempts + 1, lease_until = ?"
+                f" WHERE id = (SELECT id FROM jobs"
+                f"  WHERE (status = ? AND not_before <= ?) OR (status = ? AND lease_until < ?)"
+                f"  ORDER BY created_at LIMIT 1)"
+                f" RETURNING {self._COLUMNS}",
+                (RUNNING, now, now + lease, QUEUED, now, RUNNING, now),
+            ).fetchone()
+            self._conn.commit()
+        return self._job(row) if row else None
+    
+    def renew(self, job: Job, lease: float) -> bool:
+        """
+        延长执行中任务的租约
+        
+        Returns:
+            是否续约成功；任务已因租约过期被重新领取（执行次数已变化）时返回 False
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ? AND attempts = ?",
+                (time.time() + lease, job.id, RUNNING, job.attempts),
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+    
+    def update(self, job: Job) -> bool:
+        """
+        写回任务状态
+        
+        Returns:
+            是否写入成功；任务已因租约过期被其他工作协程重新领取（执行次数已变化）时不覆盖，返回 False
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?,"
+                " started_at = ?, finished_at = ?, not_before = ? WHERE id = ? AND attempts = ?",
+                (
+                    job.status, self._dump(job.result), job.error,
+                    job.started_at, job.finished_at, job.not_before, job.id, job.attempts,
+                ),
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+    
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._job(row) if row else None
+    
+    def counts(self) -> Dict[str, int]:
+        counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+        with self._lock:
+            for status, count in self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+                counts[status] = count
+        return counts
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    @staticmethod
+    def _dump(result: Optional[Dict[str, Any]]) -> Optional[str]:
+        return json.dumps(result, ensure_ascii=False, default=str) if result is not None else None
+    
+    def _row(self, job: Job) -> tuple:
+        return (
+            job.id, job.query, job.status, self._dump(job.result), job.error, job.webhook, job.attempts,
+            job.created_at, job.started_at, job.finished_at, job.not_before,
+        )
+    
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        (job_id, query, status, result, error, webhook, attempts,
+         created_at, started_at, finished_at, not_before) = row
+        return Job(
+            job_id, query, status, json.loads(result) if result else None, error, webhook, attempts,
+            created_at, started_at, finished_at, not_before,
+        )
+
+
+class JobQueue:
+    """
+    分析任务队列与工作协程池
+    
+    Args:
+        runner: 执行一个查询的协程函数，返回结果字典；结果中 success 为 False 时任务记为失败
+        store: 任务存储（MemoryJobStore 或 SQLiteJobStore）
+        workers: 工作协程数，即同时执行的任务上限
+        max_pending: 排队任务数上限，达到后拒绝新任务
+        max_attempts: LLM服务过载时的最大执行次数，用尽后任务失败
+        lease: 执行中任务的租约（秒），执行期间每隔三分之一租约续约一次，过期未续约的任务可被重新领取
+        poll_interval: 没有本进程新任务通知时检查存储的间隔（秒），用于多进程共享队列
+        webhook_hosts: webhook 主机白名单，为空时只允许解析到公网地址的主机
+    """
+    
+    def __init__(
+        self,
+        runner: JobRunner,
+        store: Optional[Any] = None,
+        workers: int = 4,
+        max_pending: int = 10000,
+        max_attempts: int = 5,
+        lease: float = 600.0,
+        poll_interval: float = 1.0,
+        webhook_hosts: Sequence[str] = (),
+    ):
+        self.runner = runner
+        self.store = store or MemoryJobStore()
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.webhook_hosts = [host.strip().lower() for host in webhook_hosts if host.strip()]
+        
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._waiters: Dict[str, asyncio.Event] = {}
+        self._webhooks: Set[asyncio.Task] = set()
+        self._http: Optional[httpx.AsyncClient] = None
+        
+        self.submitted = 0
+        self.rejected = 0
+        self.retried = 0
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0
+        self.run_seconds = 0.0
+    
+    @classmethod
+    def from_env(cls, runner: JobRunner) -> "JobQueue":
+        """根据环境变量创建任务队列，设置 JOB_STORE_PATH 时使用 SQLite 存储"""
+        result_ttl = float(os.getenv("JOB_RESULT_TTL", "86400"))
+        path = os.getenv("JOB_STORE_PATH")
+        store = SQLiteJobStore(path, result_ttl) if path else MemoryJobStore(result_ttl)
+        return cls(
+            runner,
+            store,
+            workers=int(os.getenv("JOB_WORKERS", "4")),
+            max_pending=int(os.getenv("JOB_MAX_PENDING", "10000")),
+            max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "5")),
+            lease=float(os.getenv("JOB_LEASE_SECONDS", "600")),
+            poll_interval=float(os.getenv("JOB_POLL_INTERVAL", "1.0")),
+            webhook_hosts=os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(","),
+        )
+    
+    def start(self):
+        """启动工作协程"""
+        # 不跟随重定向，避免通过重定向绕过 webhook 地址检查
+        self._http = httpx.AsyncClient(timeout=10.0, follow_redirects=False)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+    
+    async def aclose(self):
+        """停止工作协程；执行中的任务在 SQLite 存储中租约到期后会被重新执行"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._webhooks:
+            await asyncio.gather(*self._webhooks, return_exceptions=True)
+        if self._http is not None:
+            await self._http.aclose()
+        await asyncio.to_thread(self.store.close)
+    
+    async def submit(self, query: str, webhook: Optional[str] = None) -> Job:
+        """
+        提交一个分析任务
+        
+        Args:
+            query: 用户查询
+            webhook: 可选，任务结束后以 POST 方式推送任务状态的地址
+        
+        Returns:
+            排队中的任务
+        
+        Raises:
+            QueueFullError: 排队任务数已达上限
+            ValueError: webhook 地址不允许访问
+        """
+        if webhook:
+            await validate_webhook(webhook, self.webhook_hosts)
+        counts = await asyncio.to_thread(self.store.counts)
+        if counts[QUEUED] >= self.max_pending:
+            self.rejected += 1
+            raise QueueFullError(f"任务队列已满（{counts[QUEUED]} 个排队中）", self._estimate_wait(counts[QUEUED]))
+        
+        job = Job(uuid.uuid4().hex, query, webhook=webhook)
+        await asyncio.to_thread(self.store.put, job)
+        self.submitted += 1
+        self._wakeup.set()
+        return job
+    
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self.store.get, job_id)
+    
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """
+        等待任务状态变化（本进程执行的任务立即唤醒，其他进程执行的任务按轮询间隔检查）
+        
+        Returns:
+            最新的任务状态，任务不存在时返回 None
+        """
+        event = self._waiters.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), min(timeout, self.poll_interval))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._waiters.get(job_id) is event:
+                del self._waiters[job_id]
+        return await self.get(job_id)
+    
+    async def _work(self):
+        while True:
+            job = await asyncio.to_thread(self.store.claim, self.lease)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            self._notify(job)
+            await self._run(job)
+    
+    async def _heartbeat(self, job: Job, execution: asyncio.Future) -> bool:
+        """
+        执行期间每隔三分之一租约续约一次，只有进程崩溃或卡死的任务才会租约过期
+        
+        Returns:
+            续约失败（任务已被重新领取）时取消本次执行并返回 True
+        """
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await asyncio.to_thread(self.store.renew, job, self.lease)
+            except Exception as e:
+                print(f"任务 {job.id} 续约失败: {e}")
+                continue
+            if not renewed:
+                print(f"任务 {job.id} 续约失败: 已被重新领取，停止本次执行")
+                execution.cancel()
+                return True
+    
+    async def _run(self, job: Job):
+        started = time.monotonic()
+        execution = asyncio.ensure_future(self.runner(job.query))
+        heartbeat = asyncio.create_task(self._heartbeat(job, execution))
+        try:
+            job.result = await execution
+            if job.result.get("success", True):
+                job.status = SUCCEEDED
+                job.error = None
+                self.completed += 1
+            else:
+                # 执行函数正常返回但分析失败（如无法创建执行计划），保留结果供客户端查看
+                job.status = FAILED
+                job.error = job.result.get("message") or "执行失败"
+                self.failed += 1
+        except asyncio.CancelledError:
+            if heartbeat.done() and not heartbeat.cancelled() and heartbeat.result():
+                # 任务已归新的执行者所有：不写回状态，也不推送 webhook
+                self.lost += 1
+                return
+            # 服务关闭：任务放回队列，下次启动时继续
+            job.status = QUEUED
+            await asyncio.to_thread(self.store.update, job)
+            raise
+        except LLMUnavailableError as e:
+            if job.attempts < self.max_attempts:
+                # LLM服务过载时任务重新排队并延后，不占用工作协程等待
+                self.retried += 1
+                job.status = QUEUED
+                job.not_before = time.time() + (e.retry_after or 2.0 ** job.attempts)
+                job.error = str(e)
+            else:
+                job.status = FAILED
+                job.error = f"LLM服务不可用: {e}"
+                self.failed += 1
+        except Exception as e:
+            print(f"任务 {job.id} 执行失败: {e}")
+            job.status = FAILED
+            job.error = str(e)
+            self.failed += 1
+        finally:
+            heartbeat.cancel()
+        
+        self.run_seconds += time.monotonic() - started
+        if job.finished:
+            job.finished_at = time.time()
+        if not await asyncio.to_thread(self.store.update, job):
+            # 租约已过期、任务已被重新领取：结果以新的执行为准，不推送 webhook
+            print(f"任务 {job.id} 已被重新领取，丢弃本次执行结果")
+            self.lost += 1
+            return
+        self._notify(job)
+        if job.finished and job.webhook:
+            delivery = asyncio.create_task(self._deliver(job))
+            self._webhooks.add(delivery)
+            delivery.add_done_callback(self._webhooks.discard)
+    
+    def _notify(self, job: Job):
+        event = self._waiters.get(job.id)
+        if event is not None:
+            event.set()
+    
+    async def _deliver(self, job: Job):
+        """推送任务结果到 webhook，失败时重试 3 次；推送前重新检查地址（解析结果可能已变化），不跟随重定向"""
+        try:
+            await validate_webhook(job.webhook, self.webhook_hosts)
+        except ValueError as e:
+            print(f"任务 {job.id} webhook 推送失败: {e}")
+            return
+        for attempt in range(3):
+            try:
+                response = await self._http.post(job.webhook, json=job.to_dict())
+                response.raise_for_status()
+                return
+            except Exception as e:
+                print(f"任务 {job.id} webhook 推送失败: {e}")
+                await asyncio.sleep(2 ** attempt)
+    
+    def _estimate_wait(self, queued: int) -> float:
+        """按平均执行时间估算排队任务全部开始执行所需的秒数"""
+        finished = self.completed + self.failed
+        average = self.run_seconds / finished if finished else 10.0
+        return max(1.0, queued * average / max(1, self.workers))
+    
+    def stats(self) -> Dict[str, Any]:
+        """队列统计"""
+        counts = self.store.counts()
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "queued": counts[QUEUED],
+            "running": counts[RUNNING],
+            "succeeded": counts[SUCCEEDED],
+            "failed": counts[FAILED],
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "retried": self.retried,
+            "lost": self.lost,
+            "avg_run_seconds": self.run_seconds / finished if finished else 0.0,
+        }
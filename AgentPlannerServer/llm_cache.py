@@ -0,0 +1,321 @@
+"""
+LLM响应缓存 - 位于 LLMClient.ask 之前的两级缓存
+
+第一级为精确匹配：以 (model, system_prompt, prompt, temperature, is_json) 的哈希为键，
+内存中按 LRU + TTL 淘汰，并受内存预算约束，可选落盘到 SQLite 以便重启后继续命中。
+第二级为可选的语义相似度匹配：对 prompt 做向量化，在相同 (model, system_prompt,
+temperature, is_json) 范围内查找余弦相似度超过阈值的已缓存响应。
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+EmbedFn = Callable[[str], Awaitable[List[float]]]
+
+
+class CacheEntry:
+    """内存缓存条目"""
+    __slots__ = ("value", "size", "expires_at")
+    
+    def __init__(self, value: str, size: int, expires_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+class SQLiteCacheBackend:
+    """基于 SQLite 的磁盘缓存后端，进程重启后缓存依然有效"""
+    
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+    
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """读取未过期的缓存值，返回 (value, expires_at)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < time.time():
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return row[0], row[1]
+    
+    def set(self, key: str, value: str, expires_at: float):
+        """写入缓存值，超出条目上限时删除最早写入的条目"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, now),
+            )
+            self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+    
+    def clear(self):
+        """清空磁盘缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+    
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
+
+
+class _SemanticIndex:
+    """同一作用域内 prompt 向量的相似度索引"""
+    
+    def __init__(self):
+        self.keys: List[str] = []
+        self.vectors: List[List[float]] = []
+        self._matrix = None
+    
+    def add(self, key: str, vector: List[float]):
+        self.keys.append(key)
+        self.vectors.append(vector)
+        self._matrix = None
+    
+    def remove(self, key: str):
+        if key in self.keys:
+            index = self.keys.index(key)
+            del self.keys[index]
+            del self.vectors[index]
+            self._matrix = None
+    
+    def best_match(self, vector: List[float]) -> Tuple[Optional[str], float]:
+        """返回余弦相似度最高的键及其相似度（向量均已归一化）"""
+        if not self.keys:
+            return None, 0.0
+        if np is not None:
+            if self._matrix is None:
+                self._matrix = np.asarray(self.vectors, dtype=np.float32)
+            scores = self._matrix @ np.asarray(vector, dtype=np.float32)
+            index = int(np.argmax(scores))
+            return self.keys[index], float(scores[index])
+        best_key, best_score = None, -1.0
+        for key, candidate in zip(self.keys, self.vectors):
+            score = sum(a * b for a, b in zip(candidate, vector))
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class ResponseCache:
+    """
+    LLM响应缓存
+    
+    Args:
+        max_entries: 内存中最多缓存的条目数
+        max_bytes: 内存缓存的字节预算
+        ttl: 条目存活时间（秒）
+        backend: 可选的磁盘后端
+        embed_fn: 可选的向量化函数，提供后启用语义相似度缓存
+        similarity_threshold: 语义命中所需的最低余弦相似度
+    """
+    
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600,
+        backend: Optional[SQLiteCacheBackend] = None,
+        embed_fn: Optional[EmbedFn] = None,
+        similarity_threshold: float = 0.95,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._semantic: Dict[str, _SemanticIndex] = {}
+        self._semantic_scope_of: Dict[str, str] = {}
+        
+        self.hits = 0
+        self.semantic_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        """
+        根据环境变量创建缓存，LLM_CACHE_ENABLED=0 时返回None
+        
+        语义缓存需要额外传入 embed_fn，此处只读取相似度阈值
+        """
+        if os.getenv("LLM_CACHE_ENABLED", "1") == "0":
+            return None
+        path = os.getenv("LLM_CACHE_PATH")
+        return cls(
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl=float(os.getenv("LLM_CACHE_TTL", "3600")),
+            backend=SQLiteCacheBackend(path) if path else None,
+            similarity_threshold=float(os.getenv("LLM_CACHE_SIMILARITY", "0.95")),
+        )
+    
+    @staticmethod
+    def make_key(model: str, system_prompt: Optional[str], prompt: str, temperature: float, is_json: bool) -> str:
+        """精确匹配的缓存键"""
+        payload = json.dumps(
+            [model, system_prompt or "", prompt, temperature, is_json],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def make_scope(model: str, system_prompt: Optional[str], temperature: float, is_json: bool) -> str:
+        """语义匹配的作用域，只有作用域相同的 prompt 才会相互命中"""
+        return ResponseCache.make_key(model, system_prompt, "", temperature, is_json)
+    
+    async def get(self, key: str, scope: Optional[str] = None, prompt: Optional[str] = None) -> Optional[str]:
+        """
+        查询缓存
+        
+        Args:
+            key: 精确匹配键
+            scope: 语义匹配作用域（可选）
+            prompt: 用于语义匹配的原始 prompt（可选）
+        
+        Returns:
+            命中的响应文本，未命中返回None
+        """
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        
+        if self.backend is not None:
+            row = await asyncio.to_thread(self.backend.get, key)
+            if row is not None:
+                self._set_memory(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+        
+        if self.embed_fn is not None and scope is not None and prompt is not None:
+            index = self._semantic.get(scope)
+            if index is not None and index.keys:
+                vector = _normalize(await self.embed_fn(prompt))
+                match_key, score = index.best_match(vector)
+                if match_key is not None and score >= self.similarity_threshold:
+                    value = self._get_memory(match_key)
+                    if value is not None:
+                        self.semantic_hits += 1
+                        return value
+        
+        self.misses += 1
+        return None
+    
+    async def set(self, key: str, value: str, scope: Optional[str] = None, prompt: Optional[str] = None):
+        """写入缓存，提供 scope 和 prompt 时同时写入语义索引"""
+        expires_at = time.time() + self.ttl
+        self._set_memory(key, value, expires_at)
+        
+        if self.backend is not None:
+            await asyncio.to_thread(self.backend.set, key, value, expires_at)
+        
+        if self.embed_fn is not None and scope is not None and prompt is not None:
+            if key not in self._semantic_scope_of and key in self._entries:
+                vector = _normalize(await self.embed_fn(prompt))
+                self._semantic.setdefault(scope, _SemanticIndex()).add(key, vector)
+                self._semantic_scope_of[key] = scope
+    
+    def stats(self) -> Dict[str, float]:
+        """缓存命中统计"""
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+    
+    def clear(self):
+        """清空内存和磁盘缓存"""
+        self._entries.clear()
+        self._bytes = 0
+        self._semantic.clear()
+        self._semantic_scope_of.clear()
+        if self.backend is not None:
+            self.backend.clear()
+    
+    def close(self):
+        """关闭磁盘后端"""
+        if self.backend is not None:
+            self.backend.close()
+    
+    def _get_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < time.time():
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+    
+    def _set_memory(self, key: str, value: str, expires_at: float):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = CacheEntry(value, size, expires_at)
+        self._bytes += size
+        # 按 LRU 顺序淘汰，直到满足条目数和字节预算
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+    
+    def _evict(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        scope = self._semantic_scope_of.pop(key, None)
+        if scope is not None:
+            self._semantic[scope].remove(key)
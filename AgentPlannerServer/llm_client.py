@@ -1,20 +1,123 @@
 from openai import AsyncOpenAI
+from typing import AsyncIterator, List, Optional
+import httpx
 import os
+import time
+
+from .context_packer import count_tokens
+from .llm_cache import ResponseCache
+from .llm_scheduler import LLMScheduler, Priority
+from .model_router import ModelRouter, Route, get_router
+from .singleflight import SingleFlight
+from .tracing import get_tracer
+
+
+def _http2_available() -> bool:
+    """检查是否安装了 HTTP/2 依赖（h2）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
 
 
 class LLMClient:
-    """LLM对话客户端"""
+    """
+    LLM对话客户端
+    
+    内部持有一个带连接池的 httpx.AsyncClient，设计为进程级共享：
+    由应用生命周期创建一次，所有请求的规划、执行、合成调用复用同一连接池，
+    避免每次请求重新握手。使用完毕后需调用 aclose() 释放连接。
+    
+    每次调用按调用点（route）由模型路由器选择模型，默认使用进程级共享的路由器。
+    """
     
-    def __init__(self):
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        http2: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        cache: Optional[ResponseCache] = None,
+        scheduler: Optional[LLMScheduler] = None,
+        router: Optional[ModelRouter] = None,
+    ):
         api_key = os.getenv("OPENAI_API_KEY", "")
         base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
         
+        if max_connections is None:
+            max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+        if max_keepalive_connections is None:
+            max_keepalive_connections = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+        if http2 is None:
+            http2 = os.getenv("LLM_HTTP2", "1") != "0"
+        if timeout is None:
+            timeout = float(os.getenv("LLM_TIMEOUT", "60"))
+        
+        # 未安装 h2 时自动回退到 HTTP/1.1
+        self.http2 = http2 and _http2_available()
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+            ),
+            http2=self.http2,
+            timeout=timeout,
+        )
+        
         self.sdk = AsyncOpenAI(
             api_key=api_key,
             base_url=base_url,
+            http_client=self.http_client,
+            # 重试由调度器统一负责（退避、Retry-After、并发自适应）
+            max_retries=0,
         )
+        
+        # 按调用点选择模型；model 为未配置路由时使用的默认模型
+        self.router = router or get_router()
+        self.model = self.router.default_model
+        self.temperature = 0.2
+        self.embedding_model = os.getenv("LLM_EMBEDDING_MODEL", "text-embedding-3-small")
+        
+        # 响应缓存（可选），LLM_CACHE_SEMANTIC=1 时使用 embed() 启用语义缓存
+        self.cache = cache
+        if cache is not None and cache.embed_fn is None and os.getenv("LLM_CACHE_SEMANTIC") == "1":
+            cache.embed_fn = self.embed
+        
+        # 相同参数的并发请求合并为一次调用
+        self.inflight = SingleFlight()
+        # 并发限制、速率限制与重试
+        self.scheduler = scheduler or LLMScheduler.from_env()
+        # 预估 token 用量时为模型输出预留的 token 数
+        self.expected_output_tokens = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "512"))
+    
+    async def aclose(self):
+        """关闭底层连接池和缓存后端"""
+        await self.http_client.aclose()
+        if self.cache is not None:
+            self.cache.close()
+    
+    async def embed(self, text: str) -> List[float]:
+        """获取文本的向量表示"""
+        return (await self.embed_many([text]))[0]
     
-    async def ask(self, prompt: str, system_prompt: str = None, is_json: bool = False) -> str:
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """批量获取文本的向量表示"""
+        result = await self.scheduler.run(
+            lambda: self.sdk.embeddings.create(model=self.embedding_model, input=texts),
+            Priority.DEFAULT,
+            sum(count_tokens(text) for text in texts),
+        )
+        return [item.embedding for item in sorted(result.data, key=lambda item: item.index)]
+    
+    async def ask(
+        self,
+        prompt: str,
+        system_prompt: str = None,
+        is_json: bool = False,
+        priority: int = Priority.DEFAULT,
+        route: str = Route.DEFAULT,
+    ) -> str:
         """
         向LLM发送请求
         
@@ -22,24 +125,217 @@ class LLMClient:
             prompt: 用户提示
             system_prompt: 系统提示（可选）
             is_json: 是否要求返回JSON格式
+            priority: 调度优先级（Priority.SYNTHESIS / TOOL / PLANNER）
+            route: 调用点（Route.PLANNER / TEXT2SQL / SYNTHESIS 等），决定使用的模型
         
         Returns:
             LLM的响应文本
+        
+        Raises:
+            LLMUnavailableError: 重试用尽或排队超时
         """
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-        
-        params = {
-            "model": "gpt-3.5-turbo",
-            "messages": messages,
-            "temperature": 0.2,
-        }
-        
-        if is_json:
-            params["response_format"] = {"type": "json_object"}
-        
-        result = await self.sdk.chat.completions.create(**params)
-        return result.choices[0].message.content or ""
-
+        model = self.router.select(route, self._prompt_tokens(prompt, system_prompt))
+        cache_key = ResponseCache.make_key(model, system_prompt, prompt, self.temperature, is_json)
+        return await self.inflight.do(
+            cache_key,
+            lambda: self._ask(prompt, system_prompt, is_json, cache_key, priority, route, model),
+        )
+    
+    def _prompt_tokens(self, prompt: str, system_prompt: Optional[str]) -> int:
+        return count_tokens(prompt) + count_tokens(system_prompt or "")
+    
+    def _estimate_tokens(self, prompt: str, system_prompt: Optional[str]) -> int:
+        return self._prompt_tokens(prompt, system_prompt) + self.expected_output_tokens
+    
+    async def _ask(
+        self,
+        prompt: str,
+        system_prompt: Optional[str],
+        is_json: bool,
+        cache_key: str,
+        priority: int,
+        route: str,
+        model: str,
+    ) -> str:
+        """实际的请求逻辑：先查缓存，未命中时调用LLM并写入缓存"""
+        tracer = get_tracer()
+        with tracer.span(
+            "llm", priority=Priority.NAMES.get(priority, str(priority)), json=is_json, route=route, model=model,
+        ) as span:
+            scope = None
+            if self.cache is not None:
+                scope = ResponseCache.make_scope(model, system_prompt, self.temperature, is_json)
+                cached = await self.cache.get(cache_key, scope, prompt)
+                span.set("cache_hit", cached is not None)
+                tracer.count("cache_hits_total" if cached is not None else "cache_misses_total", cache="llm")
+                if cached is not None:
+                    return cached
+            
+            messages = []
+            if system_prompt:
+                messages.append({"role": "system", "content": system_prompt})
+            messages.append({"role": "user", "content": prompt})
+            
+            params = {
+                "model": model,
+                "messages": messages,
+                "temperature": self.temperature,
+            }
+            
+            if is_json:
+                params["response_format"] = {"type": "json_object"}
+            
+            estimated = self._estimate_tokens(prompt, system_prompt)
+            started = time.perf_counter()
+            try:
+                result = await self.scheduler.run(
+                    lambda: self.sdk.chat.completions.create(**params),
+                    priority,
+                    estimated,
+                )
+            except Exception:
+                self._record_route(route, model, time.perf_counter() - started, error=True)
+                raise
+            prompt_tokens = completion_tokens = 0
+            if getattr(result, "usage", None) is not None:
+                self.scheduler.record_usage(estimated, result.usage.total_tokens)
+                prompt_tokens, completion_tokens = result.usage.prompt_tokens, result.usage.completion_tokens
+                self._record_tokens(span, prompt_tokens, completion_tokens)
+            self._record_route(route, model, time.perf_counter() - started, prompt_tokens, completion_tokens)
+            content = result.choices[0].message.content or ""
+            
+            if self.cache is not None and content:
+                await self.cache.set(cache_key, content, scope, prompt)
+            return content
+    
+    def _record_tokens(self, span, prompt_tokens: int, completion_tokens: int):
+        span.set("prompt_tokens", prompt_tokens)
+        span.set("completion_tokens", completion_tokens)
+        tracer = get_tracer()
+        tracer.count("llm_tokens_total", prompt_tokens, kind="prompt")
+        tracer.count("llm_tokens_total", completion_tokens, kind="completion")
+    
+    def _record_route(
+        self,
+        route: str,
+        model: str,
+        latency: float,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        error: bool = False,
+    ):
+        self.router.record(route, model, latency, prompt_tokens, completion_tokens, error)
+        get_tracer().count("llm_route_calls_total", route=route, model=model)
+    
+    async def ask_stream(
+        self,
+        prompt: str,
+        system_prompt: str = None,
+        priority: int = Priority.SYNTHESIS,
+        is_json: bool = False,
+        route: str = Route.SYNTHESIS,
+    ) -> AsyncIterator[str]:
+        """
+        以流式方式向LLM发送请求，逐段产出响应文本
+        
+        缓存命中时一次性产出完整响应；流结束后把完整响应写入缓存。
+        调度器只对建立流的请求做限流和重试，开始产出内容后不再重试；并发槽位占用到流结束。
+        相同参数的并发流式请求共享同一个流，后加入的调用者从头收到全部片段。
+        
+        Args:
+            prompt: 用户提示
+            system_prompt: 系统提示（可选）
+            priority: 调度优先级，默认按合成调用处理
+            is_json: 是否要求返回JSON格式（如规划器边生成边解析计划）
+            route: 调用点，决定使用的模型，默认按合成调用处理；路由延迟按首个 token 的时间记录
+        
+        Yields:
+            响应文本片段
+        """
+        model = self.router.select(route, self._prompt_tokens(prompt, system_prompt))
+        cache_key = ResponseCache.make_key(model, system_prompt, prompt, self.temperature, is_json)
+        async for chunk in self.inflight.stream(
+            cache_key,
+            lambda: self._ask_stream(prompt, system_prompt, is_json, cache_key, priority, route, model),
+        ):
+            yield chunk
+    
+    async def _ask_stream(
+        self,
+        prompt: str,
+        system_prompt: Optional[str],
+        is_json: bool,
+        cache_key: str,
+        priority: int,
+        route: str,
+        model: str,
+    ) -> AsyncIterator[str]:
+        """实际的流式请求逻辑：先查缓存，未命中时建立流并在结束后写入缓存"""
+        tracer = get_tracer()
+        # 生成器中的 span 手动结束，不改变调用方的当前 span
+        span = tracer.start_span(
+            "llm.stream", priority=Priority.NAMES.get(priority, str(priority)), json=is_json, route=route, model=model,
+        )
+        started = ttft = None
+        try:
+            scope = None
+            if self.cache is not None:
+                scope = ResponseCache.make_scope(model, system_prompt, self.temperature, is_json)
+                cached = await self.cache.get(cache_key, scope, prompt)
+                span.set("cache_hit", cached is not None)
+                tracer.count("cache_hits_total" if cached is not None else "cache_misses_total", cache="llm")
+                if cached is not None:
+                    yield cached
+                    return
+            
+            messages = []
+            if system_prompt:
+                messages.append({"role": "system", "content": system_prompt})
+            messages.append({"role": "user", "content": prompt})
+            
+            params = {
+                "model": model,
+                "messages": messages,
+                "temperature": self.temperature,
+                "stream": True,
+            }
+            
+            if is_json:
+                params["response_format"] = {"type": "json_object"}
+            
+            started = time.perf_counter()
+            parts = []
+            # 并发槽位占用到流读完或被关闭，长时间的流式合成同样计入并发上限
+            async with self.scheduler.stream(
+                lambda: self.sdk.chat.completions.create(**params),
+                priority,
+                self._estimate_tokens(prompt, system_prompt),
+            ) as stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            ttft = time.perf_counter() - started
+                            span.set("ttft_ms", round(span.duration * 1000, 2))
+                        parts.append(delta)
+                        yield delta
+            
+            content = "".join(parts)
+            # 流式响应不返回 usage，按文本估算 token 数
+            prompt_tokens, completion_tokens = self._prompt_tokens(prompt, system_prompt), count_tokens(content)
+            self._record_tokens(span, prompt_tokens, completion_tokens)
+            self._record_route(
+                route, model, ttft if ttft is not None else time.perf_counter() - started,
+                prompt_tokens, completion_tokens,
+            )
+            if self.cache is not None and content:
+                await self.cache.set(cache_key, content, scope, prompt)
+        except Exception as e:
+            if started is not None:
+                self._record_route(route, model, time.perf_counter() - started, error=True)
+            span.end(e)
+            raise
+        finally:
+            span.end()
@@ -0,0 +1,430 @@
+"""
+LLM调用调度器 - 自适应并发限制、速率限制与退避重试
+
+所有经过 LLMClient 的调用先按优先级排队获取并发槽位，再从每分钟请求数和
+每分钟 token 数两个令牌桶中取得配额，然后才真正发出请求：
+- 并发上限按 AIMD 调整：成功时缓慢加性增长，遇到 429/5xx/超时时乘性减半，
+  把并发压在服务商能够承受的水平，饱和时保持有效吞吐而不是放大失败
+- 可重试错误按带抖动的指数退避重试，服务商返回 Retry-After 时至少等待该时长
+- 优先级通道：合成调用优先于工具调用，工具调用优先于规划调用，
+  保证已经进行到最后一步的请求先完成（新的合成调用只能由已完成规划的请求产生，
+  因此规划调用不会被无限饿死）
+重试用尽或排队超时时抛出 LLMUnavailableError，由接口层转换为 429/503。
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import httpx
+
+try:
+    import openai
+except ImportError:
+    openai = None
+
+
+T = TypeVar("T")
+
+
+class Priority:
+    """优先级通道，数值越小越优先"""
+    SYNTHESIS = 0
+    TOOL = 1
+    DEFAULT = 1
+    PLANNER = 2
+    
+    NAMES = {0: "synthesis", 1: "tool", 2: "planner"}
+
+
+class LLMUnavailableError(Exception):
+    """
+    LLM服务暂不可用（重试用尽或排队超时）
+    
+    Args:
+        message: 错误信息
+        status_code: 建议返回给客户端的状态码（429 或 503）
+        retry_after: 建议客户端等待的秒数
+    """
+    
+    def __init__(self, message: str, status_code: int = 503, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    令牌桶，按分钟速率连续补充
+    
+    Args:
+        per_minute: 每分钟补充的令牌数，0 表示不限制（pause 仍然生效）
+    """
+    
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        # 服务商要求的等待截止时间，在此之前不发放令牌
+        self._not_before = 0.0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+    
+    async def acquire(self, amount: float = 1):
+        """取得 amount 个令牌，暂停期间等待暂停结束，令牌不足时等待补充（超过桶容量的请求按容量计）"""
+        while self._not_before > time.monotonic():
+            await asyncio.sleep(self._not_before - time.monotonic())
+        if self.per_minute <= 0:
+            return
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) * 60 / self.per_minute)
+                self._refill()
+            self.tokens -= amount
+    
+    def adjust(self, delta: float):
+        """按实际用量修正：delta 为正时额外扣除，为负时归还"""
+        if self.per_minute <= 0:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+    
+    def pause(self, seconds: float):
+        """服务商要求等待时暂停发放令牌，使后续请求至少等待 seconds 秒（不限速时同样生效）"""
+        self._not_before = max(self._not_before, time.monotonic() + seconds)
+        if self.per_minute <= 0:
+            return
+        # 暂停结束后不允许积攒的令牌一次性突发
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class AdaptiveLimiter:
+    """
+    带优先级队列的 AIMD 自适应并发限制
+    
+    Args:
+        initial: 初始并发上限
+        min_limit: 并发上限的下限
+        max_limit: 并发上限的上限
+        backoff_ratio: 过载时并发上限的缩减比例
+    """
+    
+    def __init__(self, initial: int = 16, min_limit: int = 2, max_limit: int = 64, backoff_ratio: float = 0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_use = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._last_decrease = 0.0
+    
+    async def acquire(self, priority: int = Priority.DEFAULT):
+        """获取一个并发槽位，按 (优先级, 到达顺序) 排队"""
+        if self.in_use < int(self.limit) and not self._waiters:
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到槽位但调用方被取消，归还槽位
+                self.release()
+            else:
+                self._waiters = [w for w in self._waiters if w[2] is not future]
+                heapq.heapify(self._waiters)
+            raise
+    
+    def release(self, outcome: Optional[str] = None):
+        """
+        归还槽位并按结果调整并发上限
+        
+        Args:
+            outcome: "success" 加性增长，"overload" 乘性缩减，None 不调整
+        """
+        self.in_use -= 1
+        if outcome == "success":
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        elif outcome == "overload":
+            now = time.monotonic()
+            # 同一轮并发中的多个失败只缩减一次
+            if now - self._last_decrease > 1.0:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self._last_decrease = now
+        self._wake()
+    
+    def waiting(self) -> Dict[str, int]:
+        """各优先级通道的排队数量"""
+        counts: Dict[str, int] = {}
+        for priority, _, _ in self._waiters:
+            name = Priority.NAMES.get(priority, str(priority))
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+    
+    def _wake(self):
+        while self._waiters and self.in_use < int(self.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.in_use += 1
+            future.set_result(None)
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) or getattr(error, "status_code", None)
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """解析错误响应中的 Retry-After / retry-after-ms 头"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """429、5xx、超时和连接错误可以重试"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if openai is not None and isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = _status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+class LLMScheduler:
+    """
+    LLM调用调度器
+    
+    Args:
+        limiter: 自适应并发限制
+        rpm: 每分钟请求数上限，0 表示不限制
+        tpm: 每分钟 token 数上限，0 表示不限制
+        max_retries: 最多重试次数
+        base_delay: 退避的基础时长（秒）
+        max_delay: 单次退避的最长时长（秒）
+        queue_timeout: 等待并发槽位和速率配额的最长时间（秒）
+    """
+    
+    def __init__(
+        self,
+        limiter: Optional[AdaptiveLimiter] = None,
+        rpm: float = 0,
+        tpm: float = 0,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        queue_timeout: float = 30.0,
+    ):
+        self.limiter = limiter or AdaptiveLimiter()
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue_timeout = queue_timeout
+        
+        self.successes = 0
+        self.retries = 0
+        self.throttled = 0
+        self.rejected = 0
+    
+    @classmethod
+    def from_env(cls) -> "LLMScheduler":
+        """根据环境变量创建调度器"""
+        return cls(
+            limiter=AdaptiveLimiter(
+                initial=int(os.getenv("LLM_INITIAL_CONCURRENCY", "16")),
+                min_limit=int(os.getenv("LLM_MIN_CONCURRENCY", "2")),
+                max_limit=int(os.getenv("LLM_MAX_CONCURRENCY", "64")),
+            ),
+            rpm=float(os.getenv("LLM_RPM", "0")),
+            tpm=float(os.getenv("LLM_TPM", "0")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+            base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "20")),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "30")),
+        )
+    
+    async def run(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        priority: int = Priority.DEFAULT,
+        estimated_tokens: int = 0,
+    ) -> T:
+        """
+        在调度下执行一次LLM调用，可重试错误按退避策略重试
+        
+        Args:
+            fn: 发起调用的无参协程函数（每次重试都会重新调用）
+            priority: 优先级通道
+            estimated_tokens: 预估的 token 用量，用于 tpm 限速
+        
+        Returns:
+            fn 的结果
+        
+        Raises:
+            LLMUnavailableError: 重试用尽或排队超时
+        """
+        return await self._call(fn, priority, estimated_tokens, hold=False)
+    
+    @asynccontextmanager
+    async def stream(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        priority: int = Priority.DEFAULT,
+        estimated_tokens: int = 0,
+    ) -> AsyncIterator[T]:
+        """
+        在调度下建立一次流式调用，并发槽位一直占用到流被读完或关闭
+        
+        只有建立流的请求按退避策略重试；读取过程中出现的可重试错误按过载调整并发上限。
+        退出时（包括调用方提前停止读取）关闭流（若有 close 方法），释放底层 HTTP 连接。
+        
+        Args:
+            fn: 建立流的无参协程函数（每次重试都会重新调用）
+            priority: 优先级通道
+            estimated_tokens: 预估的 token 用量，用于 tpm 限速
+        
+        Yields:
+            fn 返回的流
+        
+        Raises:
+            LLMUnavailableError: 重试用尽或排队超时
+        """
+        result = await self._call(fn, priority, estimated_tokens, hold=True)
+        outcome = None
+        try:
+            yield result
+            outcome = "success"
+        except Exception as e:
+            if is_retryable(e):
+                outcome = "overload"
+            raise
+        finally:
+            try:
+                close = getattr(result, "close", None)
+                if close is not None:
+                    await close()
+            finally:
+                self.limiter.release(outcome)
+    
+    async def _call(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        priority: int,
+        estimated_tokens: int,
+        hold: bool,
+    ) -> T:
+        """执行调用并按退避策略重试；hold 为 True 时成功后不归还槽位，由调用方归还"""
+        attempt = 0
+        while True:
+            await self._admit(priority, estimated_tokens)
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    self.limiter.release()
+                    raise
+                status = _status_code(e)
+                retry_after = retry_after_seconds(e)
+                self.limiter.release("overload")
+                if status == 429:
+                    self.throttled += 1
+                    if retry_after:
+                        self.requests.pause(retry_after)
+                if attempt == self.max_retries:
+                    self.rejected += 1
+                    raise LLMUnavailableError(
+                        f"LLM服务暂不可用，已重试 {attempt} 次: {e}",
+                        status_code=429 if status == 429 else 503,
+                        retry_after=retry_after or self.max_delay,
+                    ) from e
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+                attempt += 1
+                continue
+            except BaseException:
+                self.limiter.release()
+                raise
+            if not hold:
+                self.limiter.release("success")
+            self.successes += 1
+            return result
+    
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """用实际 token 用量修正 tpm 令牌桶"""
+        self.tokens.adjust(actual_tokens - estimated_tokens)
+    
+    def stats(self) -> Dict[str, Any]:
+        """调度统计"""
+        return {
+            "limit": round(self.limiter.limit, 2),
+            "in_use": self.limiter.in_use,
+            "waiting": self.limiter.waiting(),
+            "successes": self.successes,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
+    
+    async def _admit(self, priority: int, estimated_tokens: int):
+        """获取并发槽位和速率配额，超过 queue_timeout 时拒绝"""
+        try:
+            await asyncio.wait_for(self.limiter.acquire(priority), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise LLMUnavailableError("LLM调用排队超时", status_code=503, retry_after=self.base_delay * 4)
+        try:
+            await asyncio.wait_for(self._take_quota(estimated_tokens), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.limiter.release()
+            self.rejected += 1
+            raise LLMUnavailableError("LLM调用超出速率限制", status_code=429, retry_after=self.base_delay * 4)
+        except BaseException:
+            self.limiter.release()
+            raise
+    
+    async def _take_quota(self, estimated_tokens: int):
+        await self.requests.acquire(1)
+        if estimated_tokens:
+            await self.tokens.acquire(estimated_tokens)
+    
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """带完全抖动的指数退避，至少等待服务商要求的时长"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
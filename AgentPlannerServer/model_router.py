@@ -0,0 +1,298 @@
+"""
+模型路由 - 按调用点（规划、Text2SQL、合成等）选择模型
+
+规划输出短小且结构化，适合便宜快速的模型；长篇合成才需要更强的模型。
+每个调用点是一条路由，路由配置来自 JSON 文件（LLM_ROUTES_FILE），例如：
+    
+    {
+      "default": "gpt-4o-mini",
+      "routes": {
+        "planner": {"model": "gpt-4o-mini"},
+        "synthesis": {
+          "model": "gpt-4o",
+          "rules": [{"max_prompt_tokens": 1000, "model": "gpt-4o-mini"}],
+          "slo_ms": 8000,
+          "fallback": "gpt-4o-mini"
+        }
+      }
+    }
+
+选择顺序：
+1. 路由的 rules 按顺序匹配提示词 token 数（min_prompt_tokens / max_prompt_tokens），
+   第一条匹配的规则决定模型，都不匹配时使用路由的 model
+2. 配置了 slo_ms 和 fallback 时，若所选模型在该路由上最近一个时间窗口内的
+   延迟分位数已达到 SLO（失败的调用按达到 SLO 计），本次改用 fallback 模型；降级期间原模型没有新样本，
+   窗口过期后自动恢复
+未配置的路由使用 default 模型。延迟指首个 token 的时间（非流式调用为完整响应时间）。
+"""
+import json
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+
+class Route:
+    """调用点"""
+    PLANNER = "planner"
+    TEXT2SQL = "text2sql"
+    SYNTHESIS = "synthesis"
+    DEFAULT = "default"
+
+
+class RouteConfig:
+    """
+    一条路由的配置
+    
+    Args:
+        name: 路由名称
+        model: 默认模型
+        rules: 按提示词 token 数选择模型的规则列表
+        slo_ms: 延迟 SLO（毫秒），为空表示不做降级
+        fallback: SLO 有风险时改用的模型
+    """
+    
+    __slots__ = ("name", "model", "rules", "slo_ms", "fallback")
+    
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        rules: Optional[List[Dict[str, Any]]] = None,
+        slo_ms: Optional[float] = None,
+        fallback: Optional[str] = None,
+    ):
+        self.name = name
+        self.model = model
+        self.rules = rules or []
+        self.slo_ms = slo_ms
+        self.fallback = fallback
+    
+    @classmethod
+    def from_dict(cls, name: str, data: Dict[str, Any], default_model: str) -> "RouteConfig":
+        """从配置文件中的一项创建，缺少 model 的规则会被忽略"""
+        rules = [rule for rule in data.get("rules", []) if rule.get("model")]
+        slo_ms = data.get("slo_ms")
+        return cls(
+            name=name,
+            model=data.get("model") or default_model,
+            rules=rules,
+            slo_ms=float(slo_ms) if slo_ms is not None else None,
+            fallback=data.get("fallback"),
+        )
+    
+    def model_for(self, prompt_tokens: int) -> str:
+        """按提示词 token 数匹配规则"""
+        for rule in self.rules:
+            if prompt_tokens < rule.get("min_prompt_tokens", 0):
+                continue
+            if "max_prompt_tokens" in rule and prompt_tokens > rule["max_prompt_tokens"]:
+                continue
+            return rule["model"]
+        return self.model
+
+
+class _RouteStats:
+    """一条路由的调用统计"""
+    
+    __slots__ = ("calls", "errors", "fallbacks", "prompt_tokens", "completion_tokens", "latencies", "models")
+    
+    def __init__(self, samples: int):
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: Deque[float] = deque(maxlen=samples)
+        self.models: Dict[str, int] = {}
+
+
+def _quantile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ModelRouter:
+    """
+    模型路由器
+    
+    Args:
+        default_model: 未配置的路由使用的模型
+        routes: {路由名称: 路由配置}
+        slo_window: 判断 SLO 风险时参考的时间窗口（秒）
+        slo_quantile: 与 SLO 比较的延迟分位数
+        min_samples: 窗口内样本数达到该值才判断 SLO 风险
+    """
+    
+    def __init__(
+        self,
+        default_model: str = "gpt-3.5-turbo",
+        routes: Optional[Dict[str, RouteConfig]] = None,
+        slo_window: float = 60.0,
+        slo_quantile: float = 0.9,
+        min_samples: int = 5,
+    ):
+        self.default_model = default_model
+        self.routes = routes or {}
+        self.slo_window = slo_window
+        self.slo_quantile = slo_quantile
+        self.min_samples = min_samples
+        # (路由, 模型) -> [(时间戳, 延迟秒数)]，用于 SLO 判断
+        self._recent: Dict[Tuple[str, str], Deque[Tuple[float, float]]] = {}
+        self._stats: Dict[str, _RouteStats] = {}
+    
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        """根据环境变量创建，配置文件读取失败时所有路由使用 LLM_MODEL"""
+        default_model = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
+        kwargs = {
+            "slo_window": float(os.getenv("LLM_SLO_WINDOW_SECONDS", "60")),
+            "slo_quantile": float(os.getenv("LLM_SLO_QUANTILE", "0.9")),
+        }
+        path = os.getenv("LLM_ROUTES_FILE")
+        if not path:
+            return cls(default_model, **kwargs)
+        try:
+            return cls.from_file(path, default_model, **kwargs)
+        except Exception as e:
+            print(f"加载模型路由配置失败: {e}")
+            return cls(default_model, **kwargs)
+    
+    @classmethod
+    def from_file(cls, path: str, default_model: str = "gpt-3.5-turbo", **kwargs: Any) -> "ModelRouter":
+        """
+        从 JSON 配置文件创建
+        
+        Args:
+            path: 配置文件路径
+            default_model: 配置文件未指定 default 时使用的模型
+        
+        Raises:
+            OSError: 文件无法读取
+            ValueError: 文件不是合法的 JSON
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        default_model = config.get("default") or default_model
+        routes = {
+            name: RouteConfig.from_dict(name, data, default_model)
+            for name, data in config.get("routes", {}).items()
+        }
+        return cls(default_model, routes, **kwargs)
+    
+    def model_for(self, route: str, prompt_tokens: int = 0) -> str:
+        """不考虑 SLO 的静态选择（如离线批任务）"""
+        config = self.routes.get(route)
+        return config.model_for(prompt_tokens) if config is not None else self.default_model
+    
+    def select(self, route: str, prompt_tokens: int = 0) -> str:
+        """
+        为一次调用选择模型
+        
+        Args:
+            route: 路由名称（见 Route）
+            prompt_tokens: 系统提示与用户提示的 token 数
+        
+        Returns:
+            模型名称
+        """
+        config = self.routes.get(route)
+        if config is None:
+            return self.default_model
+        model = config.model_for(prompt_tokens)
+        if config.fallback and config.fallback != model and self.at_risk(route, model):
+            self._route_stats(route).fallbacks += 1
+            return config.fallback
+        return model
+    
+    def at_risk(self, route: str, model: str) -> bool:
+        """所选模型在该路由上最近的延迟分位数是否已达到 SLO"""
+        config = self.routes.get(route)
+        recent = self._recent.get((route, model))
+        if config is None or config.slo_ms is None or not recent:
+            return False
+        cutoff = time.monotonic() - self.slo_window
+        while recent and recent[0][0] < cutoff:
+            recent.popleft()
+        if len(recent) < self.min_samples:
+            return False
+        return _quantile([latency for _, latency in recent], self.slo_quantile) * 1000 >= config.slo_ms
+    
+    def record(
+        self,
+        route: str,
+        model: str,
+        latency: float,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        error: bool = False,
+    ):
+        """
+        记录一次调用
+        
+        Args:
+            route: 路由名称
+            model: 实际使用的模型
+            latency: 延迟（秒）
+            prompt_tokens: 提示词 token 数
+            completion_tokens: 输出 token 数
+            error: 调用是否失败
+        
+        失败的调用（超时、限流等）不计入统计中的延迟分位数，但按不低于 SLO 的延迟
+        计入 SLO 判断的样本，持续失败的模型同样会触发降级。
+        """
+        stats = self._route_stats(route)
+        stats.calls += 1
+        stats.models[model] = stats.models.get(model, 0) + 1
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        if error:
+            stats.errors += 1
+            config = self.routes.get(route)
+            if config is not None and config.slo_ms is not None:
+                latency = max(latency, config.slo_ms / 1000)
+        else:
+            stats.latencies.append(latency)
+        self._recent.setdefault((route, model), deque(maxlen=256)).append((time.monotonic(), latency))
+    
+    def _route_stats(self, route: str) -> _RouteStats:
+        stats = self._stats.get(route)
+        if stats is None:
+            stats = self._stats[route] = _RouteStats(samples=1024)
+        return stats
+    
+    def stats(self) -> Dict[str, Any]:
+        """各路由的调用数、模型分布、降级次数、延迟分位数和 token 用量"""
+        routes = {}
+        for route, stats in self._stats.items():
+            latencies = list(stats.latencies)
+            config = self.routes.get(route)
+            routes[route] = {
+                "model": config.model if config is not None else self.default_model,
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "fallbacks": stats.fallbacks,
+                "models": dict(stats.models),
+                "latency_p50_ms": round(_quantile(latencies, 0.5) * 1000, 2) if latencies else None,
+                "latency_p90_ms": round(_quantile(latencies, 0.9) * 1000, 2) if latencies else None,
+                "prompt_tokens": stats.prompt_tokens,
+                "completion_tokens": stats.completion_tokens,
+            }
+        return {"default_model": self.default_model, "routes": routes}
+
+
+_router: Optional[ModelRouter] = None
+
+
+def get_router() -> ModelRouter:
+    """获取进程级共享的模型路由器（首次调用时按环境变量创建）"""
+    global _router
+    if _router is None:
+        _router = ModelRouter.from_env()
+    return _router
+
+
+def set_router(router: ModelRouter):
+    """替换进程级模型路由器"""
+    global _router
+    _router = router
@@ -0,0 +1,154 @@
+"""
+执行计划缓存 - 相同结构的查询复用已校验的执行计划
+
+查询先做归一化（空白、大小写，数字与日期字面量替换为参数占位符），
+归一化结果相同的查询共享同一份计划模板；命中时把新查询的参数重新绑定到
+各任务的 subQuery 和 description 中，从而跳过一次规划LLM调用。
+"""
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .types import ExecutionPlan
+
+
+# 日期字面量：2024-03-01、2024/3/1、2024年3月1日、2024年3月、2024年
+_DATE_PATTERN = r"\d{4}(?:[-/.]\d{1,2}(?:[-/.]\d{1,2})?|年(?:\d{1,2}月(?:\d{1,2}日)?)?)"
+# 数字字面量：整数、小数、百分比
+_NUMBER_PATTERN = r"\d+(?:\.\d+)?%?"
+_LITERAL_RE = re.compile(f"{_DATE_PATTERN}|{_NUMBER_PATTERN}")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# 模板中的参数占位符
+_SLOT = "⟨{}⟩"
+_SLOT_RE = re.compile("⟨(\\d+)⟩")
+
+
+def normalize_query(query: str) -> Tuple[str, List[str]]:
+    """
+    归一化查询
+    
+    Args:
+        query: 原始用户查询
+    
+    Returns:
+        (模板键, 按出现顺序提取的字面量参数)
+    """
+    text = _WHITESPACE_RE.sub(" ", query.strip()).casefold()
+    params = _LITERAL_RE.findall(text)
+    template = _LITERAL_RE.sub(_SLOT.format("#"), text)
+    return template, params
+
+
+def _literals_re(literals: List[str]) -> "re.Pattern":
+    """一次性匹配所有独立出现的字面量，避免把 3 替换进 2023 这样的数字内部"""
+    alternatives = "|".join(re.escape(literal) for literal in sorted(literals, key=len, reverse=True))
+    return re.compile(r"(?<![\d.])(?:" + alternatives + r")(?![\d.%])")
+
+
+class PlanCache:
+    """
+    按归一化查询缓存执行计划模板，LRU 淘汰
+    
+    Args:
+        max_entries: 最多缓存的模板数量
+    """
+    
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._templates: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    @classmethod
+    def from_env(cls) -> Optional["PlanCache"]:
+        """根据环境变量创建计划缓存，PLAN_CACHE_ENABLED=0 时返回None"""
+        if os.getenv("PLAN_CACHE_ENABLED", "1") == "0":
+            return None
+        return cls(max_entries=int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "512")))
+    
+    def get(self, query: str) -> Optional[ExecutionPlan]:
+        """
+        查找与查询结构相同的计划模板，并绑定新查询的参数
+        
+        Returns:
+            绑定参数后的执行计划，未命中返回None
+        """
+        key, params = normalize_query(query)
+        template = self._templates.get(key)
+        if template is None:
+            self.misses += 1
+            return None
+        
+        self._templates.move_to_end(key)
+        self.hits += 1
+        
+        def bind(text: str) -> str:
+            return _SLOT_RE.sub(lambda m: params[int(m.group(1))], text)
+        
+        tasks = [
+            {**task, "subQuery": bind(task["subQuery"]), "description": bind(task["description"])}
+            for task in template["tasks"]
+        ]
+        return ExecutionPlan(planId=template["planId"], tasks=tasks)
+    
+    def put(self, query: str, plan: ExecutionPlan) -> bool:
+        """
+        把已校验的计划存为模板
+        
+        只有当每个参数在所有任务的 subQuery 和 description 中恰好出现一次时才缓存：
+        出现多次时无法区分哪一处来自查询、哪一处是规划器自己生成的数字（如 LIMIT 3），
+        命中时会把后者也替换掉，宁可不缓存。
+        
+        Returns:
+            是否成功缓存
+        """
+        key, params = normalize_query(query)
+        if len(set(params)) != len(params):
+            return False
+        
+        slots = {param: index for index, param in enumerate(params)}
+        counts = [0] * len(params)
+        
+        def replace(match: "re.Match") -> str:
+            index = slots[match.group(0)]
+            counts[index] += 1
+            return _SLOT.format(index)
+        
+        def unbind(text: str) -> str:
+            if not params:
+                return text
+            return _literals_re(params).sub(replace, text)
+        
+        plan_dict = plan.model_dump(mode="json")
+        tasks = [
+            {**task, "subQuery": unbind(task["subQuery"]), "description": unbind(task["description"])}
+            for task in plan_dict["tasks"]
+        ]
+        if any(count != 1 for count in counts):
+            return False
+        
+        self._templates[key] = {"planId": plan_dict["planId"], "tasks": tasks}
+        self._templates.move_to_end(key)
+        while len(self._templates) > self.max_entries:
+            self._templates.popitem(last=False)
+        return True
+    
+    def __contains__(self, query: str) -> bool:
+        """是否存在与查询结构相同的模板（不计入命中统计）"""
+        key, _ = normalize_query(query)
+        return key in self._templates
+    
+    def invalidate(self, query: str) -> bool:
+        """使某个查询结构对应的模板失效，返回是否存在该模板"""
+        key, _ = normalize_query(query)
+        return self._templates.pop(key, None) is not None
+    
+    def clear(self):
+        """清空所有计划模板"""
+        self._templates.clear()
+    
+    def stats(self) -> Dict[str, int]:
+        """计划缓存命中统计"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._templates)}
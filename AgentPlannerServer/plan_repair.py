@@ -0,0 +1,338 @@
+"""
+执行计划的本地修复 - 规划输出总是先在本地修复，只有无法修复时才重新请求LLM
+
+修复项（返回的修复种类用于日志和指标）：
+- json：宽松解析，去掉代码块围栏和前后说明文字、删除多余的尾逗号、补全被截断的输出
+- tool：把未知的 tool 值按别名映射到 TaskTool（如 "SQL" -> Text2SQL、"search" -> RAG），无法映射的任务被丢弃
+- id：缺失或重复的任务ID重新编号
+- field：缺失的 description / subQuery 用另一个字段或用户查询补全
+- dependency：删除指向不存在任务或自身的依赖，合成任务没有依赖时改为依赖全部工具任务
+- cycle：存在循环依赖时只保留指向计划中更早任务的依赖
+- synthesis：缺少 Final_Synthesis 时追加一个依赖全部工具任务的合成节点
+"""
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .types import AnalysisTask, ExecutionPlan, TaskTool
+
+
+# 本地修复失败后重新请求LLM的最大次数
+MAX_REASKS = int(os.getenv("PLAN_REPAIR_MAX_REASKS", "1"))
+
+_FENCE_RE = re.compile(r"```[a-zA-Z]*\s*(.*?)(?:```|$)", re.DOTALL)
+_NORMALIZE_RE = re.compile(r"[\s_\-]+")
+
+# 归一化后的别名 -> 工具；不在表中时再按关键词匹配
+TOOL_ALIASES: Dict[str, TaskTool] = {
+    "text2sql": TaskTool.Text2SQL,
+    "texttosql": TaskTool.Text2SQL,
+    "sql": TaskTool.Text2SQL,
+    "database": TaskTool.Text2SQL,
+    "db": TaskTool.Text2SQL,
+    "数据库": TaskTool.Text2SQL,
+    "数据库查询": TaskTool.Text2SQL,
+    "rag": TaskTool.RAG,
+    "retrieval": TaskTool.RAG,
+    "retrieve": TaskTool.RAG,
+    "search": TaskTool.RAG,
+    "document": TaskTool.RAG,
+    "documents": TaskTool.RAG,
+    "knowledge": TaskTool.RAG,
+    "检索": TaskTool.RAG,
+    "文档检索": TaskTool.RAG,
+    "finalsynthesis": TaskTool.Final_Synthesis,
+    "synthesis": TaskTool.Final_Synthesis,
+    "summary": TaskTool.Final_Synthesis,
+    "summarize": TaskTool.Final_Synthesis,
+    "answer": TaskTool.Final_Synthesis,
+    "综合": TaskTool.Final_Synthesis,
+    "总结": TaskTool.Final_Synthesis,
+}
+
+_TOOL_KEYWORDS: Tuple[Tuple[str, TaskTool], ...] = (
+    ("synth", TaskTool.Final_Synthesis),
+    ("sql", TaskTool.Text2SQL),
+    ("rag", TaskTool.RAG),
+    ("retriev", TaskTool.RAG),
+    ("search", TaskTool.RAG),
+)
+
+
+def close_json(text: str) -> Optional[str]:
+    """
+    把可能带尾逗号、被截断的 JSON 文本整理为可解析的文本
+    
+    顶层值结束后的内容被忽略；被截断时回退到最后一个完整的元素并补齐括号。
+    
+    Returns:
+        整理后的文本，没有任何完整内容时返回 None
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = escape = False
+    # (已输出长度, 当时的括号栈)：截断时可以安全回退到的位置
+    safe: Optional[Tuple[int, Tuple[str, ...]]] = None
+    
+    for ch in text:
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+            safe = (len(out), tuple(stack))
+        elif ch in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if not stack:
+                break
+            out.append(stack.pop())
+            if not stack:
+                return "".join(out)
+            safe = (len(out), tuple(stack))
+        else:
+            if ch == ",":
+                safe = (len(out), tuple(stack))
+            out.append(ch)
+    
+    if safe is None:
+        return None
+    length, open_brackets = safe
+    head = "".join(out[:length]).rstrip()
+    if head.endswith(","):
+        head = head[:-1]
+    return head + "".join(reversed(open_brackets))
+
+
+def parse_lenient(text: str) -> Optional[Any]:
+    """
+    宽松解析LLM输出的 JSON：先按严格 JSON 解析，失败时去掉代码块围栏和说明文字并修补
+    
+    Returns:
+        解析结果，无法解析时返回 None
+    """
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        pass
+    
+    fenced = _FENCE_RE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return None
+    closed = close_json(text[min(starts):])
+    if closed is None:
+        return None
+    try:
+        return json.loads(closed)
+    except ValueError:
+        return None
+
+
+def map_tool(value: Any) -> Optional[TaskTool]:
+    """把 tool 字段的取值映射到 TaskTool，无法识别时返回 None"""
+    if isinstance(value, TaskTool):
+        return value
+    if not isinstance(value, str):
+        return None
+    try:
+        return TaskTool(value)
+    except ValueError:
+        pass
+    key = _NORMALIZE_RE.sub("", value).lower()
+    if key in TOOL_ALIASES:
+        return TOOL_ALIASES[key]
+    for keyword, tool in _TOOL_KEYWORDS:
+        if keyword in key:
+            return tool
+    return None
+
+
+def _as_int(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _task_dicts(raw: Any) -> Optional[List[Any]]:
+    """从解析结果中找到任务列表（兼容直接返回数组、嵌套在 plan 中等形式）"""
+    if isinstance(raw, list):
+        return raw
+    if not isinstance(raw, dict):
+        return None
+    if isinstance(raw.get("tasks"), list):
+        return raw["tasks"]
+    for value in raw.values():
+        if isinstance(value, dict) and isinstance(value.get("tasks"), list):
+            return value["tasks"]
+    return None
+
+
+def repair_plan(raw: Any, user_query: str) -> Tuple[Optional[ExecutionPlan], List[str]]:
+    """
+    修复解析后的计划
+    
+    Args:
+        raw: 解析后的规划输出（字典或任务数组）
+        user_query: 用户查询，用于补全缺失的字段
+    
+    Returns:
+        (执行计划, 修复种类列表)；没有任何可用任务时计划为 None
+    """
+    repairs: List[str] = []
+    items = _task_dicts(raw)
+    if not items:
+        return None, repairs
+    
+    # 第一遍：工具、字段与ID
+    tasks: List[Dict[str, Any]] = []
+    used: Set[int] = set()
+    pending_ids: List[Dict[str, Any]] = []
+    for item in items:
+        if not isinstance(item, dict):
+            repairs.append("tool")
+            continue
+        tool = map_tool(item.get("tool"))
+        if tool is None:
+            repairs.append("tool")
+            continue
+        if tool.value != item.get("tool"):
+            repairs.append("tool")
+        
+        description = item.get("description")
+        sub_query = item.get("subQuery")
+        if not isinstance(description, str) or not description:
+            description = sub_query if isinstance(sub_query, str) and sub_query else user_query
+            repairs.append("field")
+        if not isinstance(sub_query, str) or not sub_query:
+            sub_query = description
+            repairs.append("field")
+        
+        task = {
+            "id": _as_int(item.get("id")),
+            "tool": tool,
+            "description": description,
+            "subQuery": sub_query,
+            "dependencies": item.get("dependencies"),
+        }
+        if task["id"] is None or task["id"] in used:
+            pending_ids.append(task)
+        else:
+            used.add(task["id"])
+        tasks.append(task)
+    
+    if not tasks:
+        return None, repairs
+    next_id = max(used, default=0) + 1
+    for task in pending_ids:
+        task["id"] = next_id
+        used.add(next_id)
+        next_id += 1
+        repairs.append("id")
+    
+    # 第二遍：依赖
+    tool_ids = [task["id"] for task in tasks if task["tool"] != TaskTool.Final_Synthesis]
+    for task in tasks:
+        raw_deps = task["dependencies"]
+        if not isinstance(raw_deps, list):
+            raw_deps = [raw_deps] if raw_deps not in (None, "") else []
+        deps = []
+        for dep in raw_deps:
+            dep_id = _as_int(dep)
+            if dep_id in used and dep_id != task["id"] and dep_id not in deps:
+                deps.append(dep_id)
+        if len(deps) != len(raw_deps):
+            repairs.append("dependency")
+        if task["tool"] == TaskTool.Final_Synthesis and not deps and tool_ids:
+            deps = list(tool_ids)
+            repairs.append("dependency")
+        task["dependencies"] = deps
+    
+    if _has_cycle(tasks):
+        order = {task["id"]: index for index, task in enumerate(tasks)}
+        for task in tasks:
+            task["dependencies"] = [dep for dep in task["dependencies"] if order[dep] < order[task["id"]]]
+        repairs.append("cycle")
+    
+    if not any(task["tool"] == TaskTool.Final_Synthesis for task in tasks):
+        tasks.append({
+            "id": next_id,
+            "tool": TaskTool.Final_Synthesis,
+            "description": user_query,
+            "subQuery": user_query,
+            "dependencies": list(tool_ids),
+        })
+        repairs.append("synthesis")
+    
+    plan_id = raw.get("planId") if isinstance(raw, dict) else None
+    if not isinstance(plan_id, str) or not plan_id:
+        plan_id = "plan_" + hashlib.sha256(user_query.encode("utf-8")).hexdigest()[:12]
+    return ExecutionPlan(planId=plan_id, tasks=[AnalysisTask(**task) for task in tasks]), repairs
+
+
+def _has_cycle(tasks: List[Dict[str, Any]]) -> bool:
+    indegree = {task["id"]: len(task["dependencies"]) for task in tasks}
+    dependents: Dict[int, List[int]] = {}
+    for task in tasks:
+        for dep in task["dependencies"]:
+            dependents.setdefault(dep, []).append(task["id"])
+    ready = [task_id for task_id, degree in indegree.items() if degree == 0]
+    visited = 0
+    while ready:
+        task_id = ready.pop()
+        visited += 1
+        for child in dependents.get(task_id, ()):
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                ready.append(child)
+    return visited != len(tasks)
+
+
+def repair_plan_text(text: str, user_query: str) -> Tuple[Optional[ExecutionPlan], List[str]]:
+    """
+    解析并修复规划LLM的原始输出
+    
+    Returns:
+        (执行计划, 修复种类列表)；无法解析或没有可用任务时计划为 None
+    """
+    repairs: List[str] = []
+    try:
+        raw = json.loads(text)
+    except (TypeError, ValueError):
+        raw = parse_lenient(text)
+        repairs.append("json")
+        if raw is None:
+            return None, repairs
+    
+    # 格式合法的计划同样可能有悬空/循环依赖或缺少合成任务，总是经过修复；
+    # 没有任何修复时得到的计划与原输出一致
+    plan, fixes = repair_plan(raw, user_query)
+    return plan, repairs + fixes
+
+
+def reask_prompt(user_query: str, previous: str) -> str:
+    """本地修复失败时重新请求规划的提示"""
+    return (
+        f"用户查询: {user_query}\n\n"
+        "上一次的输出无法解析为合法的执行计划，请严格按照 JSON Schema 重新输出完整的计划，不要附加任何说明。\n"
+        f"上一次的输出（截断）:\n{previous[:2000]}"
+    )
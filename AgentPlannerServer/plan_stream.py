@@ -0,0 +1,108 @@
+"""
+增量计划解析 - 在规划LLM流式输出的过程中逐个取出已完整的任务
+
+解析器逐字符跟踪 JSON 结构（字符串与转义、对象/数组嵌套、当前键名），
+当根对象 "tasks" 数组中的某个任务对象闭合时立即把它解析出来，
+无需等待整个计划输出完毕。
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+
+class IncrementalTaskParser:
+    """
+    从流式 JSON 文本中增量提取 tasks 数组中的任务对象
+    
+    用法:
+        parser = IncrementalTaskParser()
+        for chunk in stream:
+            for task in parser.feed(chunk):
+                ...
+        plan = json.loads(parser.text)
+    """
+    
+    def __init__(self, array_key: str = "tasks"):
+        self.array_key = array_key
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._key: List[Optional[str]] = []
+        self._array_depth: Optional[int] = None
+        self._object_start: Optional[int] = None
+        # 单个增长的缓冲区，解析字符串和任务对象时直接切片
+        self._text = ""
+    
+    @property
+    def text(self) -> str:
+        """目前收到的全部文本"""
+        return self._text
+    
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """
+        输入一段文本
+        
+        Returns:
+            本段文本中闭合的任务对象（按出现顺序）
+        """
+        offset = len(self._text)
+        self._text += chunk
+        completed: List[Dict[str, Any]] = []
+        
+        for i, char in enumerate(chunk, offset):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = self._string_at(i)
+                continue
+            
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char == ":":
+                # 对象中冒号前的字符串是键名
+                if self._stack and self._stack[-1] == "{":
+                    self._key[-1] = self._last_string
+            elif char in "{[":
+                parent_key = self._key[-1] if self._key else None
+                self._stack.append(char)
+                self._key.append(None)
+                depth = len(self._stack)
+                if char == "[" and depth == 2 and parent_key == self.array_key and self._array_depth is None:
+                    self._array_depth = depth
+                elif char == "{" and self._array_depth is not None and depth == self._array_depth + 1:
+                    self._object_start = i
+            elif char in "}]":
+                depth = len(self._stack)
+                if not self._stack:
+                    continue
+                self._stack.pop()
+                self._key.pop()
+                if char == "}" and self._object_start is not None and depth == (self._array_depth or 0) + 1:
+                    obj = self._parse(self._object_start, i + 1)
+                    self._object_start = None
+                    if obj is not None:
+                        completed.append(obj)
+                elif char == "]" and depth == self._array_depth:
+                    self._array_depth = -1  # 任务数组已结束，不再匹配同名键
+            elif char == "," and self._stack and self._stack[-1] == "{":
+                self._key[-1] = None
+        return completed
+    
+    def _string_at(self, end: int) -> Optional[str]:
+        try:
+            return json.loads(self._text[self._string_start:end + 1])
+        except ValueError:
+            return None
+    
+    def _parse(self, start: int, end: int) -> Optional[Dict[str, Any]]:
+        try:
+            obj = json.loads(self._text[start:end])
+        except ValueError:
+            return None
+        return obj if isinstance(obj, dict) else None
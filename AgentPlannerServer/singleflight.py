@@ -0,0 +1,162 @@
+"""
+请求合并（single-flight）- 相同键的并发调用共享同一次执行
+
+第一个调用者启动执行，其余调用者挂到同一个进行中的任务上等待结果（或异常）。
+等待者被取消时只撤销自己的等待；当所有等待者都已离开，底层执行才会被取消，
+避免一个客户端断开连接就中断其他用户共享的计算。
+
+stream() 是流式版本：相同键的并发调用共享同一个异步迭代器的输出，
+后加入的调用者先收到已产出的片段，再与其他调用者同步接收后续片段。
+"""
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, TypeVar
+
+
+T = TypeVar("T")
+
+
+def query_key(query: str) -> str:
+    """用户查询的合并键：只归一化空白，内容不同的查询不会被合并"""
+    return " ".join(query.split())
+
+
+class _Call:
+    """进行中的一次执行"""
+    __slots__ = ("task", "waiters")
+    
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _Stream:
+    """进行中的一次流式执行"""
+    __slots__ = ("task", "chunks", "changed", "waiters")
+    
+    def __init__(self):
+        self.task: asyncio.Task = None
+        self.chunks: List[Any] = []
+        self.changed = asyncio.Event()
+        self.waiters = 0
+    
+    def notify(self):
+        """唤醒正在等待新片段的调用者"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    """相同键的并发调用合并为一次执行"""
+    
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._streams: Dict[Hashable, _Stream] = {}
+        self.executions = 0
+        self.shared = 0
+        self.cancelled = 0
+    
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        执行 fn，若相同键的调用正在进行则等待其结果
+        
+        Args:
+            key: 合并键，键相同的调用被视为等价
+            fn: 无参协程函数，只有第一个调用者会执行它
+        
+        Returns:
+            fn 的结果（所有等待者共享同一个结果对象，调用方不应修改它）
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            self.executions += 1
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.shared += 1
+        
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # 最后一个等待者离开，取消底层执行
+                self._forget(key, call)
+                call.task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            call.waiters -= 1
+    
+    async def stream(self, key: Hashable, fn: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """
+        迭代 fn() 的输出，若相同键的流式调用正在进行则共享其输出
+        
+        Args:
+            key: 合并键
+            fn: 返回异步迭代器的无参函数，只有第一个调用者会执行它
+        
+        Yields:
+            fn() 产出的片段（从头开始）；执行失败时在已产出的片段之后抛出同一个异常
+        """
+        call = self._streams.get(key)
+        if call is None:
+            call = _Stream()
+            call.task = asyncio.ensure_future(self._pump(fn, call))
+            self._streams[key] = call
+            self.executions += 1
+            call.task.add_done_callback(lambda _: self._forget_stream(key, call))
+        else:
+            self.shared += 1
+        
+        call.waiters += 1
+        index = 0
+        try:
+            while True:
+                if index < len(call.chunks):
+                    index += 1
+                    yield call.chunks[index - 1]
+                elif call.task.done():
+                    call.task.result()
+                    return
+                else:
+                    await call.changed.wait()
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 最后一个调用者离开（断开或提前停止迭代），取消底层执行
+                self._forget_stream(key, call)
+                call.task.cancel()
+                self.cancelled += 1
+    
+    async def _pump(self, fn: Callable[[], AsyncIterator[Any]], call: _Stream):
+        iterator = fn()
+        try:
+            async for chunk in iterator:
+                call.chunks.append(chunk)
+                call.notify()
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+            call.notify()
+    
+    def in_flight(self) -> int:
+        """当前进行中的执行数量"""
+        return len(self._calls) + len(self._streams)
+    
+    def stats(self) -> Dict[str, Any]:
+        """合并统计"""
+        return {
+            "executions": self.executions,
+            "shared": self.shared,
+            "cancelled": self.cancelled,
+            "in_flight": self.in_flight(),
+        }
+    
+    def _forget(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+    
+    def _forget_stream(self, key: Hashable, call: _Stream):
+        if self._streams.get(key) is call:
+            del self._streams[key]
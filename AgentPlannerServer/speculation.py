@@ -0,0 +1,147 @@
+"""
+推测执行 - 在规划LLM返回之前预先启动最可能出现的工具任务
+
+规划调用通常需要一次完整的LLM往返，而常见问题的第一批 RAG / SQL 任务是可以预测的。
+推测执行在规划的同时启动这些任务：预测来自计划模板历史，即结构相同的查询
+上次规划出的无依赖工具任务（参数重新绑定）；没有历史的查询不做推测——
+规划器生成的子查询与用户原问题几乎从不一致，按原问题预取的任务无法被采用，只会增加负载。
+真实计划到达后，(工具, 子查询) 一致的任务直接采用预取结果，其余预取任务被取消。
+命中率与浪费的工作量可通过 stats() 查看。
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .plan_cache import PlanCache
+from .types import AnalysisTask, ExecutionPlan, TaskTool
+
+
+SpeculationKey = Tuple[TaskTool, str]
+
+
+def speculation_key(tool: TaskTool, sub_query: str) -> SpeculationKey:
+    """预取任务与计划任务的匹配键：工具相同且子查询（忽略空白和大小写）相同"""
+    return tool, " ".join(sub_query.split()).casefold()
+
+
+class Speculation:
+    """单次请求的推测执行，由 Speculator.start 创建"""
+    
+    def __init__(self, speculator: "Speculator"):
+        self._speculator = speculator
+        self._tasks: Dict[SpeculationKey, asyncio.Task] = {}
+        self._started: Dict[SpeculationKey, float] = {}
+        self._ended: Dict[SpeculationKey, float] = {}
+        self._adopted: set = set()
+        self._finished = False
+    
+    def launch(self, tool: TaskTool, sub_query: str, engine: Any):
+        key = speculation_key(tool, sub_query)
+        if key in self._tasks:
+            return
+        runner = asyncio.create_task(engine.execute_tool(tool, sub_query))
+        runner.add_done_callback(lambda _: self._ended.setdefault(key, time.monotonic()))
+        self._tasks[key] = runner
+        self._started[key] = time.monotonic()
+    
+    def __len__(self) -> int:
+        return len(self._tasks)
+    
+    def take(self, task: AnalysisTask) -> Optional[asyncio.Task]:
+        """计划任务与某个预取任务匹配时返回该预取任务（每个预取任务只能被采用一次）"""
+        key = speculation_key(task.tool, task.subQuery)
+        runner = self._tasks.get(key)
+        if runner is None or key in self._adopted:
+            return None
+        self._adopted.add(key)
+        return runner
+    
+    def finish(self):
+        """取消未被采用的预取任务并记录统计"""
+        if self._finished:
+            return
+        self._finished = True
+        now = time.monotonic()
+        for key, runner in self._tasks.items():
+            if key in self._adopted:
+                continue
+            if not runner.done():
+                runner.cancel()
+            elif not runner.cancelled():
+                # 取出异常，避免 "exception was never retrieved" 警告
+                runner.exception()
+            self._speculator.wasted_seconds += self._ended.get(key, now) - self._started[key]
+        self._speculator.adopted += len(self._adopted)
+        self._speculator.wasted += len(self._tasks) - len(self._adopted)
+
+
+class Speculator:
+    """
+    推测执行器
+    
+    Args:
+        max_tasks: 每个请求最多预取的任务数
+        history_size: 计划模板历史的容量
+    """
+    
+    def __init__(self, max_tasks: int = 2, history_size: int = 512):
+        self.max_tasks = max_tasks
+        self.history = PlanCache(history_size)
+        
+        self.speculations = 0
+        self.launched = 0
+        self.adopted = 0
+        self.wasted = 0
+        self.wasted_seconds = 0.0
+    
+    @classmethod
+    def from_env(cls) -> Optional["Speculator"]:
+        """根据环境变量创建推测执行器，SPECULATION_ENABLED=1 且历史容量大于 0 时才启用"""
+        history_size = int(os.getenv("SPECULATION_HISTORY_SIZE", "512"))
+        if os.getenv("SPECULATION_ENABLED", "0") != "1" or history_size <= 0:
+            return None
+        return cls(
+            max_tasks=int(os.getenv("SPECULATION_MAX_TASKS", "2")),
+            history_size=history_size,
+        )
+    
+    def predict(self, query: str) -> List[Tuple[TaskTool, str]]:
+        """按模板历史预测计划中无依赖的工具任务，返回 (工具, 子查询) 列表；没有历史时返回空列表"""
+        plan = self.history.get(query)
+        if plan is None:
+            return []
+        return [
+            (task.tool, task.subQuery) for task in plan.tasks
+            if not task.dependencies and task.tool != TaskTool.Final_Synthesis
+        ][:self.max_tasks]
+    
+    def start(self, query: str, engine: Any) -> Speculation:
+        """在规划的同时启动预测的工具任务"""
+        speculation = Speculation(self)
+        for tool, sub_query in self.predict(query):
+            speculation.launch(tool, sub_query, engine)
+        self.speculations += 1
+        self.launched += len(speculation)
+        return speculation
+    
+    def record(self, query: str, plan: ExecutionPlan):
+        """
+        把真实计划记入模板历史，供结构相同的后续查询预测使用
+        
+        参数无法在计划中唯一定位的计划不会被记录（见 PlanCache.put），
+        避免预取参数被错误替换的SQL
+        """
+        self.history.put(query, plan)
+    
+    def stats(self) -> Dict[str, Any]:
+        """命中率与浪费的工作量"""
+        settled = self.adopted + self.wasted
+        return {
+            "speculations": self.speculations,
+            "launched": self.launched,
+            "adopted": self.adopted,
+            "wasted": self.wasted,
+            "hit_rate": self.adopted / settled if settled else 0.0,
+            "wasted_seconds": round(self.wasted_seconds, 3),
+        }
@@ -0,0 +1,51 @@
+"""
+测试合成上下文在 token 预算内的压缩
+"""
+import os
+import sys
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.context_packer import ContextPacker, count_tokens, select_chunks, summarize_table
+
+
+ROWS = [{"region": f"区域{i % 5}", "sales": i * 10, "product": f"产品{i}"} for i in range(200)]
+
+
+def test_small_results_kept_verbatim():
+    packer = ContextPacker(budget_tokens=1000)
+    packed = packer.pack("问题", [("任务 1 结果", [{"a": 1}]), ("任务 2 结果", "短文本")])
+    assert packed == '任务 1 结果: [{"a": 1}]\n任务 2 结果: 短文本'
+
+
+def test_large_table_summarized_within_budget():
+    summary = summarize_table(ROWS, 200)
+    assert count_tokens(summary) <= 200
+    assert summary.startswith("共 200 行，列: region, sales, product")
+    assert "sales: 数值, min=0, max=1990" in summary
+    assert '{"region": "区域0", "sales": 0, "product": "产品0"}' in summary
+
+
+def test_relevant_chunks_selected_in_original_order():
+    text = "\n".join([
+        "华东区断货原因是物流延误。",
+        "无关的内容" * 20,
+        "华北区销量稳定增长。",
+        "华东区补货计划下周完成。",
+    ])
+    selected = select_chunks(text, "华东区断货", 30)
+    assert count_tokens(selected) <= 30
+    assert selected.splitlines() == ["华东区断货原因是物流延误。", "华东区补货计划下周完成。"]
+
+
+def test_budget_shared_between_large_results():
+    packer = ContextPacker(budget_tokens=600)
+    results = [("任务 1 结果", ROWS), ("任务 2 结果", "说明。\n" * 400), ("任务 3 结果", "小结果")]
+    packed = packer.pack("销量", results)
+    assert count_tokens(packed) <= 600 + 50
+    assert "任务 3 结果: 小结果" in packed
+    
+    # 相同结果再次压缩时命中缓存
+    assert packer.pack("销量", results) == packed
+    assert len(packer._cache) == 2
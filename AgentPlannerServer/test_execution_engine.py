@@ -0,0 +1,62 @@
+"""
+测试执行引擎的流式调度
+"""
+import asyncio
+import os
+import sys
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.execution_engine import ExecutionEngine
+from AgentPlannerServer.types import ExecutionPlan
+
+
+class FakeClient:
+    """固定回答的LLM客户端"""
+    
+    async def ask(self, prompt, system_prompt=None, **kwargs):
+        return "合成结果"
+    
+    async def ask_stream(self, prompt, system_prompt=None, **kwargs):
+        for token in ("合成", "结果"):
+            yield token
+
+
+def _plan(*tasks):
+    return ExecutionPlan(planId="p", tasks=[
+        {"id": task_id, "tool": tool, "description": "d", "subQuery": "q", "dependencies": list(deps)}
+        for task_id, tool, deps in tasks
+    ])
+
+
+async def _collect(events):
+    return [event async for event in events]
+
+
+async def _planned(plan):
+    for task in plan.tasks:
+        yield "task", task
+    yield "plan", plan
+
+
+def test_run_stream_streams_final_synthesis():
+    plan = _plan((1, "RAG", ()), (2, "Text2SQL", ()), (3, "Final_Synthesis", (1, 2)))
+    events = asyncio.run(_collect(ExecutionEngine(FakeClient()).run_stream(plan)))
+    assert [event["event"] for event in events] == ["task", "task", "token", "token", "answer"]
+    assert events[-1]["data"] == "合成结果"
+
+
+def test_synthesis_with_dependents_runs_as_ordinary_task():
+    """有任务依赖最终合成节点时，流式路径与 run() 一样返回合成结果"""
+    plan = _plan((1, "RAG", ()), (2, "Final_Synthesis", (1,)), (3, "Text2SQL", (2,)))
+    engine = ExecutionEngine(FakeClient())
+    assert asyncio.run(engine.run(plan)) == "合成结果"
+    
+    events = asyncio.run(_collect(engine.run_stream(plan)))
+    assert {event["data"]["id"] for event in events if event["event"] == "task"} == {1, 2, 3}
+    assert events[-1] == {"event": "answer", "data": "合成结果"}
+    
+    events = asyncio.run(_collect(engine.run_incremental_stream(_planned(plan))))
+    assert "token" not in [event["event"] for event in events]
+    assert events[-1] == {"event": "answer", "data": "合成结果"}
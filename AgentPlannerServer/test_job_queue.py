@@ -0,0 +1,113 @@
+"""
+测试任务队列的租约过期、重新领取与过期执行者的结果丢弃
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.job_queue import (
+    FAILED,
+    QUEUED,
+    RUNNING,
+    SUCCEEDED,
+    Job,
+    JobQueue,
+    MemoryJobStore,
+    SQLiteJobStore,
+)
+from AgentPlannerServer.llm_scheduler import LLMUnavailableError
+
+
+def test_expired_lease_is_reclaimed_and_stale_owner_rejected():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteJobStore(os.path.join(tmp, "jobs.db"))
+        store.put(Job("j1", "查询"))
+        
+        first = store.claim(lease=0.05)
+        assert first.id == "j1" and first.attempts == 1 and first.status == RUNNING
+        assert store.claim(lease=0.05) is None
+        assert store.renew(first, lease=0.05)
+        
+        time.sleep(0.1)
+        second = store.claim(lease=60)
+        assert second.id == "j1" and second.attempts == 2
+        
+        # 旧的执行者既不能续约，也不能覆盖新执行者的结果
+        assert not store.renew(first, lease=60)
+        first.status, first.result = SUCCEEDED, {"answer": "旧结果"}
+        assert not store.update(first)
+        assert store.get("j1").status == RUNNING
+        
+        second.status, second.result = SUCCEEDED, {"answer": "新结果"}
+        assert store.update(second)
+        assert store.get("j1").result == {"answer": "新结果"}
+        store.close()
+
+
+def test_worker_stops_when_lease_is_lost():
+    async def main(path):
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+        
+        async def runner(query):
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return {"success": True}
+        
+        queue = JobQueue(runner, SQLiteJobStore(path), workers=1, lease=0.3, poll_interval=0.05)
+        queue.start()
+        try:
+            job = await queue.submit("查询")
+            await asyncio.wait_for(started.wait(), 2)
+            
+            # 另一个进程在租约过期后重新领取了该任务
+            other = SQLiteJobStore(path)
+            other._conn.execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (job.id,))
+            other._conn.commit()
+            reclaimed = other.claim(lease=60)
+            assert reclaimed.id == job.id and reclaimed.attempts == 2
+            
+            await asyncio.wait_for(cancelled.wait(), 2)
+            await asyncio.sleep(0.05)
+            assert queue.lost == 1
+            assert (await queue.get(job.id)).status == RUNNING
+            
+            reclaimed.status, reclaimed.result = SUCCEEDED, {"success": True}
+            assert other.update(reclaimed)
+            assert (await queue.get(job.id)).status == SUCCEEDED
+            other.close()
+        finally:
+            await queue.aclose()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(main(os.path.join(tmp, "jobs.db")))
+
+
+def test_overloaded_job_is_requeued_then_fails_after_max_attempts():
+    async def main():
+        async def runner(query):
+            raise LLMUnavailableError("过载", retry_after=0.01)
+        
+        queue = JobQueue(runner, MemoryJobStore(), workers=1, max_attempts=2, poll_interval=0.01)
+        queue.start()
+        try:
+            job = await queue.submit("查询")
+            deadline = time.monotonic() + 2
+            while (await queue.get(job.id)).status in (QUEUED, RUNNING) and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            finished = await queue.get(job.id)
+            assert finished.status == FAILED and finished.attempts == 2
+            assert queue.retried == 1 and queue.failed == 1
+        finally:
+            await queue.aclose()
+    
+    asyncio.run(main())
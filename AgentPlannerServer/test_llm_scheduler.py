@@ -0,0 +1,132 @@
+"""
+测试LLM调度器的 AIMD 并发调整与 Retry-After 退避
+"""
+import asyncio
+import os
+import sys
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.llm_scheduler import (
+    AdaptiveLimiter,
+    LLMScheduler,
+    LLMUnavailableError,
+    Priority,
+    retry_after_seconds,
+)
+
+
+class FakeAPIError(Exception):
+    """带 HTTP 响应的服务商错误"""
+    
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.response = httpx.Response(status_code, headers=headers or {})
+
+
+def test_limit_halves_once_per_round_and_grows_additively():
+    async def main():
+        limiter = AdaptiveLimiter(initial=16, min_limit=2, max_limit=64)
+        for _ in range(3):
+            await limiter.acquire()
+        for _ in range(3):
+            limiter.release("overload")
+        assert limiter.limit == 8
+        
+        # 超过一秒后再次过载才继续缩减，且不低于下限
+        for _ in range(3):
+            limiter._last_decrease -= 2
+            await limiter.acquire()
+            limiter.release("overload")
+        assert limiter.limit == 2
+        
+        for _ in range(2):
+            await limiter.acquire()
+            limiter.release("success")
+        assert limiter.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+        assert limiter.in_use == 0
+    
+    asyncio.run(main())
+
+
+def test_waiters_served_by_priority():
+    async def main():
+        limiter = AdaptiveLimiter(initial=2, min_limit=2, max_limit=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        order = []
+        
+        async def waiter(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+        
+        tasks = [
+            asyncio.create_task(waiter("planner", Priority.PLANNER)),
+            asyncio.create_task(waiter("tool", Priority.TOOL)),
+            asyncio.create_task(waiter("synthesis", Priority.SYNTHESIS)),
+        ]
+        await asyncio.sleep(0)
+        for _ in tasks:
+            limiter.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order == ["synthesis", "tool", "planner"]
+    
+    asyncio.run(main())
+
+
+def test_retry_after_header_formats():
+    assert retry_after_seconds(FakeAPIError(429, {"retry-after": "3"})) == 3.0
+    assert retry_after_seconds(FakeAPIError(429, {"retry-after-ms": "250"})) == 0.25
+    assert 8 <= retry_after_seconds(FakeAPIError(503, {"retry-after": formatdate(time.time() + 10, usegmt=True)})) <= 10
+    assert retry_after_seconds(FakeAPIError(429, {"retry-after": "soon"})) is None
+    assert retry_after_seconds(FakeAPIError(500)) is None
+
+
+def test_429_waits_retry_after_and_backs_off():
+    scheduler = LLMScheduler(AdaptiveLimiter(initial=8), base_delay=0.001, max_delay=1.0)
+    calls = []
+    
+    async def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise FakeAPIError(429, {"retry-after": "0.2"})
+        return "ok"
+    
+    assert asyncio.run(scheduler.run(fn)) == "ok"
+    assert calls[1] - calls[0] >= 0.2
+    assert scheduler.throttled == 1 and scheduler.retries == 1
+    assert scheduler.limiter.limit == pytest.approx(4 + 1 / 4)
+    assert scheduler.limiter.in_use == 0
+
+
+def test_retries_exhausted_raise_unavailable():
+    scheduler = LLMScheduler(max_retries=1, base_delay=0.001, max_delay=0.01)
+    
+    async def fn():
+        raise FakeAPIError(429, {"retry-after": "0.005"})
+    
+    with pytest.raises(LLMUnavailableError) as info:
+        asyncio.run(scheduler.run(fn))
+    assert info.value.status_code == 429
+    assert info.value.retry_after == 0.005
+    assert scheduler.rejected == 1 and scheduler.limiter.in_use == 0
+
+
+def test_non_retryable_error_not_retried():
+    scheduler = LLMScheduler(base_delay=0.001)
+    calls = []
+    
+    async def fn():
+        calls.append(1)
+        raise FakeAPIError(400)
+    
+    with pytest.raises(FakeAPIError):
+        asyncio.run(scheduler.run(fn))
+    assert len(calls) == 1 and scheduler.limiter.in_use == 0
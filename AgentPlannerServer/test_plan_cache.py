@@ -0,0 +1,42 @@
+"""
+测试执行计划缓存的参数重新绑定
+"""
+import os
+import sys
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.plan_cache import PlanCache
+from AgentPlannerServer.types import ExecutionPlan
+
+
+def _plan(sub_query: str, description: str) -> ExecutionPlan:
+    return ExecutionPlan(planId="p1", tasks=[
+        {"id": 1, "tool": "Text2SQL", "description": description, "subQuery": sub_query, "dependencies": []},
+        {"id": 2, "tool": "Final_Synthesis", "description": "汇总", "subQuery": "汇总", "dependencies": [1]},
+    ])
+
+
+def test_rebinds_query_literal():
+    """参数在计划中只出现一次时缓存，命中时绑定新参数"""
+    cache = PlanCache()
+    assert cache.put("Show Q3 sales", _plan("SELECT region, sales FROM sales WHERE quarter=3", "各区域销售额"))
+    
+    plan = cache.get("Show Q4 sales")
+    assert plan is not None
+    assert plan.tasks[0].subQuery == "SELECT region, sales FROM sales WHERE quarter=4"
+
+
+def test_refuses_literal_that_also_appears_in_planner_text():
+    """规划器自己生成的相同数字（LIMIT 3、top 3）不能被当作参数替换"""
+    cache = PlanCache()
+    plan = _plan("SELECT region FROM sales WHERE quarter=3 ORDER BY sales DESC LIMIT 3", "Q3 top 3 regions")
+    assert not cache.put("Show Q3 sales", plan)
+    assert cache.get("Show Q4 sales") is None
+
+
+def test_refuses_literal_missing_from_plan():
+    """参数没有出现在计划中时无法绑定，不缓存"""
+    cache = PlanCache()
+    assert not cache.put("Show Q3 sales", _plan("SELECT region, sales FROM sales", "各区域销售额"))
@@ -0,0 +1,157 @@
+"""
+测试执行计划的本地修复
+"""
+import json
+import os
+import sys
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.execution_engine import topological_waves
+from AgentPlannerServer.plan_repair import close_json, map_tool, parse_lenient, repair_plan, repair_plan_text
+from AgentPlannerServer.types import TaskTool
+
+
+QUERY = "分析Q3华东区销售额下降的原因"
+
+
+def _task(task_id, tool, dependencies=(), **fields):
+    return {
+        "id": task_id,
+        "tool": tool,
+        "description": fields.get("description", f"任务{task_id}"),
+        "subQuery": fields.get("subQuery", f"子查询{task_id}"),
+        "dependencies": list(dependencies),
+    }
+
+
+def _summary(plan):
+    return [(task.id, task.tool.value, task.dependencies) for task in plan.tasks]
+
+
+def test_close_json_removes_trailing_commas():
+    assert json.loads(close_json('{"a": [1, 2,], "b": {"c": 3,},}')) == {"a": [1, 2], "b": {"c": 3}}
+
+
+def test_close_json_ignores_text_after_top_level_value():
+    assert json.loads(close_json('{"a": 1} 以上是计划')) == {"a": 1}
+
+
+def test_close_json_closes_truncated_output():
+    assert json.loads(close_json('{"a": [1, 2, {"b": "x')) == {"a": [1, 2, {}]}
+    assert json.loads(close_json('{"tasks": [{"id": 1}, {"id": 2, "tool": "RA')) == {"tasks": [{"id": 1}, {"id": 2}]}
+
+
+def test_close_json_keeps_brackets_inside_strings():
+    assert json.loads(close_json('{"a": "x}],\\"y", "b": 1,}')) == {"a": 'x}],"y', "b": 1}
+
+
+def test_close_json_without_any_container():
+    assert close_json('"只有字符串') is None
+
+
+def test_parse_lenient_strips_code_fence_and_prose():
+    text = '计划如下：\n```json\n{"tasks": [{"id": 1},]}\n```\n请查收'
+    assert parse_lenient(text) == {"tasks": [{"id": 1}]}
+    assert parse_lenient("无法生成计划") is None
+
+
+def test_map_tool():
+    assert map_tool("RAG") == TaskTool.RAG
+    assert map_tool("SQL") == TaskTool.Text2SQL
+    assert map_tool("text_to_sql") == TaskTool.Text2SQL
+    assert map_tool("Document Search") == TaskTool.RAG
+    assert map_tool("final synthesis") == TaskTool.Final_Synthesis
+    assert map_tool("总结") == TaskTool.Final_Synthesis
+    assert map_tool("weather") is None
+    assert map_tool(None) is None
+
+
+def test_repair_plan_keeps_valid_plan():
+    raw = {"planId": "p1", "tasks": [_task(1, "Text2SQL"), _task(2, "RAG"), _task(3, "Final_Synthesis", [1, 2])]}
+    plan, repairs = repair_plan(raw, QUERY)
+    assert repairs == []
+    assert plan.planId == "p1"
+    assert _summary(plan) == [(1, "Text2SQL", []), (2, "RAG", []), (3, "Final_Synthesis", [1, 2])]
+
+
+def test_repair_plan_drops_dangling_and_self_dependencies():
+    raw = {"tasks": [_task(1, "Text2SQL", [7]), _task(2, "RAG", [2, 1]), _task(3, "Final_Synthesis", [1, 2])]}
+    plan, repairs = repair_plan(raw, QUERY)
+    assert "dependency" in repairs
+    assert _summary(plan) == [(1, "Text2SQL", []), (2, "RAG", [1]), (3, "Final_Synthesis", [1, 2])]
+
+
+def test_repair_plan_breaks_cycles():
+    raw = {"tasks": [_task(1, "Text2SQL", [2]), _task(2, "RAG", [1]), _task(3, "Final_Synthesis", [1, 2])]}
+    plan, repairs = repair_plan(raw, QUERY)
+    assert "cycle" in repairs
+    assert _summary(plan) == [(1, "Text2SQL", []), (2, "RAG", [1]), (3, "Final_Synthesis", [1, 2])]
+    topological_waves(plan.tasks)
+
+
+def test_repair_plan_inserts_missing_synthesis():
+    raw = {"tasks": [_task(1, "Text2SQL"), _task(2, "RAG")]}
+    plan, repairs = repair_plan(raw, QUERY)
+    assert "synthesis" in repairs
+    assert _summary(plan)[-1] == (3, "Final_Synthesis", [1, 2])
+    assert plan.tasks[-1].subQuery == QUERY
+
+
+def test_repair_plan_synthesis_without_dependencies_waits_for_tools():
+    raw = {"tasks": [_task(1, "Text2SQL"), _task(2, "Final_Synthesis")]}
+    plan, repairs = repair_plan(raw, QUERY)
+    assert "dependency" in repairs
+    assert _summary(plan) == [(1, "Text2SQL", []), (2, "Final_Synthesis", [1])]
+
+
+def test_repair_plan_maps_tools_and_renumbers_ids():
+    raw = {"tasks": [
+        _task(1, "sql"),
+        _task(1, "search"),
+        {"tool": "weather", "description": "x"},
+        {"id": "5", "tool": "Final_Synthesis", "description": "汇总", "dependencies": ["1", 9]},
+    ]}
+    plan, repairs = repair_plan(raw, QUERY)
+    assert {"tool", "id", "field", "dependency"} <= set(repairs)
+    assert _summary(plan) == [(1, "Text2SQL", []), (6, "RAG", []), (5, "Final_Synthesis", [1])]
+    assert plan.tasks[-1].subQuery == "汇总"
+
+
+def test_repair_plan_without_usable_tasks():
+    assert repair_plan({"tasks": []}, QUERY)[0] is None
+    assert repair_plan({"tasks": [{"tool": "weather"}]}, QUERY)[0] is None
+    assert repair_plan("不是计划", QUERY)[0] is None
+
+
+def test_repair_plan_text_repairs_well_formed_json():
+    """格式合法、能通过模型校验的计划同样需要修复依赖和补齐合成任务"""
+    dangling = json.dumps({"planId": "p", "tasks": [_task(1, "Text2SQL", [7]), _task(2, "Final_Synthesis", [1])]})
+    plan, repairs = repair_plan_text(dangling, QUERY)
+    assert repairs == ["dependency"]
+    assert _summary(plan) == [(1, "Text2SQL", []), (2, "Final_Synthesis", [1])]
+    
+    cyclic = json.dumps({"tasks": [_task(1, "Text2SQL", [2]), _task(2, "RAG", [1]), _task(3, "Final_Synthesis", [1, 2])]})
+    plan, repairs = repair_plan_text(cyclic, QUERY)
+    assert repairs == ["cycle"]
+    topological_waves(plan.tasks)
+    
+    no_synthesis = json.dumps({"planId": "p", "tasks": [_task(1, "Text2SQL"), _task(2, "RAG")]})
+    plan, repairs = repair_plan_text(no_synthesis, QUERY)
+    assert repairs == ["synthesis"]
+    assert plan.tasks[-1].tool == TaskTool.Final_Synthesis
+
+
+def test_repair_plan_text_valid_plan_has_no_repairs():
+    text = json.dumps({"planId": "p", "tasks": [_task(1, "RAG"), _task(2, "Final_Synthesis", [1])]})
+    plan, repairs = repair_plan_text(text, QUERY)
+    assert repairs == []
+    assert _summary(plan) == [(1, "RAG", []), (2, "Final_Synthesis", [1])]
+
+
+def test_repair_plan_text_truncated_output():
+    text = '```json\n{"planId": "p", "tasks": [{"id": 1, "tool": "SQL", "description": "d", "subQuery": "s", "dependencies": []}, {"id": 2, "tool": "Final_Syn'
+    plan, repairs = repair_plan_text(text, QUERY)
+    assert "json" in repairs and "synthesis" in repairs
+    assert _summary(plan) == [(1, "Text2SQL", []), (2, "Final_Synthesis", [1])]
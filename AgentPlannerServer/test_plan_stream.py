@@ -0,0 +1,55 @@
+"""
+测试增量计划解析器
+"""
+import json
+import os
+import sys
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.plan_stream import IncrementalTaskParser
+
+
+PLAN = {
+    "planId": "p",
+    "note": {"tasks": [{"id": 99}]},
+    "tasks": [
+        {"id": 1, "tool": "Text2SQL", "description": "查询\"华东\"销量 {a: [1]}", "subQuery": "C:\\\\data\\\\", "dependencies": []},
+        {"id": 2, "tool": "RAG", "description": "带 } 和 ] 的描述\\\"", "subQuery": "q", "dependencies": []},
+        {"id": 3, "tool": "Final_Synthesis", "description": "合成", "subQuery": "q", "dependencies": [1, 2]},
+    ],
+    "tasks_extra": [{"id": 100}],
+}
+
+
+def _feed_all(parser, chunks):
+    tasks = []
+    for chunk in chunks:
+        tasks.extend(parser.feed(chunk))
+    return tasks
+
+
+def test_tasks_emitted_for_any_split():
+    text = json.dumps(PLAN, ensure_ascii=False)
+    for size in (1, 2, 3, 7, len(text)):
+        parser = IncrementalTaskParser()
+        tasks = _feed_all(parser, [text[i:i + size] for i in range(0, len(text), size)])
+        assert tasks == PLAN["tasks"]
+        assert parser.text == text
+        assert json.loads(parser.text) == PLAN
+
+
+def test_task_emitted_as_soon_as_it_closes():
+    text = json.dumps(PLAN, ensure_ascii=False)
+    first_end = text.index('"dependencies": []}') + len('"dependencies": []}')
+    parser = IncrementalTaskParser()
+    assert parser.feed(text[:first_end - 1]) == []
+    assert parser.feed(text[first_end - 1:first_end]) == [PLAN["tasks"][0]]
+
+
+def test_escape_split_across_chunks():
+    text = '{"tasks": [{"id": 1, "description": "a\\"}b"}]}'
+    split = text.index("\\") + 1
+    parser = IncrementalTaskParser()
+    assert _feed_all(parser, [text[:split], text[split:]]) == [{"id": 1, "description": 'a"}b'}]
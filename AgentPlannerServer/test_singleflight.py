@@ -0,0 +1,144 @@
+"""
+测试请求合并（single-flight）的共享、取消与流式重放
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+        
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"answer": 42}
+        
+        results = await asyncio.gather(*(flight.do("q", fn) for _ in range(5)))
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert flight.stats() == {"executions": 1, "shared": 4, "cancelled": 0, "in_flight": 0}
+    
+    asyncio.run(main())
+
+
+def test_execution_survives_until_last_waiter_cancels():
+    async def main():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+        
+        async def fn():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        
+        first = asyncio.create_task(flight.do("q", fn))
+        second = asyncio.create_task(flight.do("q", fn))
+        await started.wait()
+        
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.sleep(0)
+        assert not cancelled.is_set() and flight.in_flight() == 1
+        
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert flight.cancelled == 1 and flight.in_flight() == 0
+        
+        # 取消后相同键重新执行，而不是拿到已取消的任务
+        async def fresh():
+            return "new"
+        assert await flight.do("q", fresh) == "new"
+    
+    asyncio.run(main())
+
+
+def test_late_stream_joiner_replays_chunks():
+    async def main():
+        flight = SingleFlight()
+        gate = asyncio.Event()
+        
+        async def produce():
+            yield "a"
+            yield "b"
+            await gate.wait()
+            yield "c"
+        
+        async def consume(received):
+            async for chunk in flight.stream("q", produce):
+                received.append(chunk)
+        
+        early, late = [], []
+        first = asyncio.create_task(consume(early))
+        while len(early) < 2:
+            await asyncio.sleep(0)
+        second = asyncio.create_task(consume(late))
+        while len(late) < 2:
+            await asyncio.sleep(0)
+        assert late == ["a", "b"]
+        
+        gate.set()
+        await asyncio.gather(first, second)
+        assert early == late == ["a", "b", "c"]
+        assert flight.executions == 1 and flight.shared == 1
+    
+    asyncio.run(main())
+
+
+def test_stream_error_reaches_every_consumer_after_chunks():
+    async def main():
+        flight = SingleFlight()
+        
+        async def produce():
+            yield "a"
+            await asyncio.sleep(0.01)
+            raise RuntimeError("boom")
+        
+        async def consume():
+            received = []
+            with pytest.raises(RuntimeError, match="boom"):
+                async for chunk in flight.stream("q", produce):
+                    received.append(chunk)
+            return received
+        
+        assert await asyncio.gather(consume(), consume()) == [["a"], ["a"]]
+    
+    asyncio.run(main())
+
+
+def test_stream_cancelled_when_last_consumer_stops():
+    async def main():
+        flight = SingleFlight()
+        closed = asyncio.Event()
+        
+        async def produce():
+            try:
+                while True:
+                    yield "x"
+                    await asyncio.sleep(0.001)
+            finally:
+                closed.set()
+        
+        stream = flight.stream("q", produce)
+        assert await stream.__anext__() == "x"
+        await stream.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        assert flight.cancelled == 1 and flight.in_flight() == 0
+    
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""
+测试文本切分与向量索引的构建和检索
+"""
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+# 添加父目录到路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AgentPlannerServer.vector_index import HashingEmbedder, VectorIndex, build_index, chunk_text
+
+
+def test_chunks_never_exceed_chunk_size():
+    rng = random.Random(0)
+    for _ in range(200):
+        sentences = ["字" * rng.randint(1, 80) + "。" for _ in range(rng.randint(1, 30))]
+        chunk_size = rng.randint(20, 120)
+        overlap = rng.randint(0, chunk_size - 1)
+        chunks = chunk_text("".join(sentences), chunk_size=chunk_size, overlap=overlap)
+        assert chunks
+        assert all(len(chunk) <= chunk_size for chunk in chunks)
+
+
+def test_overlap_carried_between_chunks():
+    text = "第一句话在这里。第二句话在这里。第三句话在这里。"
+    chunks = chunk_text(text, chunk_size=16, overlap=4)
+    assert chunks[0] == "第一句话在这里。第二句话在这里。"
+    assert chunks[1].startswith("在这里。第三句")
+
+
+def test_ivf_round_trip():
+    documents = [(f"doc{i}.txt", f"文档{i}") for i in range(3)]
+    chunks = [f"{region}区域{product}的库存与销量报告" for region in ("华东", "华北", "华南", "西南") for product in ("手机", "电脑", "耳机", "平板", "手表")]
+    embedder = HashingEmbedder()
+    embeddings = embedder.encode(chunks)
+    with tempfile.TemporaryDirectory() as out_dir:
+        build_index(out_dir, documents, embeddings, chunks, [i % 3 for i in range(len(chunks))], embedder.name, ivf_lists=4)
+        index = VectorIndex(out_dir)
+        assert len(index) == len(chunks)
+        assert index.centroids is not None
+        assert sorted(index.ivf_order.tolist()) == list(range(len(chunks)))
+        
+        for row, chunk in enumerate(chunks):
+            assert index.text(row) == chunk
+            assert index.source(row) == f"doc{row % 3}.txt"
+            results = index.search(embeddings[row], k=3, nprobe=2)
+            assert results[0][0] == row
+            assert np.isclose(results[0][1], 1.0, atol=1e-5)
@@ -0,0 +1,365 @@
+"""
+Text2SQL执行器 - 由LLM生成SQL，在带连接池的本地数据库上执行
+
+后端可插拔，默认使用 SQLite（首次启动时生成演示用的销售数据库），安装 duckdb 后
+可切换为 DuckDB。执行时强制只读、限制返回行数和语句超时，结果以批次流式读取，
+调用方取消时会中断正在执行的语句。
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from .llm_scheduler import Priority
+from .model_router import Route
+from .singleflight import SingleFlight
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+SQLGenerator = Callable[[str, str], Awaitable[str]]
+
+# 演示数据：Q3 各区域产品线销售额，与原模拟结果一致
+DEMO_ROWS = [
+    ("华东区", "旗舰系列手机", 7160000.0, 10000000.0),
+    ("华东区", "智能穿戴", 2637000.0, 3000000.0),
+    ("华中区", "旗舰系列手机", 4740000.0, 5000000.0),
+    ("华南区", "旗舰系列手机", 8800000.0, 8000000.0),
+    ("华北区", "智能穿戴", 2205000.0, 2100000.0),
+    ("西南区", "平板电脑", 1890000.0, 1800000.0),
+]
+
+_READONLY_RE = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+_CODE_FENCE_RE = re.compile(r"^```(?:sql)?\s*|\s*```$", re.IGNORECASE)
+
+
+def ensure_demo_database(path: str):
+    """数据库文件不存在时创建演示用的 sales_q3 表"""
+    if os.path.exists(path):
+        return
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(
+            "CREATE TABLE sales_q3 ("
+            " region TEXT NOT NULL,"
+            " product_line TEXT NOT NULL,"
+            " revenue REAL NOT NULL,"
+            " prev_revenue REAL NOT NULL)"
+        )
+        conn.executemany("INSERT INTO sales_q3 VALUES (?, ?, ?, ?)", DEMO_ROWS)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def clean_sql(text: str) -> str:
+    """
+    清理LLM生成的SQL并校验只读
+    
+    Raises:
+        ValueError: 不是单条 SELECT/WITH 语句
+    """
+    sql = _CODE_FENCE_RE.sub("", text.strip()).strip().rstrip(";").strip()
+    if ";" in sql:
+        raise ValueError("只允许执行单条SQL语句")
+    if not _READONLY_RE.match(sql):
+        raise ValueError(f"只允许执行只读查询: {sql[:50]}")
+    return sql
+
+
+class SQLBackend:
+    """数据库后端基类，子类负责连接的创建、执行和中断"""
+    
+    def __init__(self, pool_size: int = 4):
+        self.pool_size = pool_size
+        self._pool: Optional[asyncio.Queue] = None
+        self._connections: List[Any] = []
+        self._opened = 0
+        self._schema: Optional[str] = None
+    
+    def _connect(self) -> Any:
+        raise NotImplementedError
+    
+    def _describe(self, conn: Any) -> str:
+        raise NotImplementedError
+    
+    def _interrupt(self, conn: Any):
+        conn.interrupt()
+    
+    def _prepare(self, conn: Any, deadline: float, cancelled: threading.Event):
+        """执行前的准备工作（如安装超时检查），默认无操作"""
+    
+    def _finish(self, conn: Any):
+        """执行结束后的清理工作，默认无操作"""
+    
+    async def _acquire(self) -> Any:
+        """从连接池获取连接，池未满时按需创建新连接"""
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+        if self._pool.empty() and self._opened < self.pool_size:
+            # 先占位再创建，避免并发请求同时创建超过上限的连接
+            self._opened += 1
+            try:
+                conn = await asyncio.get_running_loop().run_in_executor(None, self._connect)
+            except BaseException:
+                self._opened -= 1
+                raise
+            self._connections.append(conn)
+            return conn
+        return await self._pool.get()
+    
+    def _release(self, conn: Any):
+        self._pool.put_nowait(conn)
+    
+    async def schema(self) -> str:
+        """返回数据库表结构描述，用于SQL生成提示词（结果会被缓存）"""
+        if self._schema is None:
+            conn = await self._acquire()
+            try:
+                loop = asyncio.get_running_loop()
+                self._schema = await loop.run_in_executor(None, self._describe, conn)
+            finally:
+                self._release(conn)
+        return self._schema
+    
+    async def stream(
+        self,
+        sql: str,
+        row_limit: int,
+        timeout: float,
+        batch_size: int = 200,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        执行查询并按批次流式产出结果行
+        
+        Args:
+            sql: 只读SQL
+            row_limit: 最多返回的行数
+            timeout: 语句超时（秒）
+            batch_size: 每批读取的行数
+        
+        Yields:
+            以列名为键的结果行
+        
+        Raises:
+            asyncio.TimeoutError: 语句执行超时
+        """
+        conn = await self._acquire()
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        cancelled = threading.Event()
+        cursor = None
+        running: Optional[asyncio.Future] = None
+        
+        async def in_thread(func, *args):
+            # 在线程池中执行阻塞调用，超时或取消时不丢失对线程中语句的引用
+            nonlocal running
+            running = loop.run_in_executor(None, func, *args)
+            result = await asyncio.wait_for(asyncio.shield(running), max(deadline - time.monotonic(), 0))
+            running = None
+            return result
+        
+        def execute():
+            self._prepare(conn, deadline, cancelled)
+            cur = conn.cursor()
+            cur.execute(sql)
+            return cur
+        
+        try:
+            cursor = await in_thread(execute)
+            columns = [column[0] for column in cursor.description or []]
+            remaining = row_limit
+            while remaining > 0:
+                batch = await in_thread(cursor.fetchmany, min(batch_size, remaining))
+                if not batch:
+                    break
+                remaining -= len(batch)
+                for row in batch:
+                    yield dict(zip(columns, row))
+        except BaseException as e:
+            # 超时、取消或调用方提前关闭时中断正在执行的语句，并等待线程退出后再归还连接
+            cancelled.set()
+            self._interrupt(conn)
+            if running is not None:
+                await asyncio.wait([running])
+                if not running.cancelled():
+                    running.exception()
+            if isinstance(e, Exception) and time.monotonic() >= deadline:
+                raise asyncio.TimeoutError(f"SQL执行超时（{timeout}秒）") from e
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+            self._finish(conn)
+            self._release(conn)
+    
+    async def close(self):
+        """关闭连接池中的所有连接"""
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+        self._opened = 0
+        self._pool = None
+
+
+class SQLiteBackend(SQLBackend):
+    """SQLite 后端，连接以只读模式打开"""
+    
+    def __init__(self, path: str, pool_size: int = 4):
+        super().__init__(pool_size)
+        self.path = path
+        ensure_demo_database(path)
+    
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+    
+    def _describe(self, conn: sqlite3.Connection) -> str:
+        rows = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type IN ('table', 'view') AND sql IS NOT NULL"
+        ).fetchall()
+        return "\n".join(row[0] for row in rows)
+    
+    def _prepare(self, conn: sqlite3.Connection, deadline: float, cancelled: threading.Event):
+        # 进度回调返回非零值时 SQLite 会中止当前语句，用于实现语句超时
+        conn.set_progress_handler(
+            lambda: int(cancelled.is_set() or time.monotonic() > deadline), 1000
+        )
+    
+    def _finish(self, conn: sqlite3.Connection):
+        conn.set_progress_handler(None, 0)
+
+
+class DuckDBBackend(SQLBackend):
+    """DuckDB 后端（需要安装 duckdb），连接以只读模式打开，禁止外部访问并锁定配置"""
+    
+    def __init__(self, path: str, pool_size: int = 4):
+        if duckdb is None:
+            raise ImportError("请安装duckdb: pip install duckdb")
+        super().__init__(pool_size)
+        self.path = path
+        self._root = None
+    
+    def _connect(self) -> Any:
+        # 同一进程内的多个游标共享一个数据库实例。LLM生成的SQL不可信：禁止访问外部
+        # 文件/网络（read_csv、ATTACH、COPY 等）与加载扩展，并锁定配置防止 SET 改回
+        if self._root is None:
+            self._root = duckdb.connect(self.path, read_only=True, config={
+                "enable_external_access": False,
+                "autoinstall_known_extensions": False,
+                "autoload_known_extensions": False,
+                "lock_configuration": True,
+            })
+        return self._root.cursor()
+    
+    def _describe(self, conn: Any) -> str:
+        rows = conn.execute(
+            "SELECT table_name, column_name, data_type FROM information_schema.columns"
+            " ORDER BY table_name, ordinal_position"
+        ).fetchall()
+        tables: Dict[str, List[str]] = {}
+        for table, column, data_type in rows:
+            tables.setdefault(table, []).append(f"{column} {data_type}")
+        return "\n".join(f"CREATE TABLE {table} ({', '.join(columns)})" for table, columns in tables.items())
+    
+    def _interrupt(self, conn: Any):
+        self._root.interrupt()
+    
+    async def close(self):
+        await super().close()
+        if self._root is not None:
+            self._root.close()
+            self._root = None
+
+
+class Text2SQLExecutor:
+    """
+    Text2SQL执行器
+    
+    Args:
+        backend: 数据库后端
+        generate_sql: SQL生成函数，输入 (自然语言问题, 表结构)，返回SQL文本
+        row_limit: 单次查询最多返回的行数
+        timeout: 语句超时（秒）
+    """
+    
+    def __init__(
+        self,
+        backend: SQLBackend,
+        generate_sql: SQLGenerator,
+        row_limit: int = 1000,
+        timeout: float = 10.0,
+    ):
+        self.backend = backend
+        self.generate_sql = generate_sql
+        self.row_limit = row_limit
+        self.timeout = timeout
+        self.inflight = SingleFlight()
+    
+    @classmethod
+    def from_env(cls, generate_sql: SQLGenerator) -> "Text2SQLExecutor":
+        """根据环境变量创建执行器，默认使用本地 SQLite 演示库"""
+        backend_name = os.getenv("TEXT2SQL_BACKEND", "sqlite")
+        path = os.getenv("TEXT2SQL_DB_PATH", "demo_sales.db")
+        pool_size = int(os.getenv("TEXT2SQL_POOL_SIZE", "4"))
+        if backend_name == "duckdb":
+            backend: SQLBackend = DuckDBBackend(path, pool_size)
+        else:
+            backend = SQLiteBackend(path, pool_size)
+        return cls(
+            backend,
+            generate_sql,
+            row_limit=int(os.getenv("TEXT2SQL_ROW_LIMIT", "1000")),
+            timeout=float(os.getenv("TEXT2SQL_TIMEOUT", "10")),
+        )
+    
+    async def to_sql(self, question: str) -> str:
+        """把自然语言问题转换为经过校验的只读SQL"""
+        schema = await self.backend.schema()
+        return clean_sql(await self.generate_sql(question, schema))
+    
+    async def stream(self, question: str) -> AsyncIterator[Dict[str, Any]]:
+        """生成SQL并流式产出结果行"""
+        sql = await self.to_sql(question)
+        async for row in self.backend.stream(sql, self.row_limit, self.timeout):
+            yield row
+    
+    async def run(self, question: str) -> List[Dict[str, Any]]:
+        """生成SQL并执行，返回最多 row_limit 行结果（相同问题的并发调用共享同一次执行）"""
+        async def execute() -> List[Dict[str, Any]]:
+            return [row async for row in self.stream(question)]
+        return await self.inflight.do(question, execute)
+    
+    async def close(self):
+        """关闭数据库连接池"""
+        await self.backend.close()
+
+
+TEXT2SQL_SYSTEM_PROMPT = """你是一个SQL专家。请根据数据库表结构，把用户问题转换为一条只读的SQL查询。
+只返回SQL本身，不要任何解释，不要使用 Markdown 代码块。"""
+
+
+def build_text2sql_prompt(question: str, schema: str) -> str:
+    """构建SQL生成的用户提示词"""
+    return f"""数据库表结构:
+{schema}
+
+用户问题: {question}
+"""
+
+
+def llm_sql_generator(client: Any) -> SQLGenerator:
+    """基于 LLMClient 的SQL生成函数"""
+    async def generate(question: str, schema: str) -> str:
+        return await client.ask(
+            build_text2sql_prompt(question, schema),
+            TEXT2SQL_SYSTEM_PROMPT,
+            priority=Priority.TOOL,
+            route=Route.TEXT2SQL,
+        )
+    return generate
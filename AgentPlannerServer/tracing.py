@@ -0,0 +1,386 @@
+"""
+链路追踪与指标 - 记录规划、工具调用、合成和每次LLM调用的耗时
+
+- span 通过 contextvars 自动建立父子关系；asyncio.create_task 会复制当前上下文，
+  因此并发任务中的 span 会挂在创建任务时的 span 下
+- 结束的 span 以 OpenTelemetry OTLP/JSON 格式导出：TRACE_EXPORT_FILE 写入本地 JSONL 文件
+  （每行是一个完整的导出请求，可被 Collector 的 otlpjsonfile 接收器读取），
+  OTEL_EXPORTER_OTLP_ENDPOINT 批量发送到 OTLP/HTTP 采集器
+- 同时汇总为 Prometheus 指标：各阶段耗时直方图、进行中的 span 数、token 计数与缓存命中
+- 根 span 收集整条链路上已结束的 span，可作为接口响应中的耗时明细
+
+生成器（如流式规划、流式合成）中的 span 使用 start_span 手动结束，不修改当前上下文。
+"""
+import asyncio
+import contextvars
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    """一条链路，收集其中已结束的 span（数量有上限）"""
+    __slots__ = ("trace_id", "spans", "limit")
+    
+    def __init__(self, limit: int = 1000):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List["Span"] = []
+        self.limit = limit
+
+
+class Span:
+    """一个计时区间"""
+    __slots__ = ("name", "trace", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error", "_tracer")
+    
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self._tracer = tracer
+        self.name = name
+        self.trace = parent.trace if parent is not None else Trace()
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+    
+    def set(self, key: str, value: Any):
+        """设置属性（如 token 数、缓存命中）"""
+        self.attributes[key] = value
+    
+    def record_error(self, error: BaseException):
+        """标记为失败（异常已被处理、span 仍正常结束时使用）"""
+        self.error = f"{error.__class__.__name__}: {error}"
+    
+    def end(self, error: Optional[BaseException] = None):
+        """结束 span；重复调用无效"""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.record_error(error)
+        self._tracer._finish(self)
+    
+    @property
+    def duration(self) -> float:
+        """耗时（秒），未结束时为到目前为止的耗时"""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+    
+    def to_otlp(self) -> Dict[str, Any]:
+        """转换为 OTLP/JSON 的 span 对象"""
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+    
+    def breakdown(self) -> Dict[str, Any]:
+        """
+        以该 span 为根的耗时明细
+        
+        Returns:
+            total_ms、按阶段名汇总的 stages（次数、总耗时、最大耗时）和按开始时间排序的 spans
+        """
+        spans = sorted(self.trace.spans, key=lambda span: span.start_ns)
+        stages: Dict[str, Dict[str, Any]] = {}
+        for span in spans:
+            if span is self:
+                continue
+            stage = stages.setdefault(span.name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            milliseconds = span.duration * 1000
+            stage["count"] += 1
+            stage["total_ms"] = round(stage["total_ms"] + milliseconds, 2)
+            stage["max_ms"] = round(max(stage["max_ms"], milliseconds), 2)
+        return {
+            "total_ms": round(self.duration * 1000, 2),
+            "stages": stages,
+            "spans": [
+                {
+                    "name": span.name,
+                    "start_ms": round((span.start_ns - self.start_ns) / 1e6, 2),
+                    "duration_ms": round(span.duration * 1000, 2),
+                    "attributes": span.attributes,
+                    **({"error": span.error} if span.error else {}),
+                }
+                for span in spans if span is not self
+            ],
+        }
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Prometheus 指标
+    
+    Args:
+        buckets: 耗时直方图的桶边界（秒）
+        prefix: 指标名前缀
+    """
+    
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, prefix: str = "agent"):
+        self.buckets = buckets
+        self.prefix = prefix
+        # 阶段名 -> [各桶计数, 总和, 次数]
+        self._histograms: Dict[str, List[Any]] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+    
+    def span_started(self, stage: str):
+        self._in_flight[stage] = self._in_flight.get(stage, 0) + 1
+    
+    def span_ended(self, stage: str, seconds: float, error: bool = False):
+        self._in_flight[stage] = self._in_flight.get(stage, 1) - 1
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+        if error:
+            self.inc("stage_errors_total", stage=stage)
+    
+    def inc(self, name: str, value: float = 1, **labels: Any):
+        """计数器加 value"""
+        key = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+        series = self._counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+    
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines = [f"# HELP {name} 各阶段耗时", f"# TYPE {name} histogram"]
+        for stage, (counts, total, count) in sorted(self._histograms.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{name}_bucket{{stage="{_escape_label(stage)}",le="{bound:g}"}} {bucket_count}')
+            lines.append(f'{name}_bucket{{stage="{_escape_label(stage)}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{stage="{_escape_label(stage)}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{_escape_label(stage)}"}} {count}')
+        
+        name = f"{self.prefix}_stage_in_flight"
+        lines += [f"# HELP {name} 进行中的阶段数", f"# TYPE {name} gauge"]
+        for stage, value in sorted(self._in_flight.items()):
+            lines.append(f'{name}{{stage="{_escape_label(stage)}"}} {value}')
+        
+        for counter, series in sorted(self._counters.items()):
+            name = f"{self.prefix}_{counter}"
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class FileSpanExporter:
+    """把 span 以 OTLP/JSON 导出请求的形式逐行写入本地文件"""
+    
+    def __init__(self, path: str, resource: Dict[str, Any]):
+        self.path = path
+        self.resource = resource
+        self._file = open(path, "a", encoding="utf-8")
+    
+    def export(self, span: Span):
+        payload = _export_request([span], self.resource)
+        self._file.write(json.dumps(payload, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+    
+    async def aclose(self):
+        self._file.close()
+
+
+class OTLPHttpExporter:
+    """
+    批量发送 span 到 OTLP/HTTP 采集器（POST {endpoint}/v1/traces，JSON 编码）
+    
+    Args:
+        endpoint: 采集器地址，如 http://localhost:4318
+        resource: 资源属性
+        batch_size: 攒够多少个 span 发送一次
+    """
+    
+    def __init__(self, endpoint: str, resource: Dict[str, Any], batch_size: int = 64):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.resource = resource
+        self.batch_size = batch_size
+        self._buffer: List[Span] = []
+        self._client = httpx.AsyncClient(timeout=5.0)
+        self._flushing: set = set()
+    
+    def export(self, span: Span):
+        self._buffer.append(span)
+        if len(self._buffer) >= self.batch_size:
+            try:
+                flushing = asyncio.get_running_loop().create_task(self.flush())
+            except RuntimeError:
+                return
+            self._flushing.add(flushing)
+            flushing.add_done_callback(self._flushing.discard)
+    
+    async def flush(self):
+        spans, self._buffer = self._buffer, []
+        if not spans:
+            return
+        try:
+            response = await self._client.post(self.url, json=_export_request(spans, self.resource))
+            response.raise_for_status()
+        except Exception as e:
+            print(f"导出链路数据失败: {e}")
+    
+    async def aclose(self):
+        await self.flush()
+        await self._client.aclose()
+
+
+def _export_request(spans: List[Span], resource: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute(key, value) for key, value in resource.items()]},
+            "scopeSpans": [{
+                "scope": {"name": "multi_agent_demo.tracing"},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }],
+    }
+
+
+class Tracer:
+    """
+    追踪器
+    
+    Args:
+        service_name: 导出时的 service.name
+        exporters: span 导出器列表
+        metrics: 指标汇总，默认新建
+    """
+    
+    def __init__(
+        self,
+        service_name: str = "multi-agent-demo",
+        exporters: Optional[List[Any]] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.service_name = service_name
+        self.exporters = exporters or []
+        self.metrics = metrics or Metrics()
+    
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        """根据环境变量创建追踪器（导出为可选，指标总是汇总）"""
+        service_name = os.getenv("OTEL_SERVICE_NAME", "multi-agent-demo")
+        resource = {"service.name": service_name}
+        exporters: List[Any] = []
+        path = os.getenv("TRACE_EXPORT_FILE")
+        if path:
+            exporters.append(FileSpanExporter(path, resource))
+        endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+        if endpoint:
+            exporters.append(OTLPHttpExporter(
+                endpoint, resource, int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "64")),
+            ))
+        return cls(service_name, exporters)
+    
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """开始一个 span（父 span 取当前上下文），需调用 end() 结束，不会成为当前 span"""
+        span = Span(self, name, _current_span.get(), attributes)
+        self.metrics.span_started(name)
+        return span
+    
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """
+        在 with 块内记录一个 span，块内创建的 span 和任务以它为父 span
+        
+        用法:
+            with tracer.span("synthesis", task_id=3) as span:
+                span.set("completion_tokens", 120)
+        """
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.end(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+    
+    def count(self, name: str, value: float = 1, **labels: Any):
+        """累加计数器，如 token 数、缓存命中"""
+        self.metrics.inc(name, value, **labels)
+    
+    def _finish(self, span: Span):
+        self.metrics.span_ended(span.name, span.duration, span.error is not None)
+        if len(span.trace.spans) < span.trace.limit:
+            span.trace.spans.append(span)
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                print(f"导出链路数据失败: {e}")
+    
+    async def aclose(self):
+        """刷新并关闭导出器"""
+        for exporter in self.exporters:
+            await exporter.aclose()
+        self.exporters = []
+
+
+def current_span() -> Optional[Span]:
+    """当前上下文中的 span"""
+    return _current_span.get()
+
+
+_tracer: Optional[Tracer] = None
+
+
+def get_tracer() -> Tracer:
+    """获取进程级共享的追踪器（首次调用时按环境变量创建）"""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer.from_env()
+    return _tracer
+
+
+def set_tracer(tracer: Tracer):
+    """替换进程级追踪器"""
+    global _tracer
+    _tracer = tracer
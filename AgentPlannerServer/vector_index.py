@@ -0,0 +1,439 @@
+"""
+本地向量索引 - RAG工具的检索引擎
+
+索引目录结构:
+    meta.json           维度、条目数、向量化方式等元信息
+    embeddings.npy      归一化后的 float32 向量矩阵 (N, D)，以内存映射方式加载
+    chunks.bin          所有文本块的 UTF-8 拼接
+    offsets.npy         每个文本块在 chunks.bin 中的起止偏移 (N + 1,)
+    source_ids.npy      每个文本块所属文档的编号 (N,)
+    sources.json        文档路径列表
+    ivf_centroids.npy   （可选）IVF 聚类中心 (C, D)
+    ivf_order.npy       （可选）按聚类排序后的文本块编号 (N,)
+    ivf_offsets.npy     （可选）每个聚类在 ivf_order 中的起止偏移 (C + 1,)
+
+所有大数组都通过 mmap 只读加载，多个 uvicorn worker 共享操作系统页缓存，
+不会在每个进程中各复制一份。索引在首次查询时才加载。
+
+用法:
+    python -m AgentPlannerServer.vector_index ingest docs/ --out rag_index
+    python -m AgentPlannerServer.vector_index query rag_index "华东区断货原因"
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .singleflight import SingleFlight
+
+
+RemoteEmbedFn = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？!?；;\n])")
+_TOKEN_RE = re.compile(r"[一-鿿]|[A-Za-z]+|\d+")
+TEXT_SUFFIXES = (".txt", ".md", ".markdown", ".csv", ".json")
+
+
+class HashingEmbedder:
+    """
+    基于特征哈希的本地向量化（中文按字与相邻字对，英文按词），无需模型和网络
+    
+    哈希使用 crc32，保证不同进程对同一文本得到相同向量
+    """
+    
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = "hashing"
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _TOKEN_RE.findall(text.lower())
+            features = tokens + [a + b for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                h = zlib.crc32(feature.encode("utf-8"))
+                matrix[row, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return _normalize_rows(matrix)
+    
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return self.encode(texts)
+
+
+class RemoteEmbedder:
+    """调用远程向量化服务（如 OpenAI embeddings）的向量化器"""
+    
+    def __init__(self, embed_fn: RemoteEmbedFn, name: str):
+        self.embed_fn = embed_fn
+        self.name = name
+    
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return _normalize_rows(np.asarray(await self.embed_fn(texts), dtype=np.float32))
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
+    """
+    把文本切分为长度不超过 chunk_size 的块，尽量在句末断开，相邻块保留 overlap 字符重叠
+    
+    Raises:
+        ValueError: overlap 不满足 0 <= overlap < chunk_size（否则超长句子的切分无法前进）
+    """
+    if not 0 <= overlap < chunk_size:
+        raise ValueError(f"overlap 必须满足 0 <= overlap < chunk_size，当前 overlap={overlap}, chunk_size={chunk_size}")
+    sentences = [s for s in _SENTENCE_END_RE.split(text) if s.strip()]
+    chunks: List[str] = []
+    current = ""
+    for sentence in sentences:
+        while len(sentence) > chunk_size:
+            head, sentence = sentence[:chunk_size], sentence[chunk_size - overlap:]
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(head)
+        if len(current) + len(sentence) > chunk_size and current:
+            chunks.append(current)
+            # 重叠部分只保留放得下当前句子的长度，保证新块不超过 chunk_size
+            keep = min(overlap, chunk_size - len(sentence))
+            current = current[-keep:] if keep > 0 else ""
+        current += sentence
+    if current.strip():
+        chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def _kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """在单位向量上做球面 k-means，返回归一化的聚类中心"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(n_clusters):
+            members = vectors[assign == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+
+def build_index(
+    out_dir: str,
+    documents: List[Tuple[str, str]],
+    embeddings: np.ndarray,
+    chunks: List[str],
+    chunk_sources: List[int],
+    embedder_name: str,
+    ivf_lists: int = 0,
+):
+    """
+    把文本块和向量写入索引目录
+    
+    Args:
+        out_dir: 输出目录
+        documents: (文档路径, 文本) 列表
+        embeddings: 文本块向量 (N, D)，已归一化
+        chunks: 文本块
+        chunk_sources: 每个文本块所属文档的下标
+        embedder_name: 向量化方式，查询时据此选择同样的向量化器
+        ivf_lists: IVF 聚类数，0 表示只做暴力检索
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    np.save(os.path.join(out_dir, "embeddings.npy"), embeddings)
+    
+    encoded = [chunk.encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    with open(os.path.join(out_dir, "chunks.bin"), "wb") as f:
+        for b in encoded:
+            f.write(b)
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+    np.save(os.path.join(out_dir, "source_ids.npy"), np.asarray(chunk_sources, dtype=np.int32))
+    with open(os.path.join(out_dir, "sources.json"), "w", encoding="utf-8") as f:
+        json.dump([path for path, _ in documents], f, ensure_ascii=False)
+    
+    ivf_lists = min(ivf_lists, len(chunks))
+    if ivf_lists > 0:
+        centroids = _kmeans(embeddings, ivf_lists)
+        assign = np.argmax(embeddings @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        ivf_offsets = np.zeros(ivf_lists + 1, dtype=np.int64)
+        ivf_offsets[1:] = np.cumsum(np.bincount(assign, minlength=ivf_lists))
+        np.save(os.path.join(out_dir, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(out_dir, "ivf_order.npy"), order)
+        np.save(os.path.join(out_dir, "ivf_offsets.npy"), ivf_offsets)
+    
+    meta = {
+        "count": len(chunks),
+        "dim": int(embeddings.shape[1]) if len(chunks) else 0,
+        "embedder": embedder_name,
+        "ivf_lists": ivf_lists,
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+class VectorIndex:
+    """只读向量索引，所有数组以 mmap 方式加载"""
+    
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "sources.json"), encoding="utf-8") as f:
+            self.sources: List[str] = json.load(f)
+        
+        self.embeddings = self._load("embeddings.npy")
+        self.offsets = self._load("offsets.npy")
+        self.source_ids = self._load("source_ids.npy")
+        self.chunks = np.memmap(os.path.join(index_dir, "chunks.bin"), dtype=np.uint8, mode="r") \
+            if self.meta["count"] else np.zeros(0, dtype=np.uint8)
+        
+        self.centroids = self.ivf_order = self.ivf_offsets = None
+        if self.meta.get("ivf_lists"):
+            self.centroids = self._load("ivf_centroids.npy")
+            self.ivf_order = self._load("ivf_order.npy")
+            self.ivf_offsets = self._load("ivf_offsets.npy")
+    
+    def _load(self, name: str) -> np.ndarray:
+        # 空文件无法做内存映射，空索引直接读入
+        mmap_mode = "r" if self.meta["count"] else None
+        return np.load(os.path.join(self.index_dir, name), mmap_mode=mmap_mode)
+    
+    def __len__(self) -> int:
+        return self.meta["count"]
+    
+    def text(self, row: int) -> str:
+        """读取第 row 个文本块"""
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return bytes(self.chunks[start:end]).decode("utf-8")
+    
+    def source(self, row: int) -> str:
+        """第 row 个文本块所属的文档"""
+        return self.sources[int(self.source_ids[row])]
+    
+    def search(self, query: np.ndarray, k: int = 4, nprobe: int = 8) -> List[Tuple[int, float]]:
+        """
+        检索与查询向量余弦相似度最高的 k 个文本块
+        
+        Args:
+            query: 归一化后的查询向量 (D,)
+            k: 返回数量
+            nprobe: 使用 IVF 时探查的聚类数
+        
+        Returns:
+            [(文本块编号, 相似度)]，按相似度降序
+        """
+        if len(self) == 0:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        
+        if self.centroids is not None and nprobe < len(self.centroids):
+            probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            candidates = np.concatenate([
+                self.ivf_order[self.ivf_offsets[c]:self.ivf_offsets[c + 1]] for c in probes
+            ])
+            if len(candidates) == 0:
+                return []
+            candidates.sort()
+            scores = self.embeddings[candidates] @ query
+        else:
+            candidates = None
+            scores = self.embeddings @ query
+        
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = candidates[top] if candidates is not None else top
+        return [(int(row), float(scores[i])) for row, i in zip(rows, top)]
+
+
+# 进程内按目录缓存的索引，首次使用时加载
+_INDEXES: Dict[str, VectorIndex] = {}
+
+
+def load_index(index_dir: str) -> VectorIndex:
+    """懒加载并缓存索引"""
+    index_dir = os.path.abspath(index_dir)
+    if index_dir not in _INDEXES:
+        _INDEXES[index_dir] = VectorIndex(index_dir)
+    return _INDEXES[index_dir]
+
+
+class VectorRetriever:
+    """
+    RAG检索器：把查询向量化后在本地索引中检索 top-k 文本块
+    
+    Args:
+        index_dir: 索引目录
+        remote_embed: 远程向量化函数，索引使用远程向量化方式构建时必须提供
+        top_k: 返回的文本块数量
+        nprobe: IVF 探查的聚类数
+    """
+    
+    def __init__(self, index_dir: str, remote_embed: Optional[RemoteEmbedFn] = None, top_k: int = 4, nprobe: int = 8):
+        self.index_dir = index_dir
+        self.remote_embed = remote_embed
+        self.top_k = top_k
+        self.nprobe = nprobe
+        self._embedder = None
+        self.inflight = SingleFlight()
+    
+    @classmethod
+    def from_env(cls, remote_embed: Optional[RemoteEmbedFn] = None) -> Optional["VectorRetriever"]:
+        """RAG_INDEX_DIR 指向已构建的索引时创建检索器，否则返回None"""
+        index_dir = os.getenv("RAG_INDEX_DIR")
+        if not index_dir or not os.path.exists(os.path.join(index_dir, "meta.json")):
+            return None
+        return cls(
+            index_dir,
+            remote_embed,
+            top_k=int(os.getenv("RAG_TOP_K", "4")),
+            nprobe=int(os.getenv("RAG_NPROBE", "8")),
+        )
+    
+    @property
+    def index(self) -> VectorIndex:
+        return load_index(self.index_dir)
+    
+    def _get_embedder(self):
+        if self._embedder is None:
+            meta = self.index.meta
+            if meta["embedder"] == "hashing":
+                self._embedder = HashingEmbedder(meta["dim"])
+            elif self.remote_embed is not None:
+                self._embedder = RemoteEmbedder(self.remote_embed, meta["embedder"])
+            else:
+                raise ValueError(f"索引使用 {meta['embedder']} 构建，需要提供远程向量化函数")
+        return self._embedder
+    
+    async def search(self, query: str) -> List[Dict[str, object]]:
+        """检索与查询最相关的文本块（相同查询的并发调用共享同一次检索）"""
+        return await self.inflight.do(query, lambda: self._search(query))
+    
+    async def _search(self, query: str) -> List[Dict[str, object]]:
+        vector = (await self._get_embedder().embed([query]))[0]
+        index = self.index
+        hits = await asyncio.to_thread(index.search, vector, self.top_k, self.nprobe)
+        return [
+            {"source": index.source(row), "score": round(score, 4), "text": index.text(row)}
+            for row, score in hits
+        ]
+    
+    async def retrieve(self, query: str) -> str:
+        """检索并格式化为带文档引用的文本"""
+        hits = await self.search(query)
+        if not hits:
+            return "未检索到相关文档"
+        return "\n".join(
+            f"【文档引用 {os.path.basename(hit['source'])}】{hit['text']}" for hit in hits
+        )
+
+
+def _iter_documents(paths: List[str]) -> List[Tuple[str, str]]:
+    documents = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(TEXT_SUFFIXES):
+                        documents.extend(_iter_documents([os.path.join(root, name)]))
+        else:
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                documents.append((path, f.read()))
+    return documents
+
+
+async def ingest(
+    paths: List[str],
+    out_dir: str,
+    chunk_size: int = 500,
+    overlap: int = 50,
+    ivf_lists: int = 0,
+    embedder: str = "hashing",
+    dim: int = 512,
+    batch_size: int = 64,
+):
+    """读取文档、切块、向量化并构建索引"""
+    documents = _iter_documents(paths)
+    chunks: List[str] = []
+    chunk_sources: List[int] = []
+    for doc_id, (_, text) in enumerate(documents):
+        for chunk in chunk_text(text, chunk_size, overlap):
+            chunks.append(chunk)
+            chunk_sources.append(doc_id)
+    
+    client = None
+    if embedder == "hashing":
+        encoder = HashingEmbedder(dim)
+    else:
+        from .llm_client import LLMClient
+        client = LLMClient()
+        encoder = RemoteEmbedder(client.embed_many, f"openai:{client.embedding_model}")
+    
+    try:
+        parts = [await encoder.embed(chunks[i:i + batch_size]) for i in range(0, len(chunks), batch_size)]
+    finally:
+        if client is not None:
+            await client.aclose()
+    embeddings = np.concatenate(parts) if parts else np.zeros((0, dim), dtype=np.float32)
+    build_index(out_dir, documents, embeddings, chunks, chunk_sources, encoder.name, ivf_lists)
+    print(f"已索引 {len(documents)} 个文档，共 {len(chunks)} 个文本块 -> {out_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地向量索引工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    ingest_parser = sub.add_parser("ingest", help="构建索引")
+    ingest_parser.add_argument("paths", nargs="+", help="文档文件或目录")
+    ingest_parser.add_argument("--out", required=True, help="索引输出目录")
+    ingest_parser.add_argument("--chunk-size", type=int, default=500)
+    ingest_parser.add_argument("--overlap", type=int, default=50)
+    ingest_parser.add_argument("--ivf-lists", type=int, default=0, help="IVF 聚类数，语料较大时建议约为 sqrt(N)")
+    ingest_parser.add_argument("--embedder", choices=["hashing", "openai"], default="hashing")
+    ingest_parser.add_argument("--dim", type=int, default=512, help="hashing 向量维度")
+    
+    query_parser = sub.add_parser("query", help="查询索引")
+    query_parser.add_argument("index_dir")
+    query_parser.add_argument("query")
+    query_parser.add_argument("--top-k", type=int, default=4)
+    query_parser.add_argument("--nprobe", type=int, default=8)
+    
+    args = parser.parse_args()
+    if args.command == "ingest":
+        if not 0 <= args.overlap < args.chunk_size:
+            parser.error("--overlap 必须满足 0 <= overlap < chunk-size")
+        asyncio.run(ingest(
+            args.paths, args.out, args.chunk_size, args.overlap,
+            args.ivf_lists, args.embedder, args.dim,
+        ))
+    else:
+        asyncio.run(_query(args.index_dir, args.query, args.top_k, args.nprobe))
+
+
+async def _query(index_dir: str, query: str, top_k: int, nprobe: int):
+    client = None
+    if load_index(index_dir).meta["embedder"] != "hashing":
+        from .llm_client import LLMClient
+        client = LLMClient()
+    retriever = VectorRetriever(index_dir, client.embed_many if client else None, top_k, nprobe)
+    try:
+        for hit in await retriever.search(query):
+            print(f"[{hit['score']}] {hit['source']}: {hit['text'][:100]}")
+    finally:
+        if client is not None:
+            await client.aclose()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
+from dataclasses import dataclass
 from enum import Enum
-from typing import List, Dict, Any, Optional
-from pydantic import BaseModel
+from typing import List, Dict, Any, FrozenSet, Optional, Tuple, Union
+from typing_extensions import Annotated, TypedDict
 
 
 class TaskTool(str, Enum):
@@ -9,10 +10,136 @@ class TaskTool(str, Enum):
     Final_Synthesis = 'Final_Synthesis'
 
 
-class AgentState(BaseModel):
-    """Agent状态定义 - LangGraph的状态"""
-    query: str  # 用户查询
-    tasks: List[Dict] = []  # 任务列表
-    results: Dict[int, Any] = {}  # 任务执行结果
-    final_answer: Optional[str] = None  # 最终答案
-    current_step: str = "planning"  # 当前步骤
+# 由工具Agent执行的工具类型
+TOOL_TYPES = (TaskTool.Text2SQL.value, TaskTool.RAG.value)
+
+
+@dataclass(frozen=True, slots=True)
+class TaskRecord:
+    """计划中的一个任务（不可变，可在状态和检查点中直接共享）"""
+    id: int
+    tool: str
+    description: str = ""
+    sub_query: str = ""
+    dependencies: Tuple[int, ...] = ()
+    
+    @classmethod
+    def from_dict(cls, task: Dict[str, Any]) -> "TaskRecord":
+        """从规划LLM输出的任务字典创建，tool 不合法时抛出 ValueError"""
+        tool = TaskTool(task.get("tool")).value
+        return cls(
+            id=int(task["id"]),
+            tool=tool,
+            description=str(task.get("description", "")),
+            sub_query=str(task.get("subQuery", "")),
+            dependencies=tuple(int(dep) for dep in task.get("dependencies") or ()),
+        )
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为与规划输出相同字段名的字典"""
+        return {
+            "id": self.id,
+            "tool": self.tool,
+            "description": self.description,
+            "subQuery": self.sub_query,
+            "dependencies": list(self.dependencies),
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class TaskResult:
+    """一个任务的执行结果"""
+    task_id: int
+    tool: str
+    result: Any
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {"task_id": self.task_id, "tool": self.tool, "result": self.result}
+
+
+@dataclass(frozen=True, slots=True)
+class Plan:
+    """执行计划：任务按输出顺序保存，并按工具类型建立索引"""
+    tasks: Tuple[TaskRecord, ...]
+    by_tool: Dict[str, Tuple[TaskRecord, ...]]
+    
+    @classmethod
+    def from_dicts(cls, tasks: List[Dict[str, Any]]) -> "Plan":
+        """从规划LLM输出的任务列表创建，只遍历一次"""
+        records = tuple(TaskRecord.from_dict(task) for task in tasks)
+        by_tool: Dict[str, List[TaskRecord]] = {}
+        for record in records:
+            by_tool.setdefault(record.tool, []).append(record)
+        return cls(records, {tool: tuple(group) for tool, group in by_tool.items()})
+    
+    def of(self, tool: str) -> Tuple[TaskRecord, ...]:
+        """某一工具类型的全部任务"""
+        return self.by_tool.get(tool, ())
+    
+    def has(self, tool: str) -> bool:
+        return tool in self.by_tool
+    
+    def pending(self, results: Dict[int, TaskResult]) -> Dict[str, FrozenSet[int]]:
+        """按工具分组的待执行任务ID（已有结果的任务除外，如从检查点恢复时）"""
+        pending: Dict[str, FrozenSet[int]] = {}
+        for tool in TOOL_TYPES:
+            ids = frozenset(task.id for task in self.of(tool) if task.id not in results)
+            if ids:
+                pending[tool] = ids
+        return pending
+    
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return [task.to_dict() for task in self.tasks]
+
+
+@dataclass(frozen=True, slots=True)
+class TasksDone:
+    """工具Agent对 pending 的更新：某一工具类型的这些任务已完成"""
+    tool: str
+    task_ids: FrozenSet[int]
+
+
+def merge_results(left: Optional[Dict[int, TaskResult]], right: Optional[Dict[int, TaskResult]]) -> Dict[int, TaskResult]:
+    """results 字段的归并函数 - 合并并行分支各自写入的任务结果，一侧为空时直接复用另一侧"""
+    if not left:
+        return right or {}
+    if not right:
+        return left
+    merged = dict(left)
+    merged.update(right)
+    return merged
+
+
+def settle_pending(
+    left: Optional[Dict[str, FrozenSet[int]]],
+    right: Union[Dict[str, FrozenSet[int]], TasksDone],
+) -> Dict[str, FrozenSet[int]]:
+    """
+    pending 字段的归并函数
+    
+    规划Agent写入完整的待执行集合（替换）；工具Agent写入 TasksDone，
+    只从对应工具的集合中移除已完成的任务，并行分支互不影响
+    """
+    if not isinstance(right, TasksDone):
+        return right or {}
+    left = left or {}
+    remaining = left.get(right.tool, frozenset()) - right.task_ids
+    merged = {tool: ids for tool, ids in left.items() if tool != right.tool}
+    if remaining:
+        merged[right.tool] = remaining
+    return merged
+
+
+class GraphState(TypedDict, total=False):
+    """
+    LangGraph图的状态结构
+    
+    plan 在规划完成后不再变化；results 与 pending 通过归并函数支持多个分支并行写入，
+    路由时按工具查询 pending 即可判断是否还有待执行的任务
+    """
+    query: str
+    plan: Optional[Plan]
+    results: Annotated[Dict[int, TaskResult], merge_results]
+    pending: Annotated[Dict[str, FrozenSet[int]], settle_pending]
+    final_answer: Optional[str]
+    current_step: str
@@ -1,47 +1,247 @@
 """
 Agent节点定义 - 每个Agent负责不同的任务
 """
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, AsyncIterator, List, Callable, Awaitable, Optional, Tuple, Union
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableConfig
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+import asyncio
 import os
-import json
+import time
+
+from AgentPlannerServer.context_packer import ContextPacker, count_tokens
+from AgentPlannerServer.model_router import Route, get_router
+from AgentPlannerServer.plan_repair import MAX_REASKS, reask_prompt, repair_plan_text
+from AgentPlannerServer.plan_stream import IncrementalTaskParser
+from AgentPlannerServer.text2sql import Text2SQLExecutor, TEXT2SQL_SYSTEM_PROMPT, build_text2sql_prompt
+from AgentPlannerServer.tracing import current_span, get_tracer
+from AgentPlannerServer.vector_index import VectorRetriever
+
+from .agent_types import Plan, TaskRecord, TaskResult, TasksDone, TaskTool
 
 
 # 模拟数据（实际应该从数据库/文档检索）
 MOCK_DATA = {
-    "SQL": {
-        "result": [
-            {"region": "华东区", "product": "旗舰系列手机", "growth": "-28.4%", "impact": "High"},
-            {"region": "华东区", "product": "智能穿戴", "growth": "-12.1%", "impact": "Mid"},
-            {"region": "华中区", "product": "旗舰系列手机", "growth": "-5.2%", "impact": "Low"}
-        ]
-    },
     "RAG": {
         "result": "【文档引用】由于 Q3 期间华东大区启动'合作伙伴优化计划'，导致 35% 的核心分销商处于合同重签期，部分门店出现 2-3 周的断货。同时，上海物流中心升级导致旗舰系列周转率下降。"
     }
 }
 
+# 单个Agent内部并发执行任务的上限
+TASK_CONCURRENCY = int(os.getenv("AGENT_TASK_CONCURRENCY", "4"))
+
+# 工具类型与对应的图节点
+_TOOL_NODES = ((TaskTool.Text2SQL.value, "text2sql"), (TaskTool.RAG.value, "rag"))
+
+# 规划阶段已提前启动的工具调用：运行ID -> {(工具, 子查询): asyncio.Task}
+# 只由同一次运行的工具Agent取用，运行结束（完成、失败或被取消）时由 discard_early_runs 清除
+_early_runs: Dict[str, Dict[Tuple[str, str], asyncio.Task]] = {}
+
 
-def get_llm():
-    """获取LangChain的LLM实例"""
+async def _run_bounded(
+    tasks: List[TaskRecord],
+    worker: Callable[[TaskRecord], Awaitable[TaskResult]],
+) -> Dict[int, TaskResult]:
+    """以有限并发度执行一组任务，返回 {task_id: 结果} 字典"""
+    semaphore = asyncio.Semaphore(TASK_CONCURRENCY)
+    
+    async def run_one(task: TaskRecord) -> TaskResult:
+        async with semaphore:
+            return await worker(task)
+    
+    outputs = await asyncio.gather(*[run_one(task) for task in tasks])
+    return {output.task_id: output for output in outputs}
+
+
+@lru_cache(maxsize=None)
+def get_llm(model: Optional[str] = None):
+    """
+    获取LangChain的LLM实例
+    
+    每个模型一个实例，在进程内缓存复用，ChatOpenAI 可安全地被并发的 ainvoke 共享
+    
+    Args:
+        model: 模型名称，为空时使用模型路由器的默认模型
+    """
     api_key = os.getenv("OPENAI_API_KEY", "")
     base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
     
     return ChatOpenAI(
-        model="gpt-3.5-turbo",
+        model=model or get_router().default_model,
         temperature=0.2,
         openai_api_key=api_key,
         openai_api_base=base_url,
     )
 
 
-async def planner_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+def record_usage(usage: Optional[Dict[str, int]]):
+    """把LLM返回的token用量累加到当前节点的 span 和 token 计数指标上"""
+    if not usage:
+        return
+    tracer = get_tracer()
+    span = current_span()
+    for key, kind in (("input_tokens", "prompt"), ("output_tokens", "completion")):
+        tokens = usage.get(key, 0)
+        tracer.count("llm_tokens_total", tokens, kind=kind)
+        if span is not None:
+            span.set(f"{kind}_tokens", span.attributes.get(f"{kind}_tokens", 0) + tokens)
+
+
+def _select_model(route: str, messages: List[Any]) -> str:
+    return get_router().select(route, sum(count_tokens(message.content) for message in messages))
+
+
+def _record_route(route: str, model: str, latency: float, usage: Optional[Dict[str, int]], error: bool = False):
+    """记录一次路由调用的延迟和 token 用量"""
+    usage = usage or {}
+    get_router().record(route, model, latency, usage.get("input_tokens", 0), usage.get("output_tokens", 0), error)
+    get_tracer().count("llm_route_calls_total", route=route, model=model)
+
+
+async def invoke_routed(route: str, messages: List[Any]) -> Any:
+    """按调用点选择模型并调用LLM，记录路由统计和 token 用量"""
+    model = _select_model(route, messages)
+    started = time.perf_counter()
+    try:
+        response = await get_llm(model).ainvoke(messages)
+    except Exception:
+        _record_route(route, model, time.perf_counter() - started, None, error=True)
+        raise
+    record_usage(response.usage_metadata)
+    _record_route(route, model, time.perf_counter() - started, response.usage_metadata)
+    return response
+
+
+async def stream_routed(route: str, messages: List[Any]) -> AsyncIterator[Any]:
+    """
+    按调用点选择模型并流式调用LLM，路由延迟按首个片段的时间记录
+    
+    流式响应不返回 usage 时按文本估算 token 数
+    """
+    model = _select_model(route, messages)
+    started = time.perf_counter()
+    ttft = None
+    parts = []
+    usage: Dict[str, int] = {}
+    try:
+        async for chunk in get_llm(model).astream(messages):
+            if ttft is None:
+                ttft = time.perf_counter() - started
+            parts.append(chunk.content)
+            for key in ("input_tokens", "output_tokens"):
+                usage[key] = usage.get(key, 0) + (chunk.usage_metadata or {}).get(key, 0)
+            yield chunk
+    except Exception:
+        _record_route(route, model, time.perf_counter() - started, usage, error=True)
+        raise
+    if not any(usage.values()):
+        usage = {
+            "input_tokens": sum(count_tokens(message.content) for message in messages),
+            "output_tokens": count_tokens("".join(parts)),
+        }
+    record_usage(usage)
+    _record_route(route, model, ttft if ttft is not None else time.perf_counter() - started, usage)
+
+
+@lru_cache(maxsize=None)
+def get_text2sql_executor() -> Text2SQLExecutor:
+    """获取进程内共享的Text2SQL执行器（与AgentPlannerServer共用同一套实现）"""
+    async def generate_sql(question: str, schema: str) -> str:
+        response = await invoke_routed(Route.TEXT2SQL, [
+            SystemMessage(content=TEXT2SQL_SYSTEM_PROMPT),
+            HumanMessage(content=build_text2sql_prompt(question, schema))
+        ])
+        return response.content
+    
+    return Text2SQLExecutor.from_env(generate_sql)
+
+
+@lru_cache(maxsize=None)
+def get_context_packer() -> ContextPacker:
+    """获取进程内共享的合成上下文压缩器（压缩结果缓存在多次请求间复用）"""
+    return ContextPacker.from_env()
+
+
+@lru_cache(maxsize=None)
+def get_embeddings() -> OpenAIEmbeddings:
+    """获取LangChain的向量化实例（仅在索引使用远程向量化方式构建时需要）"""
+    return OpenAIEmbeddings(
+        model=os.getenv("LLM_EMBEDDING_MODEL", "text-embedding-3-small"),
+        openai_api_key=os.getenv("OPENAI_API_KEY", ""),
+        openai_api_base=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_vector_retriever() -> Optional[VectorRetriever]:
+    """获取进程内共享的向量检索器，未配置 RAG_INDEX_DIR 时返回None"""
+    async def embed(texts: List[str]) -> List[List[float]]:
+        return await get_embeddings().aembed_documents(texts)
+    
+    return VectorRetriever.from_env(embed)
+
+
+async def _run_tool(tool: str, sub_query: str) -> Any:
+    """执行一次工具调用，未配置本地索引时RAG返回模拟数据"""
+    if tool == "Text2SQL":
+        return await get_text2sql_executor().run(sub_query)
+    retriever = get_vector_retriever()
+    if retriever is None:
+        return MOCK_DATA["RAG"]["result"]
+    return await retriever.retrieve(sub_query)
+
+
+def run_id_of(config: Optional[RunnableConfig]) -> Optional[str]:
+    """节点配置中的运行ID（即检查点的 thread_id）"""
+    return ((config or {}).get("configurable") or {}).get("thread_id")
+
+
+def _start_early(run_id: str, task: Dict) -> Tuple[str, str]:
+    """在规划阶段提前启动一个无依赖的工具任务"""
+    key = (task.get("tool"), task.get("subQuery", ""))
+    runs = _early_runs.setdefault(run_id, {})
+    if key not in runs:
+        runs[key] = asyncio.create_task(_run_tool(*key))
+    return key
+
+
+def _cancel_early(run_id: str, keys: List[Tuple[str, str]]):
+    """取消本次运行中不会再被取用的提前调用"""
+    runs = _early_runs.get(run_id, {})
+    for key in keys:
+        runner = runs.pop(key, None)
+        if runner is not None:
+            runner.cancel()
+
+
+def discard_early_runs(run_id: str):
+    """取消并清除一次运行剩余的提前调用，在运行结束（包括失败和被取消）时调用"""
+    for runner in _early_runs.pop(run_id, {}).values():
+        if not runner.done():
+            runner.cancel()
+        elif not runner.cancelled():
+            # 取出异常，避免 "exception was never retrieved" 警告
+            runner.exception()
+
+
+async def _tool_result(run_id: Optional[str], task: TaskRecord) -> Any:
+    """取用本次运行在规划阶段提前启动的调用结果，没有时现在执行"""
+    early = _early_runs.get(run_id, {}).pop((task.tool, task.sub_query), None)
+    if early is not None:
+        return await early
+    return await _run_tool(task.tool, task.sub_query)
+
+
+async def planner_agent(state: Dict[str, Any], config: Optional[RunnableConfig] = None) -> Dict[str, Any]:
     """
     规划Agent - 将用户查询拆解为任务列表
+    
+    流式接收LLM输出并增量解析，每个无依赖的工具任务一输出完整就提前开始执行，
+    工具Agent随后直接取用其结果。输出不合法时先在本地修复，无法修复时才重新请求LLM
     """
     query = state.get("query", "")
-    llm = get_llm()
+    run_id = run_id_of(config)
     
     system_prompt = """你是一个数据分析专家。请将用户请求拆解为任务列表。
 
@@ -69,96 +269,117 @@ JSON Schema:
         HumanMessage(content=f"用户查询: {query}")
     ]
     
-    response = await llm.ainvoke(messages)
-    response_text = response.content
-    
+    parser = IncrementalTaskParser()
+    started = []
     try:
-        plan_dict = json.loads(response_text)
-        tasks = plan_dict.get("tasks", [])
+        async for chunk in stream_routed(Route.PLANNER, messages):
+            for task in parser.feed(chunk.content):
+                if run_id and task.get("tool") in ("Text2SQL", "RAG") and not task.get("dependencies"):
+                    started.append(_start_early(run_id, task))
+        
+        repaired, repairs = repair_plan_text(parser.text, query)
+        for _ in range(MAX_REASKS):
+            if repaired is not None:
+                break
+            get_tracer().count("plan_repairs_total", kind="reask")
+            response = await invoke_routed(Route.PLANNER, [
+                SystemMessage(content=system_prompt),
+                HumanMessage(content=reask_prompt(query, parser.text)),
+            ])
+            repaired, repairs = repair_plan_text(response.content, query)
+        if repaired is None:
+            raise ValueError("规划输出无法修复")
+        for kind in set(repairs):
+            get_tracer().count("plan_repairs_total", kind=kind)
+        
+        plan = Plan.from_dicts([task.model_dump(mode="json") for task in repaired.tasks])
+        # 修复改动了子查询的任务不会再被取用，取消其提前启动的调用
+        keep = {(task.tool, task.sub_query) for task in plan.tasks}
+        _cancel_early(run_id, [key for key in started if key not in keep])
         
         return {
-            "tasks": tasks,
+            "plan": plan,
+            "pending": plan.pending(state.get("results") or {}),
             "current_step": "execution"
         }
     except Exception as e:
         print(f"规划Agent失败: {e}")
+        _cancel_early(run_id, started)
         return {
-            "tasks": [],
+            "plan": None,
             "current_step": "error"
         }
 
 
-async def text2sql_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+async def _run_tool_agent(
+    state: Dict[str, Any],
+    tool: str,
+    run: Callable[[TaskRecord], Awaitable[TaskResult]],
+) -> Dict[str, Any]:
+    """执行某一工具类型的所有待执行任务，返回本分支新增的结果和对 pending 的更新"""
+    plan: Plan = state["plan"]
+    pending = state.get("pending", {}).get(tool, frozenset())
+    tasks = [task for task in plan.of(tool) if task.id in pending]
+    
+    # 只返回本分支新增的结果，由状态归并函数与其他分支合并
+    return {
+        "results": await _run_bounded(tasks, run),
+        "pending": TasksDone(tool, pending),
+    }
+
+
+async def text2sql_agent(state: Dict[str, Any], config: Optional[RunnableConfig] = None) -> Dict[str, Any]:
     """
-    Text2SQL Agent - 执行SQL查询任务
+    Text2SQL Agent - 并发执行SQL查询任务
     """
-    tasks = state.get("tasks", [])
-    results = state.get("results", {})
+    run_id = run_id_of(config)
     
-    # 找到所有Text2SQL任务
-    sql_tasks = [task for task in tasks if task.get("tool") == "Text2SQL"]
+    async def run_sql(task: TaskRecord) -> TaskResult:
+        try:
+            result = await _tool_result(run_id, task)
+            print(f"✅ Text2SQL Agent 完成任务 {task.id}: {len(result)} 条记录")
+        except Exception as e:
+            print(f"Text2SQL Agent 任务 {task.id} 失败: {e}")
+            result = f"任务执行失败: {e}"
+        return TaskResult(task.id, TaskTool.Text2SQL.value, result)
     
-    for task in sql_tasks:
-        task_id = task.get("id")
-        if task_id not in results:
-            # 模拟SQL执行（实际应该连接到数据库）
-            result = MOCK_DATA["SQL"]["result"]
-            results[task_id] = {
-                "task_id": task_id,
-                "tool": "Text2SQL",
-                "result": result
-            }
-            print(f"✅ Text2SQL Agent 完成任务 {task_id}: {len(result)} 条记录")
-    
-    return {"results": results}
+    return await _run_tool_agent(state, TaskTool.Text2SQL.value, run_sql)
 
 
-async def rag_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+async def rag_agent(state: Dict[str, Any], config: Optional[RunnableConfig] = None) -> Dict[str, Any]:
     """
-    RAG Agent - 执行文档检索任务
+    RAG Agent - 并发执行文档检索任务
     """
-    tasks = state.get("tasks", [])
-    results = state.get("results", {})
+    run_id = run_id_of(config)
     
-    # 找到所有RAG任务
-    rag_tasks = [task for task in tasks if task.get("tool") == "RAG"]
+    async def run_rag(task: TaskRecord) -> TaskResult:
+        try:
+            result = await _tool_result(run_id, task)
+        except Exception as e:
+            print(f"RAG Agent 任务 {task.id} 失败: {e}")
+            result = f"任务执行失败: {e}"
+        print(f"✅ RAG Agent 完成任务 {task.id}: {len(result)} 字符")
+        return TaskResult(task.id, TaskTool.RAG.value, result)
     
-    for task in rag_tasks:
-        task_id = task.get("id")
-        if task_id not in results:
-            # 模拟RAG检索（实际应该连接到向量数据库）
-            result = MOCK_DATA["RAG"]["result"]
-            results[task_id] = {
-                "task_id": task_id,
-                "tool": "RAG",
-                "result": result
-            }
-            print(f"✅ RAG Agent 完成任务 {task_id}: {len(result)} 字符")
-    
-    return {"results": results}
+    return await _run_tool_agent(state, TaskTool.RAG.value, run_rag)
 
 
-async def synthesis_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+async def synthesis_agent(state: Dict[str, Any], config: Optional[RunnableConfig] = None) -> Dict[str, Any]:
     """
     综合Agent - 聚合所有结果并生成最终答案
     """
     query = state.get("query", "")
-    tasks = state.get("tasks", [])
+    plan: Plan = state["plan"]
     results = state.get("results", {})
     
-    llm = get_llm()
-    
-    # 构建所有结果文本
+    # 构建所有结果文本（按 token 预算压缩大结果），按计划中的任务顺序排列
     all_results = []
-    for task in tasks:
-        task_id = task.get("id")
-        if task_id in results:
-            result_info = results[task_id]
-            all_results.append(
-                f"任务 {task_id} ({result_info['tool']}): {result_info['result']}"
-            )
+    for task in plan.tasks:
+        result = results.get(task.id)
+        if result is not None:
+            all_results.append((f"任务 {task.id} ({result.tool})", result.result))
     
-    results_text = "\n".join(all_results)
+    results_text = get_context_packer().pack(query, all_results)
     
     system_prompt = "你是一个深度的业务逻辑分析师。请结合数据结果和文档背景，输出一份客观、详尽的分析报告。"
     
@@ -174,7 +395,7 @@ async def synthesis_agent(state: Dict[str, Any]) -> Dict[str, Any]:
         HumanMessage(content=prompt)
     ]
     
-    response = await llm.ainvoke(messages)
+    response = await invoke_routed(Route.SYNTHESIS, messages)
     final_answer = response.content
     
     return {
@@ -183,36 +404,36 @@ async def synthesis_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def should_continue(state: Dict[str, Any]) -> str:
+def should_continue(state: Dict[str, Any]) -> Union[str, List[str]]:
     """
-    路由函数 - 决定下一步执行哪个Agent
+    路由函数 - 决定下一步执行哪些Agent
+    
+    规划完成后，Text2SQL 与 RAG 两个互不依赖的分支同时扇出执行；
+    没有工具任务时直接进入综合或结束。每个分支只需查询一次 pending，与计划规模无关。
     """
     current_step = state.get("current_step", "planning")
-    tasks = state.get("tasks", [])
-    results = state.get("results", {})
     
     if current_step == "planning":
         return "planner"
     elif current_step == "execution":
-        # 检查是否有未执行的任务
-        sql_tasks = [t for t in tasks if t.get("tool") == "Text2SQL"]
-        rag_tasks = [t for t in tasks if t.get("tool") == "RAG"]
-        synthesis_tasks = [t for t in tasks if t.get("tool") == "Final_Synthesis"]
-        
-        # 检查Text2SQL任务是否完成
-        sql_done = all(t.get("id") in results for t in sql_tasks)
-        # 检查RAG任务是否完成
-        rag_done = all(t.get("id") in results for t in rag_tasks)
+        # 收集仍有未执行任务的分支
+        pending = state.get("pending", {})
+        branches = [node for tool, node in _TOOL_NODES if pending.get(tool)]
         
-        if sql_tasks and not sql_done:
-            return "text2sql"
-        elif rag_tasks and not rag_done:
-            return "rag"
-        elif synthesis_tasks:
-            return "synthesis"
-        else:
-            return "end"
-    elif current_step == "completed":
-        return "end"
+        if branches:
+            return branches
+        return route_to_synthesis(state)
     else:
         return "end"
+
+
+def route_to_synthesis(state: Dict[str, Any]) -> str:
+    """
+    工具分支完成后的路由函数
+    
+    并行分支在同一步内结束，指向 synthesis 的多条边只会触发一次综合
+    """
+    plan: Optional[Plan] = state.get("plan")
+    if plan is not None and plan.has(TaskTool.Final_Synthesis.value):
+        return "synthesis"
+    return "end"
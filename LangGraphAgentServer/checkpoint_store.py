@@ -0,0 +1,347 @@
+"""
+LangGraph 检查点存储 - 每个节点完成后把图状态持久化到本地 SQLite，按运行ID（thread_id）索引
+
+工作进程重启或某个LLM调用超时后，可以从最近的检查点恢复运行：已完成的节点不会重新执行，
+并行分支中已完成的那一个（如 Text2SQL）的写入也会保留，只重跑失败的分支。
+
+- LANGGRAPH_CHECKPOINT_PATH 设置数据库文件，设置后才启用检查点（内存数据库无法跨重启恢复，
+  却要为每个请求付出序列化和内存开销，因此不作为默认值）
+- LANGGRAPH_CHECKPOINT_MAX_RUNS 限制保留的运行数，新运行开始时按最近活动时间删除最早的运行
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+
+# 检查点中会出现的自定义状态类型
+STATE_TYPES = [
+    ("LangGraphAgentServer.agent_types", name)
+    for name in ("TaskRecord", "TaskResult", "Plan", "TasksDone")
+]
+
+
+class SQLiteCheckpointSaver(BaseCheckpointSaver):
+    """
+    基于 SQLite 的检查点存储，每个检查点保存完整的通道值
+    
+    Args:
+        path: 数据库文件路径，":memory:" 表示内存数据库（仅用于测试，无法跨重启恢复）
+        max_runs: 最多保留的运行数，0 表示不限制
+    """
+    
+    def __init__(self, path: str = ":memory:", max_runs: int = 1000):
+        # 图状态中的任务记录类型需显式允许反序列化
+        super().__init__(serde=JsonPlusSerializer(allowed_msgpack_modules=STATE_TYPES))
+        self.path = path
+        self.max_runs = max_runs
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL DEFAULT '',"
+            " checkpoint_id TEXT NOT NULL,"
+            " parent_checkpoint_id TEXT,"
+            " type TEXT,"
+            " checkpoint BLOB,"
+            " metadata_type TEXT,"
+            " metadata BLOB,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS writes ("
+            " thread_id TEXT NOT NULL,"
+            " checkpoint_ns TEXT NOT NULL DEFAULT '',"
+            " checkpoint_id TEXT NOT NULL,"
+            " task_id TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " channel TEXT NOT NULL,"
+            " type TEXT,"
+            " value BLOB,"
+            " task_path TEXT NOT NULL DEFAULT '',"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))"
+        )
+        # 每次运行一行，按最近活动时间索引，清理时无需扫描检查点表
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " thread_id TEXT PRIMARY KEY,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS runs_updated_at ON runs (updated_at)")
+        # 兼容没有 runs 表的旧数据库
+        self._conn.execute(
+            "INSERT OR IGNORE INTO runs (thread_id, updated_at)"
+            " SELECT thread_id, MAX(created_at) FROM checkpoints GROUP BY thread_id"
+        )
+        self._conn.commit()
+    
+    @classmethod
+    def from_env(cls) -> Optional["SQLiteCheckpointSaver"]:
+        """根据环境变量创建检查点存储，未设置 LANGGRAPH_CHECKPOINT_PATH 或 LANGGRAPH_CHECKPOINT_ENABLED=0 时返回None"""
+        path = os.getenv("LANGGRAPH_CHECKPOINT_PATH")
+        if not path or os.getenv("LANGGRAPH_CHECKPOINT_ENABLED", "1") == "0":
+            return None
+        return cls(
+            path=path,
+            max_runs=int(os.getenv("LANGGRAPH_CHECKPOINT_MAX_RUNS", "1000")),
+        )
+    
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """读取指定检查点；config 中没有 checkpoint_id 时读取该运行最新的检查点"""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        with self._lock:
+            if checkpoint_id:
+                row = self._conn.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+                    " FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+                    " FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+                    " ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+            if row is None:
+                return None
+            return self._to_tuple(thread_id, checkpoint_ns, row)
+    
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        """按时间倒序列出检查点"""
+        sql = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint,"
+            " metadata_type, metadata FROM checkpoints"
+        )
+        clauses, params = [], []
+        if config is not None:
+            clauses.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            checkpoint_ns = config["configurable"].get("checkpoint_ns")
+            if checkpoint_ns is not None:
+                clauses.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+        if before is not None:
+            clauses.append("checkpoint_id < ?")
+            params.append(get_checkpoint_id(before))
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY checkpoint_id DESC"
+        
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            tuples = [self._to_tuple(row[0], row[1], row[2:]) for row in rows]
+        
+        count = 0
+        for checkpoint_tuple in tuples:
+            if filter and any(checkpoint_tuple.metadata.get(key) != value for key, value in filter.items()):
+                continue
+            yield checkpoint_tuple
+            count += 1
+            if limit is not None and count >= limit:
+                return
+    
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        """保存一个检查点，返回指向它的 config"""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_checkpoint_id = config["configurable"].get("checkpoint_id")
+        checkpoint_type, checkpoint_blob = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        now = time.time()
+        with self._lock:
+            if parent_checkpoint_id is None and self.max_runs > 0:
+                self._prune(thread_id)
+            self._conn.execute(
+                "INSERT INTO runs (thread_id, updated_at) VALUES (?, ?)"
+                " ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (thread_id, now),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,"
+                " type, checkpoint, metadata_type, metadata, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id, checkpoint_ns, checkpoint["id"], parent_checkpoint_id,
+                    checkpoint_type, checkpoint_blob, metadata_type, metadata_blob, now,
+                ),
+            )
+            self._conn.commit()
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+    
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        """保存某个节点在当前检查点之后产生的写入（并行分支中先完成的分支由此得以保留）"""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            value_type, value_blob = self.serde.dumps_typed(value)
+            rows.append((
+                thread_id, checkpoint_ns, checkpoint_id, task_id,
+                WRITES_IDX_MAP.get(channel, idx), channel, value_type, value_blob, task_path,
+            ))
+        # 特殊通道（错误、中断）可以覆盖，普通写入只保留第一次
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        with self._lock:
+            self._conn.executemany(
+                f"{verb} INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel,"
+                " type, value, task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+    
+    def delete_thread(self, thread_id: str) -> None:
+        """删除一次运行的所有检查点和写入"""
+        with self._lock:
+            self._delete(thread_id)
+            self._conn.commit()
+    
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+    
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+    
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+    
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+    
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+    
+    def stats(self) -> Dict[str, Any]:
+        """检查点统计：保留的运行数和检查点数"""
+        with self._lock:
+            runs, checkpoints = self._conn.execute(
+                "SELECT COUNT(DISTINCT thread_id), COUNT(*) FROM checkpoints"
+            ).fetchone()
+        return {"path": self.path, "max_runs": self.max_runs, "runs": runs, "checkpoints": checkpoints}
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, row: Sequence[Any]) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint_blob, metadata_type, metadata_blob = row
+        writes = self._conn.execute(
+            "SELECT task_id, channel, type, value FROM writes"
+            " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint=self.serde.loads_typed((checkpoint_type, checkpoint_blob)),
+            metadata=self.serde.loads_typed((metadata_type, metadata_blob)),
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_checkpoint_id,
+                    }
+                }
+                if parent_checkpoint_id
+                else None
+            ),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((value_type, value)))
+                for task_id, channel, value_type, value in writes
+            ],
+        )
+    
+    def _prune(self, thread_id: str):
+        """新运行开始前按 runs 表的时间索引删除最早的运行，使保留的运行数不超过 max_runs"""
+        if self._conn.execute("SELECT 1 FROM runs WHERE thread_id = ?", (thread_id,)).fetchone():
+            # 恢复已有的运行，不增加运行数
+            return
+        (runs,) = self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()
+        if runs < self.max_runs:
+            return
+        stale = self._conn.execute(
+            "SELECT thread_id FROM runs ORDER BY updated_at LIMIT ?",
+            (runs - self.max_runs + 1,),
+        ).fetchall()
+        for (stale_id,) in stale:
+            self._delete(stale_id)
+    
+    def _delete(self, thread_id: str):
+        self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+        self._conn.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+        self._conn.execute("DELETE FROM runs WHERE thread_id = ?", (thread_id,))
@@ -1,7 +1,10 @@
 """
 LangGraph图构建 - 定义Agent之间的执行流程
 """
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple, Callable, Awaitable, AsyncIterator
+import uuid
+
+from langchain_core.runnables import RunnableConfig
 
 # LangGraph导入（根据版本可能有不同的导入路径）
 try:
@@ -14,37 +17,90 @@ except ImportError:
         StateGraph = None
         END = None
 
-from .agents import planner_agent, text2sql_agent, rag_agent, synthesis_agent, should_continue
+from .agents import (
+    planner_agent, text2sql_agent, rag_agent, synthesis_agent,
+    should_continue, route_to_synthesis, get_llm, get_text2sql_executor, get_vector_retriever,
+    discard_early_runs,
+)
+from .agent_types import GraphState
+from .checkpoint_store import SQLiteCheckpointSaver
+from AgentPlannerServer.tracing import get_tracer
+
+
+# 进程内缓存的已编译图，编译后的图是无状态的，可被并发的 ainvoke 共享
+_compiled_graph: Optional[Tuple[Any, Callable[[str], Dict[str, Any]]]] = None
+
+# 进程内共享的检查点存储（未设置 LANGGRAPH_CHECKPOINT_PATH 时为 None）
+_checkpointer: Optional[SQLiteCheckpointSaver] = None
+_checkpointer_loaded = False
+
+
+def create_initial_state(query: str) -> Dict[str, Any]:
+    """创建一次运行的初始状态"""
+    return {
+        "query": query,
+        "plan": None,
+        "results": {},
+        "pending": {},
+        "final_answer": None,
+        "current_step": "planning"
+    }
+
+
+def traced_node(
+    name: str,
+    agent: Callable[[Dict[str, Any], RunnableConfig], Awaitable[Dict[str, Any]]],
+) -> Callable[[Dict[str, Any], RunnableConfig], Awaitable[Dict[str, Any]]]:
+    """为节点记录一个 node.<name> span，节点内的LLM调用和工具任务挂在其下；运行配置原样传给Agent"""
+    async def node(state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        with get_tracer().span(f"node.{name}"):
+            return await agent(state, config)
+    
+    node.__name__ = agent.__name__
+    return node
+
+
+def get_checkpointer() -> Optional[SQLiteCheckpointSaver]:
+    """获取进程内共享的检查点存储，首次调用时按环境变量创建"""
+    global _checkpointer, _checkpointer_loaded
+    if not _checkpointer_loaded:
+        _checkpointer = SQLiteCheckpointSaver.from_env()
+        _checkpointer_loaded = True
+    return _checkpointer
+
+
+def new_run_id() -> str:
+    """生成运行ID（即检查点的 thread_id）"""
+    return uuid.uuid4().hex
+
 
+def _run_config(run_id: str) -> Dict[str, Any]:
+    return {"configurable": {"thread_id": run_id}}
 
-def build_agent_graph():
+
+def build_agent_graph(checkpointer: Optional[SQLiteCheckpointSaver] = None):
     """
     构建多Agent执行图
     
     流程:
-    planner -> text2sql -> rag -> synthesis -> END
+    planner -> (text2sql || rag) -> synthesis -> END
+    
+    Text2SQL 与 RAG 分支并行执行，results 由状态归并函数合并
+    
+    Args:
+        checkpointer: 可选的检查点存储，每个节点完成后保存状态，运行可按运行ID恢复
     """
     if StateGraph is None:
         raise ImportError("请安装langgraph: pip install langgraph")
     
-    # 定义状态结构
-    def create_initial_state(query: str) -> Dict[str, Any]:
-        return {
-            "query": query,
-            "tasks": [],
-            "results": {},
-            "final_answer": None,
-            "current_step": "planning"
-        }
-    
     # 创建状态图
-    workflow = StateGraph(Dict[str, Any])
+    workflow = StateGraph(GraphState)
     
     # 添加节点（每个Agent）
-    workflow.add_node("planner", planner_agent)
-    workflow.add_node("text2sql", text2sql_agent)
-    workflow.add_node("rag", rag_agent)
-    workflow.add_node("synthesis", synthesis_agent)
+    workflow.add_node("planner", traced_node("planner", planner_agent))
+    workflow.add_node("text2sql", traced_node("text2sql", text2sql_agent))
+    workflow.add_node("rag", traced_node("rag", rag_agent))
+    workflow.add_node("synthesis", traced_node("synthesis", synthesis_agent))
     
     # 设置入口点
     workflow.set_entry_point("planner")
@@ -61,48 +117,150 @@ def build_agent_graph():
         }
     )
     
-    workflow.add_conditional_edges(
-        "text2sql",
-        should_continue,
-        {
-            "rag": "rag",
-            "synthesis": "synthesis",
-            "end": END
-        }
-    )
-    
-    workflow.add_conditional_edges(
-        "rag",
-        should_continue,
-        {
-            "synthesis": "synthesis",
-            "end": END
-        }
-    )
+    # 两个工具分支完成后汇合到综合节点
+    for branch in ("text2sql", "rag"):
+        workflow.add_conditional_edges(
+            branch,
+            route_to_synthesis,
+            {
+                "synthesis": "synthesis",
+                "end": END
+            }
+        )
     
     workflow.add_edge("synthesis", END)
     
     # 编译图
-    app = workflow.compile()
+    app = workflow.compile(checkpointer=checkpointer)
     
     return app, create_initial_state
 
 
-async def run_agent_graph(query: str) -> Dict[str, Any]:
+def get_agent_graph():
+    """
+    获取已编译的多Agent执行图
+    
+    首次调用时构建并编译，之后直接复用缓存结果
+    """
+    global _compiled_graph
+    if _compiled_graph is None:
+        _compiled_graph = build_agent_graph(get_checkpointer())
+    return _compiled_graph
+
+
+def warm_up():
+    """预热：提前编译执行图并创建LLM实例和Text2SQL执行器，避免首个请求承担初始化开销"""
+    get_agent_graph()
+    get_llm()
+    get_text2sql_executor()
+    get_vector_retriever()
+
+
+async def shutdown():
+    """释放进程级共享资源（数据库连接池、检查点存储）"""
+    global _compiled_graph, _checkpointer, _checkpointer_loaded
+    await get_text2sql_executor().close()
+    if _checkpointer is not None:
+        _checkpointer.close()
+    # 已编译的图引用了检查点存储，一并丢弃
+    _compiled_graph = None
+    _checkpointer = None
+    _checkpointer_loaded = False
+
+
+async def run_agent_graph(query: str, run_id: Optional[str] = None) -> Dict[str, Any]:
     """
     运行Agent图
     
     Args:
         query: 用户查询
+        run_id: 运行ID，启用检查点时每个节点完成后的状态按它保存，默认新生成
     
     Returns:
         最终状态（包含final_answer）
     """
-    app, create_initial_state = build_agent_graph()
+    app, create_initial_state = get_agent_graph()
     
     initial_state = create_initial_state(query)
+    run_id = run_id or new_run_id()
     
     # 运行图
-    final_state = await app.ainvoke(initial_state)
+    try:
+        final_state = await app.ainvoke(initial_state, _run_config(run_id))
+    finally:
+        discard_early_runs(run_id)
     
     return final_state
+
+
+async def resume_agent_graph(run_id: str) -> Dict[str, Any]:
+    """
+    从最近的检查点恢复一次运行，已完成的节点不再执行
+    
+    Args:
+        run_id: 运行ID
+    
+    Returns:
+        最终状态；该运行已经完成时直接返回保存的状态
+    
+    Raises:
+        RuntimeError: 未启用检查点
+        KeyError: 没有该运行的检查点
+    """
+    if get_checkpointer() is None:
+        raise RuntimeError("未启用检查点（LANGGRAPH_CHECKPOINT_ENABLED=0）")
+    app, _ = get_agent_graph()
+    config = _run_config(run_id)
+    
+    snapshot = await app.aget_state(config)
+    if not snapshot.values:
+        raise KeyError(run_id)
+    if not snapshot.next:
+        return snapshot.values
+    
+    # 输入为 None 表示从保存的检查点继续，只执行尚未完成的节点
+    try:
+        return await app.ainvoke(None, config)
+    finally:
+        discard_early_runs(run_id)
+
+
+async def stream_agent_graph(query: str, run_id: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    流式运行Agent图，基于 astream_events 把各节点的进度转换为事件
+    
+    Args:
+        query: 用户查询
+        run_id: 运行ID，默认新生成
+    
+    Yields:
+        事件字典：plan（规划完成）、task（单个任务结果）、token（综合阶段的token）、
+        answer（最终答案）
+    """
+    app, create_initial_state = get_agent_graph()
+    
+    initial_state = create_initial_state(query)
+    run_id = run_id or new_run_id()
+    
+    try:
+        async for event in app.astream_events(initial_state, _run_config(run_id), version="v2"):
+            kind = event["event"]
+            node = event.get("metadata", {}).get("langgraph_node")
+            
+            if kind == "on_chat_model_stream" and node == "synthesis":
+                content = event["data"]["chunk"].content
+                if content:
+                    yield {"event": "token", "data": content}
+            elif kind == "on_chain_end" and event["name"] == node:
+                output = event["data"].get("output") or {}
+                if node == "planner":
+                    plan = output.get("plan")
+                    yield {"event": "plan", "data": {"tasks": plan.to_dicts() if plan else []}}
+                elif node in ("text2sql", "rag"):
+                    for task_id, result in output.get("results", {}).items():
+                        yield {"event": "task", "data": {"id": task_id, **result.to_dict()}}
+                elif node == "synthesis":
+                    yield {"event": "answer", "data": output.get("final_answer")}
+    finally:
+        # 客户端断开时生成器被关闭，同样清除本次运行的提前调用
+        discard_early_runs(run_id)
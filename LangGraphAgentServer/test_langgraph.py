@@ -38,19 +38,19 @@ async def test_langgraph():
         
         # 显示结果
         print("📋 执行计划:")
-        tasks = final_state.get("tasks", [])
-        for task in tasks:
-            print(f"  任务 {task.get('id')}: {task.get('tool')} - {task.get('description')}")
+        plan = final_state.get("plan")
+        for task in (plan.tasks if plan else ()):
+            print(f"  任务 {task.id}: {task.tool} - {task.description}")
         
         print()
         print("📊 执行结果:")
         results = final_state.get("results", {})
         for task_id, result in results.items():
-            print(f"  任务 {task_id} ({result.get('tool')}):")
-            if isinstance(result.get('result'), list):
-                print(f"    {len(result.get('result'))} 条记录")
+            print(f"  任务 {task_id} ({result.tool}):")
+            if isinstance(result.result, list):
+                print(f"    {len(result.result)} 条记录")
             else:
-                print(f"    {result.get('result')[:100]}...")
+                print(f"    {result.result[:100]}...")
         
         print()
         print("📄 最终答案:")
@@ -0,0 +1,6 @@
+"""
+Agent规划器 - 复用 AgentPlannerServer 的实现
+"""
+from AgentPlannerServer.agent_planner import AgentPlanner
+
+__all__ = ["AgentPlanner"]
@@ -0,0 +1,54 @@
+"""
+执行引擎 - RAG 工具由知识图谱检索提供
+"""
+from typing import Any, Callable, Optional
+
+from AgentPlannerServer.context_packer import ContextPacker
+from AgentPlannerServer.execution_context import ExecutionContext
+from AgentPlannerServer.execution_engine import ExecutionEngine as BaseExecutionEngine
+
+from .knowledge_graph import KnowledgeGraphRetriever
+
+
+_default_retriever: Optional[KnowledgeGraphRetriever] = None
+
+
+def get_default_retriever() -> KnowledgeGraphRetriever:
+    """进程级共享的知识图谱检索器（子图缓存在多次请求间复用）"""
+    global _default_retriever
+    if _default_retriever is None:
+        _default_retriever = KnowledgeGraphRetriever.from_env()
+    return _default_retriever
+
+
+class ExecutionEngine(BaseExecutionEngine):
+    """
+    基于知识图谱RAG的执行引擎
+    
+    Args:
+        client: LLM客户端
+        text2sql: 可选的Text2SQL执行器
+        retriever: 知识图谱检索器，未提供时使用进程级共享实例
+        context_factory: 创建执行上下文的函数，默认按环境变量配置
+        packer: 合成上下文压缩器，默认按环境变量配置 token 预算
+    """
+    
+    def __init__(
+        self,
+        client: Any,
+        text2sql: Any = None,
+        retriever: Optional[KnowledgeGraphRetriever] = None,
+        context_factory: Optional[Callable[[], ExecutionContext]] = None,
+        packer: Optional[ContextPacker] = None,
+    ):
+        super().__init__(
+            client,
+            text2sql=text2sql,
+            retriever=retriever or get_default_retriever(),
+            context_factory=context_factory,
+            packer=packer,
+        )
+    
+    async def _execute_rag(self, query: str) -> str:
+        """执行知识图谱检索：链接查询中的实体，返回其 k 跳邻域子图"""
+        return await self.retriever.retrieve(query)
@@ -0,0 +1,384 @@
+"""
+知识图谱检索引擎 - 基于知识图谱的RAG工具
+
+入库时从文档中抽取 (实体, 关系, 实体) 三元组（LLM抽取，或无需网络的规则抽取），
+图以 CSR 数组存储：indptr 给出每个实体的出边区间，indices / relations / forward
+给出邻居实体、关系编号和边的原始方向，evidence 指向证据句子。
+查询时在问题中链接种子实体，做 k 跳邻域扩展，把子图格式化为上下文；
+相同种子和跳数的子图结果会被缓存。
+
+用法:
+    python -m RAGKnowledgeGraphServer.knowledge_graph ingest docs/ --out kg_index
+    python -m RAGKnowledgeGraphServer.knowledge_graph query kg_index "华东大区断货和哪些因素有关"
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+Triple = Tuple[str, str, str]
+
+_SENTENCE_RE = re.compile(r"[^。！？!?；;\n]+[。！？!?；;]?")
+# 规则抽取使用的实体模式：以常见机构/地点/产品后缀结尾的中文短语，以及英文专有名词
+_ENTITY_RE = re.compile(
+    r"[一-鿿A-Za-z0-9]{0,6}(?:大区|区|中心|系列|计划|公司|部门|渠道|门店|分销商|供应商|仓库|产品线|产品)"
+    r"|[A-Z][A-Za-z0-9]+(?:\s[A-Z][A-Za-z0-9]+)*"
+)
+# 实体不会跨越这些虚词和常见谓词，先按其切分短语再匹配实体模式
+_BOUNDARY_RE = re.compile(
+    r"[^一-鿿A-Za-z0-9\s]|的|和|与|及|在|对|从|向|为|是|了|由于|导致|期间|同时|启动|升级|出现|处于|部分|包括|通过"
+)
+_CO_OCCUR = "相关"
+TEXT_SUFFIXES = (".txt", ".md", ".markdown")
+
+EXTRACTION_SYSTEM_PROMPT = """你是一个知识图谱构建专家。请从文本中抽取实体之间的关系三元组。
+必须返回 JSON 格式：{"triples": [["头实体", "关系", "尾实体"], ...]}
+实体使用文本中的原始名称，关系使用简短的动词或名词短语。"""
+
+# 未配置图谱目录时使用的演示文档
+DEMO_DOCUMENTS = [
+    "由于 Q3 期间华东大区启动'合作伙伴优化计划'，导致 35% 的核心分销商处于合同重签期，部分门店出现 2-3 周的断货。"
+    "同时，上海物流中心升级导致旗舰系列周转率下降。",
+]
+
+
+def split_sentences(text: str) -> List[str]:
+    """按中英文句末标点切分句子"""
+    return [s.strip() for s in _SENTENCE_RE.findall(text) if s.strip()]
+
+
+def extract_triples_rules(sentence: str) -> List[Triple]:
+    """
+    规则抽取：同一句中出现的实体两两建立“相关”关系
+    
+    无需网络，适合离线构建和演示；精度要求高时使用 LLM 抽取
+    """
+    entities = list(dict.fromkeys(
+        m.strip()
+        for phrase in _BOUNDARY_RE.split(sentence)
+        for m in _ENTITY_RE.findall(phrase)
+        if len(m.strip()) >= 2
+    ))
+    return [
+        (entities[i], _CO_OCCUR, entities[j])
+        for i in range(len(entities))
+        for j in range(i + 1, len(entities))
+    ]
+
+
+async def extract_triples_llm(client: Any, sentence: str) -> List[Triple]:
+    """LLM抽取：解析失败时回退到规则抽取"""
+    try:
+        response = await client.ask(sentence, EXTRACTION_SYSTEM_PROMPT, is_json=True)
+        triples = json.loads(response).get("triples", [])
+        return [
+            (str(h).strip(), str(r).strip(), str(t).strip())
+            for h, r, t in triples
+            if str(h).strip() and str(t).strip()
+        ]
+    except Exception as e:
+        print(f"三元组抽取失败，使用规则抽取: {e}")
+        return extract_triples_rules(sentence)
+
+
+class KnowledgeGraph:
+    """
+    CSR 邻接表示的知识图谱
+    
+    每条三元组存为两条有向边（正向和反向），便于无向的邻域扩展，
+    forward 标记边的原始方向，用于还原三元组
+    """
+    
+    def __init__(
+        self,
+        entities: List[str],
+        relation_names: List[str],
+        sentences: List[str],
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        relations: np.ndarray,
+        forward: np.ndarray,
+        evidence: np.ndarray,
+    ):
+        self.entities = entities
+        self.relation_names = relation_names
+        self.sentences = sentences
+        self.indptr = indptr
+        self.indices = indices
+        self.relations = relations
+        self.forward = forward
+        self.evidence = evidence
+        self.entity_ids = {name: i for i, name in enumerate(entities)}
+        
+        # 实体名长度集合（从长到短），链接实体时按长度做字典查找
+        self._name_lengths = sorted({len(name) for name in entities}, reverse=True)
+    
+    @classmethod
+    def from_triples(cls, triples: Iterable[Tuple[Triple, str]]) -> "KnowledgeGraph":
+        """
+        由 ((头实体, 关系, 尾实体), 证据句子) 序列构建图谱
+        """
+        entity_ids: Dict[str, int] = {}
+        relation_ids: Dict[str, int] = {}
+        sentence_ids: Dict[str, int] = {}
+        src, dst, rel, fwd, evi = [], [], [], [], []
+        seen = set()
+        
+        for (head, relation, tail), sentence in triples:
+            if head == tail:
+                continue
+            h = entity_ids.setdefault(head, len(entity_ids))
+            t = entity_ids.setdefault(tail, len(entity_ids))
+            r = relation_ids.setdefault(relation, len(relation_ids))
+            if (h, r, t) in seen:
+                continue
+            seen.add((h, r, t))
+            s = sentence_ids.setdefault(sentence, len(sentence_ids))
+            src += [h, t]
+            dst += [t, h]
+            rel += [r, r]
+            fwd += [True, False]
+            evi += [s, s]
+        
+        src_arr = np.asarray(src, dtype=np.int32)
+        order = np.argsort(src_arr, kind="stable")
+        indptr = np.zeros(len(entity_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src_arr, minlength=len(entity_ids)))
+        
+        return cls(
+            entities=list(entity_ids),
+            relation_names=list(relation_ids),
+            sentences=list(sentence_ids),
+            indptr=indptr,
+            indices=np.asarray(dst, dtype=np.int32)[order],
+            relations=np.asarray(rel, dtype=np.int32)[order],
+            forward=np.asarray(fwd, dtype=np.bool_)[order],
+            evidence=np.asarray(evi, dtype=np.int32)[order],
+        )
+    
+    def save(self, out_dir: str):
+        """保存为 npz 数组文件和 JSON 字符串表"""
+        os.makedirs(out_dir, exist_ok=True)
+        np.savez(
+            os.path.join(out_dir, "graph.npz"),
+            indptr=self.indptr, indices=self.indices, relations=self.relations,
+            forward=self.forward, evidence=self.evidence,
+        )
+        with open(os.path.join(out_dir, "strings.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"entities": self.entities, "relations": self.relation_names, "sentences": self.sentences},
+                f, ensure_ascii=False,
+            )
+    
+    @classmethod
+    def load(cls, index_dir: str) -> "KnowledgeGraph":
+        """从目录加载图谱"""
+        with open(os.path.join(index_dir, "strings.json"), encoding="utf-8") as f:
+            strings = json.load(f)
+        arrays = np.load(os.path.join(index_dir, "graph.npz"))
+        return cls(
+            strings["entities"], strings["relations"], strings["sentences"],
+            arrays["indptr"], arrays["indices"], arrays["relations"],
+            arrays["forward"], arrays["evidence"],
+        )
+    
+    def link_entities(self, text: str) -> List[int]:
+        """在文本中找出已知实体（同一位置优先匹配最长的实体名）"""
+        found: List[int] = []
+        i = 0
+        while i < len(text):
+            step = 1
+            for length in self._name_lengths:
+                entity_id = self.entity_ids.get(text[i:i + length])
+                if entity_id is not None:
+                    if entity_id not in found:
+                        found.append(entity_id)
+                    step = length
+                    break
+            i += step
+        return found
+    
+    def expand(self, seeds: Sequence[int], hops: int, max_edges: int) -> List[int]:
+        """
+        从种子实体出发做 k 跳邻域扩展
+        
+        Returns:
+            子图中的边编号（CSR 中的下标），按跳数由近到远排列，最多 max_edges 条
+        """
+        visited = np.zeros(len(self.entities), dtype=np.bool_)
+        frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+        visited[frontier] = True
+        edges: List[int] = []
+        seen_triples = set()
+        
+        for _ in range(hops):
+            if len(frontier) == 0 or len(edges) >= max_edges:
+                break
+            starts, ends = self.indptr[frontier], self.indptr[frontier + 1]
+            edge_ids = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+            sources = np.repeat(frontier, ends - starts)
+            for edge, source in zip(edge_ids.tolist(), sources.tolist()):
+                # 正反两条边表示同一三元组，只保留一条
+                target = int(self.indices[edge])
+                key = (min(source, target), max(source, target), int(self.relations[edge]), int(self.evidence[edge]))
+                if key in seen_triples:
+                    continue
+                seen_triples.add(key)
+                edges.append(edge)
+                if len(edges) >= max_edges:
+                    break
+            neighbors = self.indices[edge_ids]
+            frontier = np.unique(neighbors[~visited[neighbors]])
+            visited[frontier] = True
+        return edges
+    
+    def _source_of(self, edge: int) -> int:
+        return int(np.searchsorted(self.indptr, edge, side="right") - 1)
+    
+    def triple(self, edge: int) -> Tuple[str, str, str, str]:
+        """还原边对应的 (头实体, 关系, 尾实体, 证据句子)"""
+        source, target = self.entities[self._source_of(edge)], self.entities[int(self.indices[edge])]
+        if not self.forward[edge]:
+            source, target = target, source
+        return source, self.relation_names[int(self.relations[edge])], target, self.sentences[int(self.evidence[edge])]
+
+
+class KnowledgeGraphRetriever:
+    """
+    知识图谱检索器，作为 ExecutionEngine 的 RAG 工具
+    
+    Args:
+        graph: 知识图谱
+        hops: 邻域扩展跳数
+        max_edges: 子图最多包含的边数
+        cache_size: 子图结果缓存的条目数
+    """
+    
+    def __init__(self, graph: KnowledgeGraph, hops: int = 2, max_edges: int = 50, cache_size: int = 1024):
+        self.graph = graph
+        self.hops = hops
+        self.max_edges = max_edges
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[Tuple[int, ...], int], str]" = OrderedDict()
+    
+    @classmethod
+    def from_env(cls) -> "KnowledgeGraphRetriever":
+        """KG_INDEX_DIR 指向已构建的图谱时加载之，否则用演示文档构建一个小图谱"""
+        index_dir = os.getenv("KG_INDEX_DIR")
+        if index_dir and os.path.exists(os.path.join(index_dir, "graph.npz")):
+            graph = KnowledgeGraph.load(index_dir)
+        else:
+            graph = KnowledgeGraph.from_triples(
+                (triple, sentence)
+                for document in DEMO_DOCUMENTS
+                for sentence in split_sentences(document)
+                for triple in extract_triples_rules(sentence)
+            )
+        return cls(
+            graph,
+            hops=int(os.getenv("KG_HOPS", "2")),
+            max_edges=int(os.getenv("KG_MAX_EDGES", "50")),
+        )
+    
+    def subgraph(self, seeds: Sequence[int]) -> str:
+        """格式化种子实体的 k 跳子图，结果按 (种子, 跳数) 缓存"""
+        key = (tuple(sorted(seeds)), self.hops)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+        
+        lines = []
+        evidence_seen: Dict[str, None] = {}
+        for edge in self.graph.expand(seeds, self.hops, self.max_edges):
+            head, relation, tail, sentence = self.graph.triple(edge)
+            lines.append(f"{head} -[{relation}]-> {tail}")
+            evidence_seen[sentence] = None
+        text = "\n".join(lines)
+        if evidence_seen:
+            text += "\n【证据】" + "\n【证据】".join(evidence_seen)
+        
+        self._cache[key] = text
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return text
+    
+    async def retrieve(self, query: str) -> str:
+        """检索与查询相关的知识子图"""
+        seeds = self.graph.link_entities(query)
+        if not seeds:
+            return "知识图谱中未找到与查询相关的实体"
+        return self.subgraph(seeds)
+
+
+def _read_documents(paths: List[str]) -> List[str]:
+    documents = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(TEXT_SUFFIXES):
+                        documents.extend(_read_documents([os.path.join(root, name)]))
+        else:
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                documents.append(f.read())
+    return documents
+
+
+async def ingest(paths: List[str], out_dir: str, extractor: str = "rules", concurrency: int = 8):
+    """读取文档，逐句抽取三元组并构建图谱"""
+    sentences = [s for document in _read_documents(paths) for s in split_sentences(document)]
+    
+    if extractor == "llm":
+        from .llm_client import LLMClient
+        client = LLMClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def extract(sentence: str) -> List[Triple]:
+            async with semaphore:
+                return await extract_triples_llm(client, sentence)
+        
+        try:
+            extracted = await asyncio.gather(*[extract(s) for s in sentences])
+        finally:
+            await client.aclose()
+    else:
+        extracted = [extract_triples_rules(s) for s in sentences]
+    
+    graph = KnowledgeGraph.from_triples(
+        (triple, sentence) for sentence, triples in zip(sentences, extracted) for triple in triples
+    )
+    graph.save(out_dir)
+    print(f"已处理 {len(sentences)} 个句子，得到 {len(graph.entities)} 个实体、{len(graph.indices) // 2} 条关系 -> {out_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知识图谱构建与查询工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    ingest_parser = sub.add_parser("ingest", help="构建知识图谱")
+    ingest_parser.add_argument("paths", nargs="+", help="文档文件或目录")
+    ingest_parser.add_argument("--out", required=True, help="图谱输出目录")
+    ingest_parser.add_argument("--extractor", choices=["rules", "llm"], default="rules")
+    
+    query_parser = sub.add_parser("query", help="查询知识图谱")
+    query_parser.add_argument("index_dir")
+    query_parser.add_argument("query")
+    query_parser.add_argument("--hops", type=int, default=2)
+    
+    args = parser.parse_args()
+    if args.command == "ingest":
+        asyncio.run(ingest(args.paths, args.out, args.extractor))
+    else:
+        retriever = KnowledgeGraphRetriever(KnowledgeGraph.load(args.index_dir), hops=args.hops)
+        print(asyncio.run(retriever.retrieve(args.query)))
+
+
+if __name__ == "__main__":
+    main()
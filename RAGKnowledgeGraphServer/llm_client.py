@@ -0,0 +1,6 @@
+"""
+LLM客户端 - 复用 AgentPlannerServer 的实现（连接池、响应缓存、流式输出）
+"""
+from AgentPlannerServer.llm_client import LLMClient
+
+__all__ = ["LLMClient"]
@@ -0,0 +1,6 @@
+"""
+数据类型定义 - 复用 AgentPlannerServer 的执行计划模型
+"""
+from AgentPlannerServer.types import AnalysisTask, ExecutionPlan, TaskTool
+
+__all__ = ["AnalysisTask", "ExecutionPlan", "TaskTool"]
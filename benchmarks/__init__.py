@@ -0,0 +1 @@
+"""基准测试：本地模拟 OpenAI 服务与端到端性能测量"""
@@ -0,0 +1,362 @@
+"""
+基准测试 - 用本地模拟 LLM 驱动 main.py / main_langgraph.py，测量端到端性能
+
+流程：启动模拟 OpenAI 服务 → 逐个启动被测服务（OPENAI_BASE_URL 指向模拟服务）→
+预热后按配置的并发度发送请求 → 统计延迟 p50/p95/p99、吞吐量、首字节时间（TTFB）
+和被测进程的常驻内存（RSS）→ 结果写入 JSON 文件，可与上一次的结果对比。
+
+被测服务在临时目录中运行，演示数据库和缓存文件不会写入仓库。默认关闭LLM响应缓存和
+计划缓存，使每个请求都真实经过规划、执行、合成流水线；可用 --env 覆盖。
+
+用法:
+    python3 -m benchmarks.harness --targets main,langgraph --requests 200 --concurrency 16 --out bench.json
+    python3 -m benchmarks.harness --endpoint stream --baseline bench.json --out bench_new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    "main": "main:app",
+    "langgraph": "main_langgraph:app",
+    "rag": "main_rag:app",
+}
+
+ENDPOINTS = {
+    "analyze": "/analyze",
+    "stream": "/analyze/stream",
+}
+
+DEFAULT_QUERIES = [
+    "分析Q3华东区销售额下降的原因",
+    "对比各区域旗舰系列手机的同比增长",
+    "智能穿戴产品线本季度表现如何，背后有哪些策略调整",
+    "为什么华南区营收增长而华东区下滑",
+    "统计各产品线的销售额占比并说明变化原因",
+    "上海物流中心升级对周转率有什么影响",
+    "哪些区域的平板电脑销量在增长",
+    "总结本季度渠道政策变化及其对销售的影响",
+]
+
+DEFAULT_ENV = {
+    "LLM_CACHE_ENABLED": "0",
+    "PLAN_CACHE_ENABLED": "0",
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """线性插值百分位数，q 取 0-100"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """毫秒单位的分布摘要"""
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """读取进程常驻内存（字节），优先使用 psutil，否则读取 /proc"""
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60.0):
+    """轮询直到服务可以响应"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"服务进程提前退出: {url}")
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"等待服务启动超时: {url}")
+
+
+def start_process(args: List[str], env: Dict[str, str], cwd: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, *args],
+        env={**os.environ, **env},
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def stop_process(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def drive(
+    base_url: str,
+    path: str,
+    queries: List[str],
+    requests: int,
+    concurrency: int,
+    pid: int,
+    rss_interval: float = 0.2,
+) -> Dict[str, Any]:
+    """
+    以固定并发度发送请求并采集指标
+    
+    Returns:
+        单个被测服务的测量结果
+    """
+    latencies: List[float] = []
+    ttfbs: List[float] = []
+    statuses: Dict[str, int] = {}
+    rss_samples: List[int] = []
+    counter = iter(range(requests))
+    
+    async def sample_rss():
+        while True:
+            rss = read_rss(pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            await asyncio.sleep(rss_interval)
+    
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300.0) as client:
+        
+        async def worker():
+            for index in counter:
+                query = queries[index % len(queries)]
+                started = time.monotonic()
+                ttfb = None
+                try:
+                    async with client.stream("POST", path, json={"query": query}) as response:
+                        async for _ in response.aiter_raw():
+                            if ttfb is None:
+                                ttfb = time.monotonic() - started
+                        status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = e.__class__.__name__
+                elapsed = time.monotonic() - started
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == "200":
+                    latencies.append(elapsed)
+                    ttfbs.append(ttfb if ttfb is not None else elapsed)
+        
+        sampler = asyncio.create_task(sample_rss())
+        started = time.monotonic()
+        try:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        finally:
+            sampler.cancel()
+        wall = time.monotonic() - started
+    
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "succeeded": len(latencies),
+        "errors": requests - len(latencies),
+        "statuses": statuses,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall > 0 else 0.0,
+        "latency_ms": summarize(latencies),
+        "ttfb_ms": summarize(ttfbs),
+        "rss_mb": {
+            "peak": round(max(rss_samples) / 2 ** 20, 1),
+            "mean": round(sum(rss_samples) / len(rss_samples) / 2 ** 20, 1),
+        } if rss_samples else {},
+    }
+
+
+async def run_target(
+    target: str,
+    llm_base_url: str,
+    path: str,
+    queries: List[str],
+    requests: int,
+    concurrency: int,
+    warmup: int,
+    env: Dict[str, str],
+) -> Dict[str, Any]:
+    """启动一个被测服务，预热并测量后关闭"""
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as workdir:
+        process = start_process(
+            ["-m", "uvicorn", TARGETS[target], "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            {
+                "PYTHONPATH": REPO_ROOT,
+                "OPENAI_BASE_URL": llm_base_url,
+                "OPENAI_API_KEY": "benchmark",
+                **env,
+            },
+            workdir,
+        )
+        try:
+            await wait_ready(f"{base_url}/health", process)
+            if warmup:
+                await drive(base_url, path, queries, warmup, min(concurrency, warmup), process.pid)
+            return await drive(base_url, path, queries, requests, concurrency, process.pid)
+        finally:
+            stop_process(process)
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """与基线结果对比，返回可读的变化摘要（延迟为负、吞吐为正表示变好）"""
+    lines = []
+    for target, result in current["results"].items():
+        base = baseline.get("results", {}).get(target)
+        if not base:
+            continue
+        for section, keys in (("latency_ms", ("p50", "p95", "p99")), ("ttfb_ms", ("p50", "p95"))):
+            for key in keys:
+                old, new = base.get(section, {}).get(key), result.get(section, {}).get(key)
+                if old and new is not None:
+                    lines.append(f"{target} {section}.{key}: {old} -> {new} ({(new - old) / old:+.1%})")
+        old, new = base.get("throughput_rps"), result.get("throughput_rps")
+        if old and new is not None:
+            lines.append(f"{target} throughput_rps: {old} -> {new} ({(new - old) / old:+.1%})")
+    return lines
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+            capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = [json.loads(line)["query"] for line in f if line.strip()]
+    
+    env = dict(DEFAULT_ENV)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    
+    mock_port = free_port()
+    mock_args = [
+        "-m", "benchmarks.mock_llm_server", "--port", str(mock_port),
+        "--ttft-ms", str(args.ttft_ms), "--ttft-sigma", str(args.ttft_sigma),
+        "--tps", str(args.tps), "--tps-std", str(args.tps_std),
+        "--output-tokens", str(args.output_tokens), "--seed", str(args.seed),
+    ]
+    mock = start_process(mock_args, {"PYTHONPATH": REPO_ROOT}, REPO_ROOT)
+    results: Dict[str, Any] = {}
+    try:
+        await wait_ready(f"http://127.0.0.1:{mock_port}/stats", mock)
+        for target in args.targets.split(","):
+            print(f"测试 {target} ...")
+            results[target] = await run_target(
+                target, f"http://127.0.0.1:{mock_port}/v1", ENDPOINTS[args.endpoint],
+                queries, args.requests, args.concurrency, args.warmup, env,
+            )
+            print(json.dumps(results[target], ensure_ascii=False))
+    finally:
+        stop_process(mock)
+    
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "endpoint": args.endpoint,
+            "env": env,
+            "mock": {
+                "ttft_ms": args.ttft_ms, "ttft_sigma": args.ttft_sigma,
+                "tps": args.tps, "tps_std": args.tps_std,
+                "output_tokens": args.output_tokens, "seed": args.seed,
+            },
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多Agent服务基准测试（本地模拟LLM）")
+    parser.add_argument("--targets", default="main,langgraph", help=f"逗号分隔的被测服务: {', '.join(TARGETS)}")
+    parser.add_argument("--endpoint", choices=list(ENDPOINTS), default="analyze")
+    parser.add_argument("--requests", type=int, default=100, help="每个被测服务的请求数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5, help="正式测量前的预热请求数")
+    parser.add_argument("--queries", help="JSONL 查询文件（每行含 query 字段），默认使用内置查询")
+    parser.add_argument("--env", action="append", default=[], help="传给被测服务的环境变量 KEY=VALUE，可重复")
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--ttft-sigma", type=float, default=0.3)
+    parser.add_argument("--tps", type=float, default=60.0)
+    parser.add_argument("--tps-std", type=float, default=10.0)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.json", help="结果输出文件")
+    parser.add_argument("--baseline", help="上一次的结果文件，用于对比")
+    
+    args = parser.parse_args()
+    report = asyncio.run(run_benchmark(args))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.out}")
+    
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            for line in compare(report, json.load(f)):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
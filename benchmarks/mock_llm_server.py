@@ -0,0 +1,259 @@
+"""
+本地模拟 OpenAI 接口 - 供基准测试使用的确定性 LLM 替身
+
+实现 /v1/chat/completions（普通与流式）和 /v1/embeddings，响应内容按请求类型生成：
+- 规划请求（要求 JSON、提示中含 tasks）返回 Text2SQL + RAG + Final_Synthesis 三个任务的计划
+- 批量规划请求（提示中含 plans）按编号返回计划数组
+- Text2SQL 请求返回可在演示库 sales_q3 上执行的只读SQL
+- 其他请求（合成）返回固定长度的分析文本
+
+延迟模型：首 token 延迟服从对数正态分布（中位数 + sigma），输出速率服从截断正态分布（tokens/s）。
+随机数以 (seed, 请求内容) 为种子，相同请求在多次运行中得到完全相同的延迟和内容。
+
+用法:
+    python3 -m benchmarks.mock_llm_server --port 9100 --ttft-ms 300 --tps 60 --output-tokens 200
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+class MockConfig:
+    """
+    模拟服务的延迟与输出配置
+    
+    Args:
+        ttft_ms: 首 token 延迟中位数（毫秒）
+        ttft_sigma: 首 token 延迟对数正态分布的 sigma，0 表示固定延迟
+        tps: 平均输出速率（tokens/s）
+        tps_std: 输出速率的标准差
+        output_tokens: 合成类请求的输出 token 数
+        chunk_tokens: 流式响应每个分片包含的 token 数
+        seed: 随机种子
+    """
+    
+    def __init__(
+        self,
+        ttft_ms: float = 300.0,
+        ttft_sigma: float = 0.3,
+        tps: float = 60.0,
+        tps_std: float = 10.0,
+        output_tokens: int = 200,
+        chunk_tokens: int = 4,
+        seed: int = 0,
+    ):
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.tps = tps
+        self.tps_std = tps_std
+        self.output_tokens = output_tokens
+        self.chunk_tokens = chunk_tokens
+        self.seed = seed
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+_NUMBERED_RE = re.compile(r"^\[(\d+)\]\s*(.*)$", re.MULTILINE)
+
+MOCK_SQL = (
+    "SELECT region, product_line, revenue, "
+    "(revenue - prev_revenue) / prev_revenue AS growth "
+    "FROM sales_q3 ORDER BY growth ASC LIMIT 3"
+)
+
+
+def _plan(query: str, plan_id: str) -> Dict[str, Any]:
+    return {
+        "planId": plan_id,
+        "tasks": [
+            {"id": 1, "tool": "Text2SQL", "description": "查询销售数据", "subQuery": query, "dependencies": []},
+            {"id": 2, "tool": "RAG", "description": "检索相关文档", "subQuery": query, "dependencies": []},
+            {"id": 3, "tool": "Final_Synthesis", "description": query, "subQuery": query, "dependencies": [1, 2]},
+        ],
+    }
+
+
+def _messages_text(messages: List[Dict[str, Any]], role: str) -> str:
+    parts = []
+    for message in messages:
+        if message.get("role") != role:
+            continue
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        parts.append(content)
+    return "\n".join(parts)
+
+
+def generate_reply(body: Dict[str, Any], config: MockConfig) -> str:
+    """按请求类型生成确定性的响应内容"""
+    messages = body.get("messages", [])
+    system = _messages_text(messages, "system")
+    user = _messages_text(messages, "user")
+    digest = hashlib.sha256(user.encode("utf-8")).hexdigest()[:8]
+    
+    if '"plans"' in system:
+        numbered = _NUMBERED_RE.findall(user)
+        plans = [dict(_plan(query, f"mock-{digest}-{index}"), index=int(index)) for index, query in numbered]
+        return json.dumps({"plans": plans}, ensure_ascii=False)
+    if "tasks" in system and "JSON" in system:
+        query = user.split("用户查询:", 1)[-1].strip()
+        return json.dumps(_plan(query, f"mock-{digest}"), ensure_ascii=False)
+    if "SQL" in system:
+        return MOCK_SQL
+    # 合成：每个 token 约 4 个字符
+    sentence = "根据数据结果，华东区旗舰系列销售额同比下降，主要原因是分销商合同重签导致断货。"
+    text = (sentence * (config.output_tokens * 4 // len(sentence) + 1))[:config.output_tokens * 4]
+    return text
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, math.ceil(len(text) / 4))
+
+
+class MockLLM:
+    """模拟的 OpenAI 服务"""
+    
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.requests = 0
+    
+    def _rng(self, body: Dict[str, Any]) -> random.Random:
+        key = json.dumps(body.get("messages", []), ensure_ascii=False, sort_keys=True)
+        digest = hashlib.sha256(f"{self.config.seed}\0{key}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+    
+    def _timing(self, body: Dict[str, Any]):
+        """采样本次请求的首 token 延迟（秒）和输出速率（tokens/s）"""
+        rng = self._rng(body)
+        ttft = self.config.ttft_ms / 1000
+        if self.config.ttft_sigma > 0:
+            ttft *= math.exp(rng.gauss(0, self.config.ttft_sigma))
+        tps = max(1.0, rng.gauss(self.config.tps, self.config.tps_std))
+        return ttft, tps
+    
+    async def complete(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        self.requests += 1
+        ttft, tps = self._timing(body)
+        content = generate_reply(body, self.config)
+        completion_tokens = _count_tokens(content)
+        await asyncio.sleep(ttft + completion_tokens / tps)
+        prompt_tokens = _count_tokens(json.dumps(body.get("messages", []), ensure_ascii=False))
+        return {
+            "id": f"chatcmpl-mock-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+    
+    async def stream(self, body: Dict[str, Any]) -> AsyncIterator[str]:
+        self.requests += 1
+        ttft, tps = self._timing(body)
+        content = generate_reply(body, self.config)
+        chunk_chars = self.config.chunk_tokens * 4
+        created = int(time.time())
+        base = {
+            "id": f"chatcmpl-mock-{self.requests}",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": body.get("model", "mock"),
+        }
+        
+        def chunk(delta: Dict[str, Any], finish_reason=None) -> str:
+            payload = dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        
+        await asyncio.sleep(ttft)
+        yield chunk({"role": "assistant", "content": ""})
+        for start in range(0, len(content), chunk_chars):
+            piece = content[start:start + chunk_chars]
+            yield chunk({"content": piece})
+            await asyncio.sleep(_count_tokens(piece) / tps)
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+    
+    def embed(self, body: Dict[str, Any], dim: int = 256) -> Dict[str, Any]:
+        self.requests += 1
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = []
+        for index, text in enumerate(inputs):
+            rng = random.Random(hashlib.sha256(str(text).encode("utf-8")).digest())
+            vector = [rng.gauss(0, 1) for _ in range(dim)]
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            data.append({"object": "embedding", "index": index, "embedding": [v / norm for v in vector]})
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "mock"),
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        }
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    """创建模拟服务应用"""
+    mock = MockLLM(config)
+    app = FastAPI(title="Mock OpenAI")
+    
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if body.get("stream"):
+            return StreamingResponse(mock.stream(body), media_type="text/event-stream")
+        return await mock.complete(body)
+    
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        return mock.embed(await request.json())
+    
+    @app.get("/stats")
+    async def stats():
+        return {"requests": mock.requests, "config": config.to_dict()}
+    
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 OpenAI 接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="首 token 延迟中位数（毫秒）")
+    parser.add_argument("--ttft-sigma", type=float, default=0.3, help="首 token 延迟对数正态分布的 sigma")
+    parser.add_argument("--tps", type=float, default=60.0, help="平均输出速率（tokens/s）")
+    parser.add_argument("--tps-std", type=float, default=10.0, help="输出速率的标准差")
+    parser.add_argument("--output-tokens", type=int, default=200, help="合成类请求的输出 token 数")
+    parser.add_argument("--chunk-tokens", type=int, default=4, help="流式响应每个分片的 token 数")
+    parser.add_argument("--seed", type=int, default=0)
+    
+    args = parser.parse_args()
+    config = MockConfig(
+        args.ttft_ms, args.ttft_sigma, args.tps, args.tps_std,
+        args.output_tokens, args.chunk_tokens, args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
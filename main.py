@@ -1,19 +1,61 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Dict, Optional
+from contextlib import asynccontextmanager
 import uvicorn
+import asyncio
 import os
+import time
 
 from AgentPlannerServer.llm_client import LLMClient
+from AgentPlannerServer.http_utils import retry_after_header, sse, unavailable
+from AgentPlannerServer.job_queue import JobQueue, QueueFullError
+from AgentPlannerServer.llm_cache import ResponseCache
+from AgentPlannerServer.llm_scheduler import LLMUnavailableError
+from AgentPlannerServer.plan_batcher import PlanBatcher
+from AgentPlannerServer.plan_cache import PlanCache
+from AgentPlannerServer.singleflight import SingleFlight, query_key
+from AgentPlannerServer.speculation import Speculation, Speculator
+from AgentPlannerServer.text2sql import Text2SQLExecutor, llm_sql_generator
+from AgentPlannerServer.tracing import get_tracer
+from AgentPlannerServer.vector_index import VectorRetriever
 from AgentPlannerServer.agent_planner import AgentPlanner
 from AgentPlannerServer.execution_engine import ExecutionEngine
 from AgentPlannerServer.types import ExecutionPlan
 
 
-app = FastAPI(title="多源数据路由与推理规划器", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：创建进程级共享的LLM客户端和数据库连接池，退出时关闭"""
+    app.state.llm_client = LLMClient(cache=ResponseCache.from_env())
+    app.state.plan_cache = PlanCache.from_env()
+    app.state.text2sql = Text2SQLExecutor.from_env(llm_sql_generator(app.state.llm_client))
+    app.state.retriever = VectorRetriever.from_env(app.state.llm_client.embed_many)
+    # 规划请求微批处理（PLAN_BATCH_ENABLED=1 时启用）：并发请求合并为一次多查询规划调用
+    app.state.plan_batcher = PlanBatcher.from_env(app.state.llm_client)
+    # 结果按请求存放在独立的执行上下文中，规划器和执行引擎可在请求间复用
+    app.state.planner = AgentPlanner(app.state.llm_client, app.state.plan_cache, app.state.plan_batcher)
+    app.state.engine = ExecutionEngine(app.state.llm_client, app.state.text2sql, app.state.retriever)
+    # 相同查询的并发 /analyze 请求共享同一次规划和执行
+    app.state.inflight = SingleFlight()
+    # 推测执行（SPECULATION_ENABLED=1 时启用）：规划的同时预取可能的工具任务
+    app.state.speculator = Speculator.from_env()
+    # 作业模式：POST /jobs 排队后由后台工作协程执行，结果通过轮询、SSE 或 webhook 获取
+    app.state.jobs = JobQueue.from_env(_run_job)
+    app.state.jobs.start()
+    try:
+        yield
+    finally:
+        await app.state.jobs.aclose()
+        await app.state.text2sql.close()
+        await app.state.llm_client.aclose()
+        await get_tracer().aclose()
+
+
+app = FastAPI(title="多源数据路由与推理规划器", version="1.0.0", lifespan=lifespan)
 
 # 配置CORS，允许前端访问
 app.add_middleware(
@@ -28,6 +70,13 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     """查询请求模型"""
     query: str
+    timing: bool = False
+
+
+class JobRequest(BaseModel):
+    """作业请求模型"""
+    query: str
+    webhook: Optional[str] = None
 
 
 class QueryResponse(BaseModel):
@@ -36,6 +85,7 @@ class QueryResponse(BaseModel):
     finalAnswer: Optional[str] = None
     success: bool
     message: Optional[str] = None
+    timing: Optional[Dict[str, Any]] = None
 
 
 # 提供静态文件服务
@@ -61,25 +111,68 @@ async def analyze(request: QueryRequest):
     """
     分析接口
     
-    接收用户查询，创建执行计划，执行任务并返回结果
+    接收用户查询，创建执行计划，执行任务并返回结果。
+    相同查询的并发请求合并为一次执行，所有请求共享同一结果。
+    timing=true 时响应中附带各阶段的耗时明细。
     """
     try:
-        # 初始化组件
-        client = LLMClient()
-        planner = AgentPlanner(client)
-        engine = ExecutionEngine(client)
-        
-        # 创建计划
-        plan = await planner.create_plan(request.query)
-        
-        if not plan:
-            return QueryResponse(
-                success=False,
-                message="创建执行计划失败"
-            )
+        response = await app.state.inflight.do(
+            query_key(request.query),
+            lambda: _run_analysis(request.query),
+        )
+    except LLMUnavailableError as e:
+        raise unavailable(e)
+    if not request.timing:
+        response = response.model_copy(update={"timing": None})
+    return response
+
+
+def _speculate(query: str) -> Optional[Speculation]:
+    """启动推测执行；计划缓存命中时规划几乎不耗时，无需推测"""
+    speculator = app.state.speculator
+    if speculator is None:
+        return None
+    plan_cache = app.state.plan_cache
+    if plan_cache is not None and query in plan_cache:
+        return None
+    return speculator.start(query, app.state.engine)
+
+
+async def _run_analysis(query: str) -> QueryResponse:
+    """规划并执行一次分析，响应中附带以本次分析为根的耗时明细"""
+    with get_tracer().span("analyze") as root:
+        response = await _analyze(query)
+    return response.model_copy(update={"timing": root.breakdown()})
+
+
+async def _analyze(query: str) -> QueryResponse:
+    """规划并执行一次分析"""
+    try:
+        # 复用应用级共享的规划器和执行引擎
+        planner = app.state.planner
+        engine = app.state.engine
+        speculation = _speculate(query)
         
-        # 执行计划
-        final_answer = await engine.run(plan)
+        try:
+            # 边规划边执行：计划中的任务一旦完整输出且依赖已就绪就开始执行
+            try:
+                plan, final_answer = await engine.run_incremental(planner.stream_plan(query), speculation)
+            except ValueError as e:
+                return QueryResponse(
+                    success=False,
+                    message=f"执行计划不合法: {e}"
+                )
+            
+            if not plan:
+                return QueryResponse(
+                    success=False,
+                    message="创建执行计划失败"
+                )
+            if speculation is not None:
+                app.state.speculator.record(query, plan)
+        finally:
+            if speculation is not None:
+                speculation.finish()
         
         return QueryResponse(
             plan=plan,
@@ -87,10 +180,221 @@ async def analyze(request: QueryRequest):
             success=True
         )
     
+    except LLMUnavailableError:
+        # 由调用方决定返回 429/503（/analyze）还是重新排队（作业模式）
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"执行失败: {str(e)}")
 
 
+async def _run_job(query: str) -> Dict[str, Any]:
+    """作业队列的执行函数：与 /analyze 共享请求合并，LLMUnavailableError 交给队列重新排队"""
+    try:
+        response = await app.state.inflight.do(query_key(query), lambda: _run_analysis(query))
+    except HTTPException as e:
+        raise RuntimeError(e.detail)
+    return response.model_dump(mode="json", exclude={"timing"})
+
+
+@app.post("/analyze/stream")
+async def analyze_stream(request: QueryRequest):
+    """
+    流式分析接口（Server-Sent Events）
+    
+    规划过程中每输出一个完整任务推送 plan_task 事件（该任务随即开始执行），
+    计划生成完毕推送 plan 事件，每个任务完成时推送 task 事件，
+    合成阶段逐段推送 token 事件，最后推送 answer 和 done 事件
+    """
+    planner = app.state.planner
+    engine = app.state.engine
+    
+    async def event_stream():
+        speculation = _speculate(request.query)
+        try:
+            async for item in engine.run_incremental_stream(planner.stream_plan(request.query), speculation):
+                if item["event"] == "plan_task":
+                    yield sse("plan_task", item["data"].model_dump(mode="json"))
+                elif item["event"] == "plan":
+                    plan = item["data"]
+                    if not plan:
+                        yield sse("error", {"message": "创建执行计划失败"})
+                        return
+                    if speculation is not None:
+                        app.state.speculator.record(request.query, plan)
+                    yield sse("plan", plan.model_dump(mode="json"))
+                else:
+                    yield sse(item["event"], item["data"])
+            yield sse("done", {"success": True})
+        except ValueError as e:
+            yield sse("error", {"message": f"执行计划不合法: {e}"})
+        except LLMUnavailableError as e:
+            yield sse("error", {"message": str(e), "status": e.status_code, "retryAfter": e.retry_after})
+        except Exception as e:
+            yield sse("error", {"message": f"执行失败: {str(e)}"})
+        finally:
+            if speculation is not None:
+                speculation.finish()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: JobRequest):
+    """
+    作业模式分析接口
+    
+    查询写入队列后立即返回任务ID，由后台工作协程执行；通过 GET /jobs/{id} 轮询、
+    GET /jobs/{id}/events 订阅，或在请求中提供 webhook 接收结果。webhook 地址不允许访问时返回 400，队列已满时返回 429。
+    """
+    try:
+        job = await app.state.jobs.submit(request.query, request.webhook)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": retry_after_header(e.retry_after)},
+        )
+    return job.to_dict()
+
+
+@app.get("/jobs/stats")
+async def job_stats():
+    """作业队列统计：工作协程数、各状态任务数、拒绝数和重新排队数"""
+    return await asyncio.to_thread(app.state.jobs.stats)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询任务状态，完成后 result 为与 /analyze 相同的响应"""
+    job = await app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"任务 {job_id} 不存在")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    任务状态事件流（Server-Sent Events）
+    
+    每次状态变化推送 status 事件，任务结束后推送 done 事件并关闭连接
+    """
+    jobs = app.state.jobs
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"任务 {job_id} 不存在")
+    
+    async def event_stream():
+        current = job
+        last = None
+        sent_at = time.monotonic()
+        while True:
+            state = current.to_dict()
+            if (state["status"], state["attempts"]) != last:
+                last = (state["status"], state["attempts"])
+                sent_at = time.monotonic()
+                yield sse("status", state)
+            elif time.monotonic() - sent_at > 15:
+                # 长时间没有状态变化时发送注释行，避免代理断开空闲连接
+                sent_at = time.monotonic()
+                yield ": keepalive\n\n"
+            if current.finished:
+                yield sse("done", {"success": current.status == "succeeded"})
+                return
+            current = await jobs.wait(job_id, timeout=15.0)
+            if current is None:
+                yield sse("error", {"message": f"任务 {job_id} 已被清理"})
+                return
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """LLM响应缓存命中统计"""
+    cache = app.state.llm_client.cache
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+
+@app.get("/plan-cache/stats")
+async def plan_cache_stats():
+    """执行计划缓存命中统计"""
+    plan_cache = app.state.plan_cache
+    if plan_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **plan_cache.stats()}
+
+
+@app.delete("/plan-cache")
+async def invalidate_plan_cache(query: Optional[str] = None):
+    """使计划缓存失效：指定 query 时只清除该查询结构的模板，否则清空全部"""
+    plan_cache = app.state.plan_cache
+    if plan_cache is None:
+        return {"enabled": False}
+    if query is None:
+        plan_cache.clear()
+        return {"enabled": True, "invalidated": "all"}
+    return {"enabled": True, "invalidated": plan_cache.invalidate(query)}
+
+
+@app.get("/plan-batch/stats")
+async def plan_batch_stats():
+    """规划微批处理统计：批次数、平均批大小、未合并与回退的请求数"""
+    batcher = app.state.plan_batcher
+    if batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **batcher.stats()}
+
+
+@app.get("/inflight/stats")
+async def inflight_stats():
+    """请求合并统计：/analyze、LLM调用、Text2SQL执行"""
+    return {
+        "analyze": app.state.inflight.stats(),
+        "llm": app.state.llm_client.inflight.stats(),
+        "text2sql": app.state.text2sql.inflight.stats(),
+    }
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    """LLM调度统计：当前并发上限、占用、各优先级排队数和重试/限流次数"""
+    return app.state.llm_client.scheduler.stats()
+
+
+@app.get("/model-routes/stats")
+async def model_route_stats():
+    """模型路由统计：各调用点的模型分布、SLO 降级次数、延迟分位数和 token 用量"""
+    return app.state.llm_client.router.stats()
+
+
+@app.get("/speculation/stats")
+async def speculation_stats():
+    """推测执行统计：预取任务数、被采用数、浪费数、命中率和浪费的执行时间"""
+    speculator = app.state.speculator
+    if speculator is None:
+        return {"enabled": False}
+    return {"enabled": True, **speculator.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 指标：各阶段耗时直方图、进行中的阶段数、LLM token 数和缓存命中"""
+    return PlainTextResponse(get_tracer().metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/health")
 async def health():
     """健康检查接口"""
@@ -1,15 +1,35 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Dict, Optional
+from contextlib import asynccontextmanager
 import uvicorn
 import os
 
-from LangGraphAgentServer.graph_builder import run_agent_graph
+from AgentPlannerServer.http_utils import sse
+from AgentPlannerServer.model_router import get_router
+from AgentPlannerServer.singleflight import SingleFlight, query_key
+from AgentPlannerServer.tracing import get_tracer
+from LangGraphAgentServer.graph_builder import (
+    get_checkpointer, new_run_id, resume_agent_graph, run_agent_graph, stream_agent_graph, warm_up, shutdown,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时预热执行图和LLM实例，退出时释放连接池"""
+    warm_up()
+    # 相同查询的并发 /analyze 请求共享同一次图执行
+    app.state.inflight = SingleFlight()
+    try:
+        yield
+    finally:
+        await shutdown()
+        await get_tracer().aclose()
 
 
-app = FastAPI(title="基于LangGraph的多Agent调度服务器", version="1.0.0")
+app = FastAPI(title="基于LangGraph的多Agent调度服务器", version="1.0.0", lifespan=lifespan)
 
 # 配置CORS
 app.add_middleware(
@@ -24,6 +44,7 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     """查询请求模型"""
     query: str
+    timing: bool = False
 
 
 class QueryResponse(BaseModel):
@@ -32,6 +53,8 @@ class QueryResponse(BaseModel):
     success: bool
     message: Optional[str] = None
     execution_state: Optional[dict] = None
+    run_id: Optional[str] = None
+    timing: Optional[Dict[str, Any]] = None
 
 
 # 提供静态文件服务
@@ -57,23 +80,124 @@ async def analyze(request: QueryRequest):
     """
     分析接口 - 使用LangGraph调度多个Agent
     
-    接收用户查询，通过LangGraph调度多个Agent执行任务并返回结果
+    接收用户查询，通过LangGraph调度多个Agent执行任务并返回结果。
+    相同查询的并发请求合并为一次执行，所有请求共享同一结果。
+    timing=true 时响应中附带各节点的耗时明细。
     """
+    response = await app.state.inflight.do(
+        query_key(request.query),
+        lambda: _run_analysis(request.query),
+    )
+    if not request.timing:
+        response = response.model_copy(update={"timing": None})
+    return response
+
+
+async def _run_analysis(query: str) -> QueryResponse:
+    """运行一次多Agent流程；失败时通过 X-Run-Id 响应头返回运行ID，可用于恢复"""
+    run_id = new_run_id()
     try:
         # 使用LangGraph运行多Agent流程
-        final_state = await run_agent_graph(request.query)
+        with get_tracer().span("analyze", run_id=run_id) as root:
+            final_state = await run_agent_graph(query, run_id)
         
-        return QueryResponse(
-            finalAnswer=final_state.get("final_answer"),
-            success=True,
-            execution_state={
-                "tasks": final_state.get("tasks", []),
-                "results_count": len(final_state.get("results", {}))
-            }
-        )
+        return _response(run_id, final_state, root.breakdown())
     
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"执行失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"执行失败: {str(e)}", headers={"X-Run-Id": run_id})
+
+
+def _response(run_id: str, final_state: dict, timing: Optional[Dict[str, Any]]) -> QueryResponse:
+    plan = final_state.get("plan")
+    return QueryResponse(
+        finalAnswer=final_state.get("final_answer"),
+        success=True,
+        execution_state={
+            "tasks": plan.to_dicts() if plan else [],
+            "results_count": len(final_state.get("results", {}))
+        },
+        run_id=run_id,
+        timing=timing
+    )
+
+
+@app.post("/analyze/{run_id}/resume", response_model=QueryResponse)
+async def resume(run_id: str, timing: bool = False):
+    """
+    从最近的检查点恢复一次中断或失败的运行
+    
+    已完成的节点（包括并行分支中已完成的一支）不再执行，只重跑剩余的节点；
+    运行已经完成时直接返回保存的结果。同一运行的并发恢复请求合并为一次执行。
+    """
+    response = await app.state.inflight.do(f"resume:{run_id}", lambda: _resume(run_id))
+    if not timing:
+        response = response.model_copy(update={"timing": None})
+    return response
+
+
+async def _resume(run_id: str) -> QueryResponse:
+    try:
+        with get_tracer().span("resume", run_id=run_id) as root:
+            final_state = await resume_agent_graph(run_id)
+        return _response(run_id, final_state, root.breakdown())
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"运行 {run_id} 不存在或检查点已被清理")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"执行失败: {str(e)}", headers={"X-Run-Id": run_id})
+
+
+@app.post("/analyze/stream")
+async def analyze_stream(request: QueryRequest):
+    """
+    流式分析接口（Server-Sent Events）
+    
+    通过 astream_events 推送规划结果、各Agent的任务结果和综合阶段的token
+    """
+    run_id = new_run_id()
+    
+    async def event_stream():
+        yield sse("run", {"run_id": run_id})
+        try:
+            async for item in stream_agent_graph(request.query, run_id):
+                yield sse(item["event"], item["data"])
+            yield sse("done", {"success": True})
+        except Exception as e:
+            yield sse("error", {"message": f"执行失败: {str(e)}", "run_id": run_id})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/inflight/stats")
+async def inflight_stats():
+    """请求合并统计"""
+    return {"analyze": app.state.inflight.stats()}
+
+
+@app.get("/checkpoints/stats")
+async def checkpoint_stats():
+    """检查点统计：保留的运行数和检查点数"""
+    checkpointer = get_checkpointer()
+    if checkpointer is None:
+        return {"enabled": False}
+    return {"enabled": True, **checkpointer.stats()}
+
+
+@app.get("/model-routes/stats")
+async def model_route_stats():
+    """模型路由统计：各调用点的模型分布、SLO 降级次数、延迟分位数和 token 用量"""
+    return get_router().stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 指标：各节点耗时直方图、进行中的节点数、LLM token 数"""
+    return PlainTextResponse(get_tracer().metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/health")
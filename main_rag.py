@@ -3,16 +3,35 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from typing import Optional
+from contextlib import asynccontextmanager
 import uvicorn
 import os
 
 from RAGKnowledgeGraphServer.llm_client import LLMClient
+from AgentPlannerServer.http_utils import unavailable
+from AgentPlannerServer.llm_cache import ResponseCache
+from AgentPlannerServer.llm_scheduler import LLMUnavailableError
 from RAGKnowledgeGraphServer.agent_planner import AgentPlanner
 from RAGKnowledgeGraphServer.execution_engine import ExecutionEngine
+from RAGKnowledgeGraphServer.knowledge_graph import KnowledgeGraphRetriever
 from RAGKnowledgeGraphServer.types import ExecutionPlan
 
 
-app = FastAPI(title="基于知识图谱的RAG检索服务器", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：创建进程级共享的LLM客户端和知识图谱检索器，退出时关闭连接池"""
+    app.state.llm_client = LLMClient(cache=ResponseCache.from_env())
+    app.state.kg_retriever = KnowledgeGraphRetriever.from_env()
+    # 结果按请求存放在独立的执行上下文中，规划器和执行引擎可在请求间复用
+    app.state.planner = AgentPlanner(app.state.llm_client)
+    app.state.engine = ExecutionEngine(app.state.llm_client, retriever=app.state.kg_retriever)
+    try:
+        yield
+    finally:
+        await app.state.llm_client.aclose()
+
+
+app = FastAPI(title="基于知识图谱的RAG检索服务器", version="1.0.0", lifespan=lifespan)
 
 # 配置CORS，允许前端访问
 app.add_middleware(
@@ -63,13 +82,18 @@ async def analyze(request: QueryRequest):
     接收用户查询，创建执行计划，执行任务并返回结果
     """
     try:
-        # 初始化组件
-        client = LLMClient()
-        planner = AgentPlanner(client)
-        engine = ExecutionEngine(client)
+        # 复用应用级共享的规划器和执行引擎
+        planner = app.state.planner
+        engine = app.state.engine
         
-        # 创建计划
-        plan = await planner.create_plan(request.query)
+        # 边规划边执行：计划中的任务一旦完整输出且依赖已就绪就开始执行
+        try:
+            plan, final_answer = await engine.run_incremental(planner.stream_plan(request.query))
+        except ValueError as e:
+            return QueryResponse(
+                success=False,
+                message=f"执行计划不合法: {e}"
+            )
         
         if not plan:
             return QueryResponse(
@@ -77,15 +101,14 @@ async def analyze(request: QueryRequest):
                 message="创建执行计划失败"
             )
         
-        # 执行计划
-        final_answer = await engine.run(plan)
-        
         return QueryResponse(
             plan=plan,
             finalAnswer=final_answer,
             success=True
         )
     
+    except LLMUnavailableError as e:
+        raise unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"执行失败: {str(e)}")
 